@@ -1,30 +1,241 @@
+import json
 import logging
 import os
+import tempfile
+import threading
 from datetime import datetime
 
+from lib.deadline_module import NonRetryableError, RetryScheduler
+from lib.metadata_segment_module import MetadataSegmentSpool
 from lib.remote_storage_module import get_archive_class
 
 module_logger = logging.getLogger('tr_rdio_uploader.archive')
 
+# How often long running modes check for metadata segments that are due, at most.
+METADATA_FLUSH_INTERVAL_SECONDS = 30
 
-def archive_files(archive_config, source_path, wav_filename, call_data, system_short_name):
+
+def archive_files(archive_config, source_path, wav_filename, call_data, system_short_name, stage_deadline=None,
+                  bandwidth_config=None, compression_enabled=True):
+    """
+    Upload a call's files, one attempt each.
+
+    :param compression_enabled: Whether an m4a is made for the call. When it isn't, a missing m4a is
+                                skipped. Otherwise a missing m4a is retried, and resume_stages encodes it again.
+
+    :return: Tuple of (wav URL, m4a URL, json URL, extensions whose upload failed and is worth retrying).
+             The caller re-queues the archive stage for a retry rather than waiting here.
+    """
     wav_url_path = None
     m4a_url_path = None
     json_url_path = None
 
-    if not archive_config.get("archive_path", "") and archive_config.get('archive_type', '') not in ["google_cloud", "aws_s3"]:
+    archive_class = _get_archive_class(archive_config, bandwidth_config)
+    if not archive_class:
+        # A config problem. Another attempt would fail the same way.
+        return wav_url_path, m4a_url_path, json_url_path, []
+
+    generated_folder_path, folder_path, upload_paths = _archive_paths(archive_config, source_path, wav_filename,
+                                                                      call_data, system_short_name)
+
+    module_logger.info(f"Archiving {' '.join(archive_config.archive_extensions)} files via {archive_config.archive_type} to: {folder_path}")
+
+    upload_tasks = {}
+    for extension in archive_config.archive_extensions:
+        if extension == ".json" and archive_config.metadata_mode == "segments":
+            continue
+        if extension not in upload_paths:
+            module_logger.warning("<<Archive>> <<error>> Unknown Archive Extension")
+            continue
+        if extension == ".m4a" and not compression_enabled and not os.path.isfile(upload_paths[extension][0]):
+            module_logger.debug("<<Archive>> Compression is disabled, no .m4a to archive.")
+            continue
+        upload_tasks[extension] = _upload_task(archive_class, *upload_paths[extension], generated_folder_path, stage_deadline,
+                                               missing_is_retryable=extension == ".m4a")
+
+    upload_responses, retry_extensions = RetryScheduler(stage_deadline).run(upload_tasks)
+
+    wav_url_path = upload_responses.get(".wav")
+    m4a_url_path = upload_responses.get(".m4a")
+    json_url_path = upload_responses.get(".json")
+
+    # Checksums of what each backend confirmed it stored, taken from the same read that sent the file.
+    archive_checksums = {extension.lstrip("."): archive_class.upload_checksums[upload_paths[extension][1]]
+                         for extension in upload_tasks if upload_responses.get(extension)
+                         and upload_paths[extension][1] in archive_class.upload_checksums}
+    if archive_checksums:
+        call_data["archive_checksums"] = archive_checksums
+
+    # The record is appended once, by the attempt that finishes the uploads, so a retry doesn't add it twice.
+    if ".json" in archive_config.archive_extensions and archive_config.metadata_mode == "segments" and not retry_extensions:
+        json_url_path = _archive_metadata_segment(archive_class, archive_config, wav_filename, call_data,
+                                                  system_short_name, stage_deadline)
+
+    if archive_config.archive_days >= 1:
+        archive_class.clean_files(os.path.join(archive_config.archive_path, system_short_name), archive_config.archive_days)
+
+    return wav_url_path, m4a_url_path, json_url_path, retry_extensions
+
+
+def archive_call_metadata(archive_config, wav_filename, call_data, system_short_name, temp_path, stage_deadline=None,
+                          bandwidth_config=None):
+    """
+    Archive a call's metadata from call_data, without its audio. Used for linked simulcast
+    duplicates, whose record points at the kept call's audio.
+
+    In file metadata mode call_data is written to a temporary JSON file under temp_path and
+    uploaded in place of the call's own JSON. In segments mode it is appended to the segment.
+
+    :return: URL of the archived metadata, or None if it could not be archived.
+    """
+    if ".json" not in archive_config.archive_extensions:
+        module_logger.warning("<<Archive>> <<error>> .json is not in archive_extensions, call metadata not archived.")
+        return None
+
+    archive_class = _get_archive_class(archive_config, bandwidth_config)
+    if not archive_class:
+        return None
+
+    if archive_config.metadata_mode == "segments":
+        return _archive_metadata_segment(archive_class, archive_config, wav_filename, call_data, system_short_name,
+                                         stage_deadline)
+
+    try:
+        with tempfile.TemporaryDirectory(prefix="tr_rdio_metadata_", dir=temp_path or None) as metadata_path:
+            generated_folder_path, _, upload_paths = _archive_paths(archive_config, metadata_path, wav_filename,
+                                                                    call_data, system_short_name)
+            source_file_path, destination_file_path = upload_paths[".json"]
+            with open(source_file_path, 'w') as f:
+                json.dump(call_data, f, indent=4)
+            json_url_path = _upload_task(archive_class, source_file_path, destination_file_path, generated_folder_path,
+                                         stage_deadline)()
+    except OSError as e:
+        module_logger.error(f"<<Archive>> <<error>> Unable to write call metadata: {e}")
+        return None
+
+    return json_url_path or None
+
+
+def archived_file_urls(archive_config, wav_filename, call_data, system_short_name):
+    """
+    URLs a call's files were archived under, without uploading anything.
+
+    Used when the archive stage is skipped for a call that was archived on an earlier run.
+    Returns the same (wav, m4a, json) tuple as archive_files, with None for extensions not archived.
+    The json URL is None in segments metadata mode, where it depends on which segment the call landed in.
+    """
+    urls = {}
+
+    archive_class = _get_archive_class(archive_config)
+    if archive_class:
+        generated_folder_path, _, upload_paths = _archive_paths(archive_config, "", wav_filename,
+                                                                call_data, system_short_name)
+        for extension in archive_config.archive_extensions:
+            if extension == ".json" and archive_config.metadata_mode == "segments":
+                continue
+            if extension in upload_paths:
+                urls[extension] = archive_class.file_url(upload_paths[extension][1], generated_folder_path)
+
+    return urls.get(".wav"), urls.get(".m4a"), urls.get(".json")
+
+
+def _archive_metadata_segment(archive_class, archive_config, wav_filename, call_data, system_short_name, stage_deadline):
+    """
+    Append the call's metadata to its hourly segment and upload any segments that are due.
+
+    Sets call_data["archive_metadata"] to the segment URL and the record's byte range.
+    :return: URL of the segment holding the call's metadata.
+    """
+    spool = MetadataSegmentSpool(archive_config.metadata_segments)
+    try:
+        segment_name, generated_folder_path, offset, length = spool.append(call_data, wav_filename.replace(".wav", ""),
+                                                                           system_short_name)
+    except OSError as e:
+        module_logger.error(f"<<Archive>> <<error>> Unable to spool call metadata: {e}")
+        return None
+
+    segment_url = archive_class.file_url(os.path.join(archive_config.archive_path, generated_folder_path, segment_name),
+                                         generated_folder_path)
+    call_data["archive_metadata"] = {"url": segment_url, "offset": offset, "length": length}
+
+    try:
+        spool.flush(archive_class, archive_config.archive_path, stage_deadline.timeout() if stage_deadline else None)
+    except Exception as e:
+        # The call's record is safely spooled. The segment is uploaded on a later flush.
+        module_logger.warning(f"<<Archive>> Metadata segment flush deferred: {e}")
+
+    return segment_url
+
+
+def flush_metadata_segments(archive_config, bandwidth_config=None):
+    """Seal and upload every spooled metadata segment, e.g. when watch mode or a backfill stops."""
+    if archive_config.metadata_mode != "segments" or ".json" not in archive_config.archive_extensions:
+        return
+
+    archive_class = _get_archive_class(archive_config, bandwidth_config)
+    if not archive_class:
+        return
+
+    uploaded = MetadataSegmentSpool(archive_config.metadata_segments).flush(archive_class, archive_config.archive_path,
+                                                                            force=True)
+    module_logger.info(f"<<Archive>> Flushed {uploaded} metadata segments.")
+
+
+def start_metadata_segment_flusher(config_manager, stop_event):
+    """
+    Seal and upload due metadata segments on a background thread until stop_event is set, so a
+    segment is archived once it is due even when no later call comes along to flush it. Used by
+    watch and worker mode. The archive settings are read from the current config on every check.
+    """
+    def flush_due_segments():
+        while True:
+            archive_config = config_manager.current.archive
+            interval_seconds = max(1, min(METADATA_FLUSH_INTERVAL_SECONDS,
+                                          archive_config.metadata_segments.max_segment_age_seconds))
+            if stop_event.wait(interval_seconds):
+                return
+            if archive_config.metadata_mode != "segments" or ".json" not in archive_config.archive_extensions:
+                continue
+
+            try:
+                spool = MetadataSegmentSpool(archive_config.metadata_segments)
+                spool.seal_due()
+                if not spool.has_sealed():
+                    continue
+                archive_class = _get_archive_class(archive_config, config_manager.current.bandwidth)
+                if archive_class:
+                    spool.upload_sealed(archive_class, archive_config.archive_path)
+            except Exception as e:
+                module_logger.warning(f"<<Archive>> Metadata segment flush failed, will try again: {e}")
+
+    threading.Thread(target=flush_due_segments, name="MetadataSegmentFlusher", daemon=True).start()
+
+
+def _get_archive_class(archive_config, bandwidth_config=None):
+    """Validate the archive config and start its storage class. Returns None when archiving can't run."""
+    if not archive_config.archive_path and archive_config.archive_type not in ["google_cloud", "aws_s3"]:
         module_logger.warning("<<Archive>> <<error>> No Archive Path Set")
-        return wav_url_path, m4a_url_path, json_url_path
+        return None
 
-    if not archive_config.get('archive_type', '') or archive_config.get('archive_type', '') not in ["google_cloud", "aws_s3", "scp", "local"]:
-        module_logger.warning(f"<<Archive>> <<error>> Archive Type Not Set or Invalid. {archive_config.get('archive_type', '')}")
-        return wav_url_path, m4a_url_path, json_url_path
+    if not archive_config.archive_type or archive_config.archive_type not in ["google_cloud", "aws_s3", "scp", "local"]:
+        module_logger.warning(f"<<Archive>> <<error>> Archive Type Not Set or Invalid. {archive_config.archive_type}")
+        return None
 
-    archive_class = get_archive_class(archive_config)
+    archive_class = get_archive_class(archive_config, bandwidth_config)
     if not archive_class:
-        module_logger.warning(f"<<Archive>> <<error>> Can not start the Archive Class for {archive_config.get('archive_type', '')}")
-        return wav_url_path, m4a_url_path, json_url_path
+        module_logger.warning(f"<<Archive>> <<error>> Can not start the Archive Class for {archive_config.archive_type}")
+        return None
+
+    return archive_class
 
+
+def _archive_paths(archive_config, source_path, wav_filename, call_data, system_short_name):
+    """
+    Work out where a call's files are archived.
+
+    :return: Tuple of (generated folder path, destination folder path,
+             dict of extension -> (source file path, destination file path)).
+    """
     # Convert the epoch timestamp to a datetime object in UTC
     call_date = datetime.utcfromtimestamp(call_data['start_time'])
 
@@ -32,39 +243,35 @@ def archive_files(archive_config, source_path, wav_filename, call_data, system_s
                                str(call_date.month), str(call_date.day))
 
     # Create folder structure using current date
-    folder_path = os.path.join(archive_config.get("archive_path"), generated_folder_path)
+    folder_path = os.path.join(archive_config.archive_path, generated_folder_path)
 
     m4a_filename = wav_filename.replace(".wav", ".m4a")
     json_filename = wav_filename.replace(".wav", ".json")
 
-    source_wav_path = os.path.join(source_path, wav_filename)
-    destination_wav_path = os.path.join(folder_path, wav_filename)
-
-    source_m4a_path = os.path.join(source_path, m4a_filename)
-    destination_m4a_path = os.path.join(folder_path, m4a_filename)
-
-    source_json_path = os.path.join(source_path, json_filename)
-    destination_json_path = os.path.join(folder_path, json_filename)
-
-    module_logger.info(f"Archiving {' '.join(archive_config.get('archive_extensions', []))} files via {archive_config.get('archive_type', '')} to: {folder_path}")
-
-    for extension in archive_config.get('archive_extensions', []):
-        if extension == ".wav":
-            upload_response = archive_class.upload_file(source_wav_path, destination_wav_path, generated_folder_path)
-            if upload_response:
-                wav_url_path = upload_response
-        elif extension == ".m4a":
-            upload_response = archive_class.upload_file(source_m4a_path, destination_m4a_path, generated_folder_path)
-            if upload_response:
-                m4a_url_path = upload_response
-        elif extension == ".json":
-            upload_response = archive_class.upload_file(source_json_path, destination_json_path, generated_folder_path)
-            if upload_response:
-                json_url_path = upload_response
-        else:
-            module_logger.warning("<<Archive>> <<error>> Unknown Archive Extension")
+    upload_paths = {
+        ".wav": (os.path.join(source_path, wav_filename), os.path.join(folder_path, wav_filename)),
+        ".m4a": (os.path.join(source_path, m4a_filename), os.path.join(folder_path, m4a_filename)),
+        ".json": (os.path.join(source_path, json_filename), os.path.join(folder_path, json_filename))
+    }
+
+    return generated_folder_path, folder_path, upload_paths
+
+
+def _upload_task(archive_class, source_file_path, destination_file_path, generated_folder_path, stage_deadline,
+                 missing_is_retryable=False):
+    """
+    Bind a single upload attempt, timed against the archive stage deadline, for the RetryScheduler.
 
-    if archive_config.get("archive_days", 0) >= 1:
-        archive_class.clean_files(os.path.join(archive_config.get("archive_path"), system_short_name), archive_config.get("archive_days", 1))
+    :param missing_is_retryable: Retry a missing source file rather than giving up on it, for files a retry makes again.
+    """
+    def attempt_upload():
+        if not os.path.isfile(source_file_path):
+            if missing_is_retryable:
+                module_logger.error(f"<<Archive>> <<error>> Source file {source_file_path} does not exist.")
+                return None
+            raise NonRetryableError(f"Source file {source_file_path} does not exist.")
+        timeout = stage_deadline.timeout() if stage_deadline else None
+        return archive_class.upload_file(source_file_path, destination_file_path, generated_folder_path,
+                                         max_attempts=1, timeout=timeout)
 
-    return wav_url_path, m4a_url_path, json_url_path
+    return attempt_upload
@@ -5,16 +5,21 @@ import re
 import shutil
 import subprocess
 
+from lib.deadline_module import DeadlineExceededError
+from lib.encode_resources_module import run_ffmpeg
+
 module_logger = logging.getLogger('tr_rdio_uploader.audio_file_module')
 
-def save_temporary_file(tmp_path: str, source_file_path: str) -> None:
+def save_temporary_file(tmp_path: str, source_file_path: str) -> str:
     """
     Saves the given source_file_path into tmp_path.
 
     :param tmp_path: The directory into which the file should be saved.
     :param source_file_path: The path to the file that needs to be copied.
-    :return: None
+    :return: The path of the saved copy.
     """
+    file_label: str = "<<FILE>>"
+    target_path: str = tmp_path
     try:
         # Ensure the directory exists
         os.makedirs(tmp_path, exist_ok=True)
@@ -31,13 +36,14 @@ def save_temporary_file(tmp_path: str, source_file_path: str) -> None:
         extension = extension.lower()
 
         if extension == '.wav':
-            file_label: str = "<<WAV>>"
+            file_label = "<<WAV>>"
         elif extension == '.json':
             file_label = "<<JSON>>"
         else:
             file_label = "<<FILE>>"
 
         module_logger.debug(f"{file_label} saved successfully at {target_path}")
+        return target_path
 
     except Exception as e:
         module_logger.error(f"Failed to save {file_label} at {target_path}: {e}")
@@ -59,10 +65,33 @@ def load_call_json(json_file_path):
         module_logger.error(f"Unexpected <<Error>> while loading <<Call>> <<Metadata>> {json_file_path}: {e}")
         return None
 
+def _ffmpeg_timeout(stage_deadline):
+    """Timeout for the next ffmpeg run, or None if the encode stage has no deadline."""
+    if stage_deadline is None:
+        return None
+    return stage_deadline.timeout()
+
+def loudnorm_second_pass_filter(compression_config, stats):
+    """
+    The second-pass loudnorm filter for a call, from its first-pass JSON summary. Shared by single
+    and batched encodes, so a call gets the same gain either way.
+    """
+    return "loudnorm=" + ":".join([
+        compression_config.loudnorm_second_pass_params,
+        f"measured_I={stats['input_i']}",
+        f"measured_TP={stats['input_tp']}",
+        f"measured_LRA={stats['input_lra']}",
+        f"measured_thresh={stats['input_thresh']}",
+        f"offset={float(stats.get('target_offset', 0.0))}",
+        "print_format=summary"
+    ])
+
+
 def compress_wav_to_m4a(
         input_wav: str,
         output_m4a: str,
-        compression_config: dict
+        compression_config,
+        stage_deadline=None
 ) -> None:
     """
     Compress a WAV file to M4A using ffmpeg with specified settings and optional
@@ -70,26 +99,18 @@ def compress_wav_to_m4a(
 
     :param input_wav:    Path to the input WAV file
     :param output_m4a:   Path to the output M4A file
-    :param compression_config:       Dictionary containing compression and normalization config.
-                         Example:
-                         {
-                           "enabled": True,
-                           "sample_rate": 16000,
-                           "bitrate": 96,
-                           "normalization": True,
-                           "use_loudnorm": True,
-                           "loudnorm_params": {
-                               "I": -16.0,
-                               "TP": -1.5,
-                               "LRA": 11.0
-                           }
-                         }
+    :param compression_config:       CompressionConfig with the compression and normalization
+                         settings. Its loudnorm filter strings are built once when the config loads.
+    :param stage_deadline: Optional StageDeadline. Each ffmpeg run is given the remaining stage
+                         budget and is killed if it runs past it. Waiting for an encode slot
+                         (resources.max_concurrent) counts against the same budget.
 
     :raises FileNotFoundError: If the input file does not exist.
     :raises EnvironmentError:  If ffmpeg is not installed or not found in PATH.
     :raises subprocess.CalledProcessError: If the ffmpeg command fails.
+    :raises DeadlineExceededError: If ffmpeg does not finish within the stage budget.
     """
-    if not compression_config.get("enabled", False):
+    if not compression_config.enabled:
         module_logger.warning("Compression is disabled in config. Skipping conversion.")
         return
 
@@ -101,28 +122,15 @@ def compress_wav_to_m4a(
     if shutil.which("ffmpeg") is None:
         raise EnvironmentError("ffmpeg is not installed or not found in PATH.")
 
-    sample_rate = compression_config.get("sample_rate", 16000)
-    bitrate     = compression_config.get("bitrate", 96)
-    normalization = compression_config.get("normalization", False)
-    use_loudnorm  = compression_config.get("use_loudnorm", False)
+    sample_rate = compression_config.sample_rate
+    bitrate     = compression_config.bitrate
 
     # If normalization & loudnorm are requested, do two-pass
-    if normalization and use_loudnorm:
-        loudnorm_params = compression_config.get("loudnorm_params", {})
-
-        loudnorm_defaults = {
-            "I":  -16.0,
-            "TP": -1.5,
-            "LRA": 11.0,
-        }
-        for k, v in loudnorm_defaults.items():
-            loudnorm_params.setdefault(k, v)
-
+    if compression_config.two_pass_loudnorm:
         # ---------------------------
         # First Pass: measure stats
         # ---------------------------
-        first_pass_filter_parts = [f"{k}={v}" for k, v in loudnorm_params.items()]
-        first_pass_filter_str = "loudnorm=" + ":".join(first_pass_filter_parts) + ":print_format=json"
+        first_pass_filter_str = compression_config.loudnorm_first_pass_filter
 
         pass1_command = [
             "ffmpeg",
@@ -137,12 +145,9 @@ def compress_wav_to_m4a(
         ]
 
         try:
-            pass1_proc = subprocess.run(
-                pass1_command,
-                capture_output=True,
-                text=True,
-                check=True
-            )
+            pass1_proc = run_ffmpeg(pass1_command, compression_config.resources, _ffmpeg_timeout(stage_deadline))
+        except subprocess.TimeoutExpired as e:
+            raise DeadlineExceededError(f"ffmpeg killed after exceeding its {e.timeout:.1f}s budget. Command: {' '.join(pass1_command)}")
         except subprocess.CalledProcessError as e:
             error_msg = (
                 f"First pass ffmpeg command failed. Command: {' '.join(pass1_command)}\n"
@@ -158,29 +163,11 @@ def compress_wav_to_m4a(
 
         stats = json.loads(match.group(0))
 
-        # The 'offset' is sometimes missing from the JSON so we parse it manually if needed
-        offset_match = re.search(r"offset\s*:\s*([-\d\.]+)", pass1_stderr)
-        offset_val = float(offset_match.group(1)) if offset_match else 0.0
-
         # ---------------------------------------
         # Second Pass: apply measured stats
         # ---------------------------------------
-        second_pass_filter_parts = []
-
-        for k, v in loudnorm_params.items():
-            if k.lower() != "print_format":
-                second_pass_filter_parts.append(f"{k}={v}")
-
-
-        second_pass_filter_parts += [
-            f"measured_I={stats['input_i']}",
-            f"measured_TP={stats['input_tp']}",
-            f"measured_LRA={stats['input_lra']}",
-            f"measured_thresh={stats['input_thresh']}",
-            f"offset={offset_val}",
-            "print_format=summary"
-        ]
-        second_pass_filter_str = "loudnorm=" + ":".join(second_pass_filter_parts)
+        # The gain offset is the summary's "target_offset", 0 when it is missing.
+        second_pass_filter_str = loudnorm_second_pass_filter(compression_config, stats)
 
         pass2_command = [
             "ffmpeg",
@@ -197,12 +184,9 @@ def compress_wav_to_m4a(
         ]
 
         try:
-            completed_process = subprocess.run(
-                pass2_command,
-                capture_output=True,
-                text=True,
-                check=True
-            )
+            completed_process = run_ffmpeg(pass2_command, compression_config.resources, _ffmpeg_timeout(stage_deadline))
+        except subprocess.TimeoutExpired as e:
+            raise DeadlineExceededError(f"ffmpeg killed after exceeding its {e.timeout:.1f}s budget. Command: {' '.join(pass2_command)}")
         except subprocess.CalledProcessError as e:
             error_msg = (
                 f"Second pass ffmpeg command failed. Command: {' '.join(pass2_command)}\n"
@@ -232,12 +216,9 @@ def compress_wav_to_m4a(
         ]
 
         try:
-            completed_process = subprocess.run(
-                command,
-                capture_output=True,
-                text=True,
-                check=True
-            )
+            completed_process = run_ffmpeg(command, compression_config.resources, _ffmpeg_timeout(stage_deadline))
+        except subprocess.TimeoutExpired as e:
+            raise DeadlineExceededError(f"ffmpeg killed after exceeding its {e.timeout:.1f}s budget. Command: {' '.join(command)}")
         except subprocess.CalledProcessError as e:
             error_msg = (
                 f"ffmpeg command failed with error code {e.returncode}.\n"
@@ -246,6 +227,8 @@ def compress_wav_to_m4a(
                 f"Error: {e.stderr}"
             )
             raise subprocess.CalledProcessError(e.returncode, e.cmd, output=error_msg)
+        except DeadlineExceededError:
+            raise
         except Exception as e:
             raise RuntimeError(f"An unexpected error occurred: {e}")
 
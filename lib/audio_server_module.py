@@ -0,0 +1,304 @@
+import logging
+import mimetypes
+import os
+import re
+import select
+import stat
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+module_logger = logging.getLogger('tr_rdio_uploader.audio_server')
+
+SINGLE_BYTE_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+mimetypes.add_type("audio/mp4", ".m4a")
+mimetypes.add_type("application/x-ndjson", ".ndjson")
+
+
+class CachedFile:
+    """An open archive file shared by concurrent responses. Closed once evicted and no longer in use."""
+
+    def __init__(self, path, fd, stat_result):
+        self.path = path
+        self.fd = fd
+        self.size = stat_result.st_size
+        self.identity = (stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+        self.last_modified = stat_result.st_mtime
+        self.etag = f'"{stat_result.st_ino:x}-{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+        self.users = 0
+        self.evicted = False
+
+
+class FileDescriptorCache:
+    """
+    LRU cache of open file descriptors for archived files, so replaying a popular call doesn't
+    open() it for every listener. Entries are checked against a fresh stat() on each lookup and
+    replaced if the file changed. Responses read with os.sendfile at explicit offsets, so one
+    descriptor can serve many responses at once.
+
+    :param max_entries: Number of descriptors kept open.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max(1, max_entries)
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, path):
+        """Open (or reuse) path. Pair with release(). Raises OSError if the file can't be opened."""
+        stat_result = os.stat(path)
+        if not stat.S_ISREG(stat_result.st_mode):
+            raise IsADirectoryError(f"{path} is not a regular file.")
+        identity = (stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+
+        with self._lock:
+            cached_file = self._files.get(path)
+            if cached_file is not None and cached_file.identity == identity:
+                self._files.move_to_end(path)
+                cached_file.users += 1
+                return cached_file
+            if cached_file is not None:
+                self._evict(path)
+
+        fd = os.open(path, os.O_RDONLY)
+        cached_file = CachedFile(path, fd, os.fstat(fd))
+        cached_file.users = 1
+
+        with self._lock:
+            if path in self._files:
+                self._evict(path)
+            self._files[path] = cached_file
+            while len(self._files) > self.max_entries:
+                self._evict(next(iter(self._files)))
+
+        return cached_file
+
+    def release(self, cached_file):
+        with self._lock:
+            cached_file.users -= 1
+            if cached_file.evicted and cached_file.users == 0:
+                os.close(cached_file.fd)
+
+    def _evict(self, path):
+        """Drop path from the cache. Caller holds the lock."""
+        cached_file = self._files.pop(path)
+        cached_file.evicted = True
+        if cached_file.users == 0:
+            os.close(cached_file.fd)
+
+    def close(self):
+        with self._lock:
+            for path in list(self._files):
+                self._evict(path)
+
+
+class AudioRequestHandler(BaseHTTPRequestHandler):
+    """GET/HEAD of archived files with Range and conditional request support."""
+
+    protocol_version = "HTTP/1.1"
+    server_version = "tr_rdio_uploader"
+
+    def setup(self):
+        self.timeout = self.server.request_timeout
+        super().setup()
+
+    def log_message(self, format, *args):
+        module_logger.debug(f"<<Audio Server>> {self.address_string()} {format % args}")
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def _file_path(self):
+        """Archive file for the request path, or None if it is outside the url prefix or the archive root."""
+        request_path = unquote(urlparse(self.path).path)
+        if not request_path.startswith(self.server.url_prefix + "/"):
+            return None
+
+        relative_path = os.path.normpath(request_path[len(self.server.url_prefix):].lstrip("/"))
+        if relative_path.startswith("..") or os.path.isabs(relative_path):
+            return None
+
+        file_path = os.path.join(self.server.archive_root, relative_path)
+        if not os.path.realpath(file_path).startswith(self.server.real_archive_root + os.sep):
+            return None
+        return file_path
+
+    def _not_modified(self, cached_file):
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            return if_none_match.strip() == "*" or cached_file.etag in [tag.strip() for tag in if_none_match.split(",")]
+
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since:
+            try:
+                return int(cached_file.last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _byte_range(self, cached_file):
+        """
+        (start, end) inclusive for a satisfiable single Range request, None to send the whole
+        file, or False if the range can't be satisfied.
+        """
+        range_header = self.headers.get("Range")
+        if not range_header:
+            return None
+
+        # A Range that doesn't match If-Range means the client's copy is stale. Send the whole file.
+        if_range = self.headers.get("If-Range")
+        if if_range and if_range.strip() != cached_file.etag and if_range.strip() != formatdate(cached_file.last_modified, usegmt=True):
+            return None
+
+        match = SINGLE_BYTE_RANGE.match(range_header.strip())
+        if not match or (not match.group(1) and not match.group(2)):
+            # Multiple or malformed ranges. Ignoring Range and sending the file is allowed.
+            return None
+
+        if not match.group(1):
+            suffix_length = int(match.group(2))
+            if suffix_length == 0:
+                return False
+            return max(0, cached_file.size - suffix_length), cached_file.size - 1
+
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else cached_file.size - 1
+        if start >= cached_file.size or end < start:
+            return False
+        return start, min(end, cached_file.size - 1)
+
+    def _serve(self, send_body):
+        file_path = self._file_path()
+        if file_path is None:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+
+        try:
+            cached_file = self.server.fd_cache.acquire(file_path)
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        except OSError as e:
+            module_logger.warning(f"<<Audio Server>> Unable to open {file_path}: {e}")
+            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR)
+            return
+
+        try:
+            if self._not_modified(cached_file):
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self._send_cache_headers(cached_file)
+                self.end_headers()
+                return
+
+            byte_range = self._byte_range(cached_file)
+            if byte_range is False:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", f"bytes */{cached_file.size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            if byte_range is None:
+                start, end = 0, cached_file.size - 1
+                self.send_response(HTTPStatus.OK)
+            else:
+                start, end = byte_range
+                self.send_response(HTTPStatus.PARTIAL_CONTENT)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{cached_file.size}")
+
+            content_type, _ = mimetypes.guess_type(file_path)
+            self.send_header("Content-Type", content_type or "application/octet-stream")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            self._send_cache_headers(cached_file)
+            self.end_headers()
+
+            if send_body and end >= start:
+                self.wfile.flush()
+                self._sendfile(cached_file.fd, start, end - start + 1)
+        except (BrokenPipeError, ConnectionResetError):
+            # Listener went away mid-response.
+            self.close_connection = True
+        finally:
+            self.server.fd_cache.release(cached_file)
+
+    def _send_cache_headers(self, cached_file):
+        self.send_header("ETag", cached_file.etag)
+        self.send_header("Last-Modified", formatdate(cached_file.last_modified, usegmt=True))
+        self.send_header("Cache-Control", f"public, max-age={self.server.cache_max_age_seconds}")
+
+    def _sendfile(self, fd, offset, count):
+        """Send count bytes of fd from offset straight from the page cache to the socket."""
+        socket_fd = self.connection.fileno()
+        while count > 0:
+            try:
+                sent = os.sendfile(socket_fd, fd, offset, count)
+            except BlockingIOError:
+                # The socket has a timeout, so it is non-blocking underneath. Wait for room to write.
+                _, writable, _ = select.select([], [socket_fd], [], self.timeout)
+                if not writable:
+                    raise ConnectionResetError("Timed out sending to client.")
+                continue
+            if sent == 0:
+                # File shrank underneath us.
+                raise ConnectionResetError("File truncated while sending.")
+            offset += sent
+            count -= sent
+
+
+class AudioServer(ThreadingHTTPServer):
+    """
+    Static file server for the local archive.
+
+    :param local_server_config: LocalServerConfig.
+    :param archive_root: archive_path the local archive writes under.
+    :param base_url: local.base_url. Its path is the prefix requests are served under.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, local_server_config, archive_root, base_url):
+        self.archive_root = archive_root
+        self.real_archive_root = os.path.realpath(archive_root)
+        self.url_prefix = urlparse(base_url).path.rstrip("/")
+        self.cache_max_age_seconds = int(local_server_config.cache_max_age_seconds)
+        self.request_timeout = local_server_config.request_timeout
+        self.fd_cache = FileDescriptorCache(local_server_config.fd_cache_size)
+        super().__init__((local_server_config.bind_address, local_server_config.port), AudioRequestHandler)
+
+    def server_close(self):
+        super().server_close()
+        self.fd_cache.close()
+
+
+def run_audio_server(archive_config, stop_event):
+    """
+    Serve the local archive until stop_event is set.
+
+    :param archive_config: ArchiveConfig. Files are served from archive_path under the path of local.base_url.
+    :param stop_event: threading.Event that stops the server.
+    """
+    if not archive_config.archive_path:
+        raise ValueError("archive.archive_path is not set, nothing to serve.")
+
+    server_config = archive_config.local.server
+    audio_server = AudioServer(server_config, archive_config.archive_path, archive_config.local.base_url)
+    server_thread = threading.Thread(target=audio_server.serve_forever, name="AudioServer", daemon=True)
+    server_thread.start()
+    module_logger.info(f"<<Audio Server>> Serving {archive_config.archive_path} on "
+                       f"{server_config.bind_address}:{server_config.port}{audio_server.url_prefix or '/'}")
+
+    try:
+        stop_event.wait()
+    finally:
+        audio_server.shutdown()
+        audio_server.server_close()
+        server_thread.join()
@@ -0,0 +1,239 @@
+import json
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timezone
+
+from lib.archive_module import flush_metadata_segments
+from lib.call_processing_module import process_call, call_archive_urls, resume_stages, CALL_STAGES
+from lib.rate_limit_module import TokenBucket
+
+module_logger = logging.getLogger('tr_rdio_uploader.backfill')
+
+# trunk-recorder names calls <talkgroup>-<start epoch>_<frequency>[-call_<n>].wav
+CALL_FILE_START_TIME = re.compile(r"-(\d{9,11})_")
+
+
+class BackfillCheckpoint:
+    """
+    JSON-lines record of the stages completed for each call in a backfill, so an interrupted
+    backfill can be resumed without redoing finished work.
+
+    Each line is {"wav": <path>, "stages": [<stage>, ...], "archive_urls": {"wav": <url>, "m4a": <url>}}.
+    Later lines for the same WAV add to earlier ones. Stages include an rdio_system_stage for each RDIO
+    system that accepted the call, so a resumed backfill doesn't post to it again.
+    """
+
+    def __init__(self, checkpoint_path):
+        self.checkpoint_path = checkpoint_path
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.checkpoint_path)), exist_ok=True)
+        if not os.path.exists(self.checkpoint_path):
+            return
+
+        with open(self.checkpoint_path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short by a crash mid-write.
+                    continue
+                call = self._calls.setdefault(entry["wav"], {"stages": set(), "archive_urls": {}})
+                call["stages"].update(entry.get("stages", []))
+                call["archive_urls"].update(entry.get("archive_urls", {}))
+
+        module_logger.info(f"Loaded backfill checkpoint {self.checkpoint_path} with {len(self._calls)} calls.")
+
+    def completed_stages(self, wav_path):
+        call = self._calls.get(wav_path)
+        return set(call["stages"]) if call else set()
+
+    def archive_urls(self, wav_path):
+        call = self._calls.get(wav_path)
+        return dict(call["archive_urls"]) if call else {}
+
+    def record(self, wav_path, stages, archive_urls):
+        with self._lock:
+            call = self._calls.setdefault(wav_path, {"stages": set(), "archive_urls": {}})
+            call["stages"].update(stages)
+            call["archive_urls"].update(archive_urls)
+            with open(self.checkpoint_path, 'a') as f:
+                f.write(json.dumps({"wav": wav_path, "stages": sorted(stages), "archive_urls": archive_urls}) + "\n")
+
+
+def _call_start_time(wav_path):
+    """Call start epoch from the trunk-recorder file name, falling back to the call JSON."""
+    match = CALL_FILE_START_TIME.search(os.path.basename(wav_path))
+    if match:
+        return int(match.group(1))
+
+    try:
+        with open(wav_path[:-len(".wav")] + ".json", 'r') as f:
+            return int(json.load(f).get("start_time"))
+    except (OSError, ValueError, TypeError, json.JSONDecodeError):
+        return None
+
+
+def _day_directory_out_of_range(directory, since, until):
+    """True if directory is a trunk-recorder .../Y/M/D folder entirely outside [since, until)."""
+    parts = os.path.normpath(directory).split(os.sep)[-3:]
+    try:
+        day_start = datetime(int(parts[0]), int(parts[1]), int(parts[2]), tzinfo=timezone.utc).timestamp()
+    except (ValueError, IndexError):
+        return False
+
+    return (until is not None and day_start >= until) or (since is not None and day_start + 86400 <= since)
+
+
+def find_calls(search_paths, since=None, until=None):
+    """
+    Yield WAV paths of completed calls (WAV and JSON present) under search_paths whose start
+    time falls in [since, until). Day folders outside the range are not descended into.
+
+    :param search_paths: Directories to search.
+    :param since: Optional start epoch, inclusive.
+    :param until: Optional end epoch, exclusive.
+    """
+    pending_dirs = list(search_paths)
+    while pending_dirs:
+        directory = pending_dirs.pop()
+        try:
+            with os.scandir(directory) as entries:
+                call_files = []
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not _day_directory_out_of_range(entry.path, since, until):
+                            pending_dirs.append(entry.path)
+                    else:
+                        call_files.append(entry.name)
+        except (FileNotFoundError, PermissionError) as e:
+            module_logger.warning(f"<<Backfill>> Unable to scan {directory}: {e}")
+            continue
+
+        file_names = set(call_files)
+        for file_name in sorted(file_names):
+            if not file_name.endswith(".wav") or file_name[:-len(".wav")] + ".json" not in file_names:
+                continue
+
+            wav_path = os.path.join(directory, file_name)
+            start_time = _call_start_time(wav_path)
+            if start_time is None:
+                module_logger.warning(f"<<Backfill>> Could not determine start time of {wav_path}. Skipping.")
+                continue
+            if (since is not None and start_time < since) or (until is not None and start_time >= until):
+                continue
+
+            yield wav_path
+
+
+def _backfill_call(initial_call_data, config_data, stages):
+    """Process pool entry point. Returns (wav path, completed stages, archive urls, error message)."""
+    wav_path = initial_call_data["audio_wav_path"]
+    try:
+        call_data = process_call(initial_call_data, config_data, stages=stages)
+    except Exception as e:
+        return wav_path, [], {}, str(e)
+
+    if call_data is None:
+        return wav_path, [], {}, "Call metadata could not be loaded."
+
+    if call_data.get("simulcast_duplicate_of"):
+        # Nothing left to do for a suppressed duplicate.
+        return wav_path, list(stages), {}, None
+
+    return wav_path, call_data.get("completed_stages", []), call_archive_urls(call_data), None
+
+
+def _stage_rate_limiters(backfill_config, stages):
+    """One token bucket per rate-limited backend that the selected stages will hit."""
+    rate_limits = dict(backfill_config.rate_limits)
+    return [TokenBucket(rate_limits[stage]) for stage in stages if rate_limits.get(stage)]
+
+
+def run_backfill(config_manager, short_name, search_paths, since=None, until=None, stages=None,
+                 checkpoint_path=None, workers=None, stop_event=None):
+    """
+    Reprocess old calls across a process pool.
+
+    :param config_manager: ConfigManager. Each call is submitted with the config current at that time.
+    :param short_name: System short name to process the calls under.
+    :param search_paths: Directories to search for calls.
+    :param since: Optional start epoch, inclusive.
+    :param until: Optional end epoch, exclusive.
+    :param stages: Stages to redo, from CALL_STAGES. Defaults to all of them.
+    :param checkpoint_path: Checkpoint file. Reusing a checkpoint resumes that backfill.
+    :param workers: Number of worker processes.
+    :param stop_event: Optional threading.Event. When set, no further calls are started.
+    :return: Tuple of (calls completed, calls failed, calls skipped as already done).
+    """
+    backfill_config = config_manager.current.backfill
+    stages = [stage for stage in CALL_STAGES if stage in (stages or CALL_STAGES)]
+    checkpoint = BackfillCheckpoint(checkpoint_path or backfill_config.checkpoint_path)
+    workers = workers or backfill_config.workers or os.cpu_count() or 1
+    rate_limiters = _stage_rate_limiters(backfill_config, stages)
+
+    completed = failed = skipped = 0
+    in_flight = set()
+    stages_for = {}
+
+    def collect(done_futures):
+        nonlocal completed, failed
+        for future in done_futures:
+            in_flight.discard(future)
+            wav_path, completed_stages, archive_urls, error = future.result()
+            if completed_stages or archive_urls:
+                checkpoint.record(wav_path, completed_stages, archive_urls)
+            if error or not set(stages_for[wav_path]) <= set(completed_stages):
+                failed += 1
+                module_logger.error(f"<<Backfill>> {wav_path} did not complete {', '.join(stages_for.pop(wav_path))}: {error or 'see log'}")
+            else:
+                stages_for.pop(wav_path)
+                completed += 1
+
+    module_logger.info(f"<<Backfill>> Reprocessing {', '.join(stages)} for {short_name} with {workers} workers.")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for wav_path in find_calls(search_paths, since, until):
+            if stop_event is not None and stop_event.is_set():
+                module_logger.warning("<<Backfill>> Stopping early. Resume with the same checkpoint.")
+                break
+
+            remaining_stages = [stage for stage in stages if stage not in checkpoint.completed_stages(wav_path)]
+            if not remaining_stages:
+                skipped += 1
+                continue
+            # The m4a may only have existed in a staging directory that is gone by now.
+            remaining_stages = resume_stages(wav_path, remaining_stages)
+
+            # Keep the queue short so stopping and rate limits take effect promptly.
+            while len(in_flight) >= workers * 2:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+
+            for rate_limiter in rate_limiters:
+                rate_limiter.acquire()
+
+            initial_call_data = {
+                "short_name": short_name,
+                "audio_wav_path": wav_path,
+                "archive_urls": checkpoint.archive_urls(wav_path),
+                "completed_stages": sorted(checkpoint.completed_stages(wav_path))
+            }
+            stages_for[wav_path] = remaining_stages
+            in_flight.add(executor.submit(_backfill_call, initial_call_data, config_manager.current, remaining_stages))
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            collect(done)
+
+    if "archive" in stages:
+        flush_metadata_segments(config_manager.current.archive, config_manager.current.bandwidth)
+
+    module_logger.info(f"<<Backfill>> Finished. {completed} completed, {failed} failed, {skipped} already done.")
+    return completed, failed, skipped
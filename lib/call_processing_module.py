@@ -1,14 +1,118 @@
 import logging
 import os
 import subprocess
+from contextlib import nullcontext
 
-from lib.archive_module import archive_files
-from lib.audio_file_handler import load_call_json, compress_wav_to_m4a
-from lib.rdio_module import upload_trunk_recorder_call, TrunkRecorderUploadError
+from lib.archive_module import archive_files, archive_call_metadata, archived_file_urls
+from lib.audio_file_handler import load_call_json
+from lib.config_module import AppConfig
+from lib.deadline_module import CallDeadline, DeadlineExceededError
+from lib.encoder_module import get_encoder
+from lib.rate_limit_module import upload_limiters
+from lib.rdio_module import RdioCallPayload, upload_trunk_recorder_call, TrunkRecorderUploadError
+from lib.simulcast_module import simulcast_index
+from lib.staging_module import StagingArea
 
 module_logger = logging.getLogger('tr_rdio_uploader.call_processing_module')
 
-def process_call(initial_call_data: dict , config_data: dict):
+CALL_STAGES = ("encode", "archive", "rdio")
+
+
+def _simulcast_duplicate(call_data, original_entry, config_data, wav_file_name, deadline):
+    """
+    Call data for a suppressed duplicate. With action "link" the duplicate's metadata is archived,
+    pointing at the kept call's archived audio.
+
+    :raises RuntimeError: If the link could not be archived, so the call is retried like a failed upload.
+    """
+    call_data["simulcast_duplicate_of"] = original_entry.wav_path
+    if config_data.simulcast_dedup.action != "link":
+        module_logger.info(f"<<Simulcast>> Dropped duplicate of {original_entry.wav_path}")
+        call_data["completed_stages"] = []
+        return call_data
+
+    archive_urls = original_entry.archive_urls
+    if not archive_urls:
+        # The kept call is still being processed. Link to where it will be archived.
+        wav_url, m4a_url, json_url = archived_file_urls(config_data.archive, os.path.basename(original_entry.wav_path),
+                                                        {"start_time": original_entry.start_time},
+                                                        original_entry.short_name or call_data["short_name"])
+        archive_urls = {"wav": wav_url, "m4a": m4a_url, "json": json_url}
+
+    if archive_urls.get("m4a"):
+        call_data["audio_m4a_url"] = archive_urls["m4a"]
+    if archive_urls.get("wav"):
+        call_data["audio_wav_url"] = archive_urls["wav"]
+    call_data["audio_url"] = call_data.get("audio_m4a_url") or call_data.get("audio_wav_url")
+
+    json_url = archive_call_metadata(config_data.archive, wav_file_name, call_data, call_data["short_name"],
+                                     config_data.temp_file_path, deadline.stage("archive"), config_data.bandwidth)
+    if not json_url:
+        raise RuntimeError(f"Unable to archive the simulcast link from {wav_file_name} to {original_entry.wav_path}.")
+
+    call_data["completed_stages"] = ["archive"]
+    module_logger.info(f"<<Simulcast>> Linked duplicate of {original_entry.wav_path} to {call_data['audio_url']}, metadata at {json_url}")
+    return call_data
+
+
+def rdio_system_stage(rdio_url):
+    """The stage recorded once the RDIO system at rdio_url has accepted a call, before the whole rdio stage is done."""
+    return f"rdio:{rdio_url}"
+
+
+def resume_stages(wav_path, stages):
+    """stages in CALL_STAGES order, with encode put back when archive needs an m4a that is no longer next to the WAV."""
+    stages = [stage for stage in CALL_STAGES if stage in stages]
+    if "archive" in stages and "encode" not in stages and not os.path.isfile(wav_path[:-len(".wav")] + ".m4a"):
+        stages.insert(0, "encode")
+    return stages
+
+
+def call_archive_urls(call_data):
+    """The archived audio URLs in processed call data, as the "archive_urls" process_call accepts."""
+    archive_urls = {}
+    if call_data.get("audio_wav_url"):
+        archive_urls["wav"] = call_data["audio_wav_url"]
+    if call_data.get("audio_m4a_url"):
+        archive_urls["m4a"] = call_data["audio_m4a_url"]
+    return archive_urls
+
+
+def process_call(initial_call_data: dict , config_data: AppConfig, deadline: CallDeadline = None, stages=None,
+                 stage_completed=None):
+    """
+    Encode, archive and post a single call.
+
+    :param initial_call_data: Dict with the system "short_name" and "audio_wav_path". May also hold
+                              "archive_urls" (dict of "wav"/"m4a"/"json" -> URL) from an earlier run,
+                              used when the archive stage is skipped, and "completed_stages" from an
+                              earlier run, whose rdio_system_stage entries skip RDIO systems that already
+                              accepted the call.
+    :param config_data: AppConfig snapshot to use for the whole call. The call's system overrides are applied to it.
+    :param deadline: Optional CallDeadline. Built from config "call_deadline" when not given.
+    :param stages: Optional iterable of stages to run, from CALL_STAGES. Defaults to all of them.
+    :param stage_completed: Optional callable(stage, call_data) called as each stage finishes, before the
+                            next one starts, so progress can be recorded. It is also called with the
+                            rdio_system_stage of each RDIO system that accepts the call. An exception from
+                            it stops the call.
+    :return: The call data with archive URLs and "completed_stages" added, or None if the call JSON could not be loaded.
+             When archive uploads failed in a way worth retrying, "retry_stages" lists the stages to run again,
+             archive and the rdio post that waits for it. Retrying is left to the caller, so no worker waits
+             out a backoff.
+             A call suppressed as a simulcast duplicate has "simulcast_duplicate_of" set, and "archive" as its
+             only completed stage if its link was archived.
+    :raises DeadlineExceededError: If the call budget runs out before encoding finishes or before archiving starts.
+    :raises RuntimeError: If a linked simulcast duplicate's metadata could not be archived.
+    """
+    stages = set(stages) if stages is not None else set(CALL_STAGES)
+    completed_stages = []
+    retry_stages = []
+
+    # Compression, archive and RDIO targets can differ per system.
+    config_data = config_data.for_system(initial_call_data["short_name"])
+
+    if deadline is None:
+        deadline = CallDeadline.from_config(config_data.call_deadline)
 
     # Get file paths WAV, JSON, M4A
     wav_file_path = initial_call_data["audio_wav_path"]
@@ -29,17 +133,66 @@ def process_call(initial_call_data: dict , config_data: dict):
     # Add Shortname to call data
     call_data["short_name"] = initial_call_data["short_name"]
 
-    # Convert WAV to M4A with FFMPEG
-    try:
-        compress_wav_to_m4a(wav_file_path, m4a_file_path, config_data.get("m4a_audio_compression"))
-    except (FileNotFoundError, EnvironmentError, subprocess.CalledProcessError, RuntimeError, Exception) as e:
-        raise
-
-    # Archive File to Webserver
-    wav_url, m4a_url, json_url = archive_files(config_data.get("archive", {}),
-                                                        source_path,
-                                                        wav_file_name,
-                                                        call_data, call_data["short_name"])
+    # Drop the same transmission recorded by another site before spending any work on it.
+    simulcast_entry = None
+    if config_data.simulcast_dedup.enabled:
+        simulcast_entry, original_entry = simulcast_index.check_and_add(config_data.simulcast_dedup, call_data,
+                                                                        wav_file_path)
+        if simulcast_entry is None:
+            return _simulcast_duplicate(call_data, original_entry, config_data, wav_file_name, deadline)
+        if original_entry is not None:
+            module_logger.warning(f"<<Simulcast>> {wav_file_name} has a better signal than {original_entry.wav_path}, "
+                                  f"which was already processed. Processing both.")
+
+    # Encode and archive from a tmpfs working copy when staging is enabled and there is budget for it.
+    # Archive-only reprocessing just reads the files once, so it works from the originals.
+    staging_area = StagingArea(config_data.staging, config_data.temp_file_path)
+    if "encode" in stages:
+        working_context = staging_area.stage_call(wav_file_path, json_file_path, deadline.remaining())
+    else:
+        working_context = nullcontext(source_path)
+
+    with working_context as working_path:
+        working_wav_file_path = os.path.join(working_path, wav_file_name)
+        working_m4a_file_path = os.path.join(working_path, os.path.basename(m4a_file_path))
+
+        # Convert WAV to M4A with FFMPEG
+        if "encode" in stages:
+            try:
+                encoder = get_encoder(config_data.m4a_audio_compression.encoder)
+                encoder.encode(working_wav_file_path, working_m4a_file_path, config_data.m4a_audio_compression,
+                               deadline.stage("encode"))
+                completed_stages.append("encode")
+                if stage_completed is not None:
+                    stage_completed("encode", call_data)
+            except (FileNotFoundError, EnvironmentError, subprocess.CalledProcessError, RuntimeError, Exception) as e:
+                raise
+
+        # Archive File to Webserver
+        if "archive" in stages:
+            wav_url, m4a_url, json_url, retry_extensions = archive_files(config_data.archive,
+                                                                working_path,
+                                                                wav_file_name,
+                                                                call_data, call_data["short_name"],
+                                                                deadline.stage("archive"),
+                                                                config_data.bandwidth,
+                                                                config_data.m4a_audio_compression.enabled)
+            if retry_extensions:
+                # Posted once the retry has the URLs, so listeners don't get a call with audio missing.
+                retry_stages = [stage for stage in ("archive", "rdio") if stage in stages]
+                module_logger.warning(f"Archive of {' '.join(retry_extensions)} failed, leaving {', '.join(retry_stages)} for a retry.")
+            elif wav_url or m4a_url or json_url:
+                completed_stages.append("archive")
+        elif initial_call_data.get("archive_urls"):
+            archive_urls = initial_call_data["archive_urls"]
+            wav_url, m4a_url, json_url = archive_urls.get("wav"), archive_urls.get("m4a"), archive_urls.get("json")
+        else:
+            wav_url, m4a_url, json_url = archived_file_urls(config_data.archive, wav_file_name,
+                                                            call_data, call_data["short_name"])
+
+    if simulcast_entry is not None:
+        simulcast_entry.archive_urls = {"wav": wav_url, "m4a": m4a_url, "json": json_url}
+
     if m4a_url:
         call_data["audio_m4a_url"] = m4a_url
         call_data["audio_url"] = m4a_url
@@ -48,8 +201,15 @@ def process_call(initial_call_data: dict , config_data: dict):
         if not call_data.get("audio_url"):
             call_data["audio_url"] = wav_url
 
+    if "archive" in completed_stages and stage_completed is not None:
+        stage_completed("archive", call_data)
+
 
-    if wav_url is None and m4a_url is None and json_url is None:
+    if "archive" not in stages:
+        module_logger.debug(f"Archive skipped, using existing archive URLs.")
+    elif retry_stages:
+        module_logger.debug(f"Archive incomplete, retry pending.")
+    elif wav_url is None and m4a_url is None and json_url is None:
         module_logger.error("No Files Uploaded to Archive")
     else:
         module_logger.info(f"Archive Complete")
@@ -58,11 +218,35 @@ def process_call(initial_call_data: dict , config_data: dict):
 
 
     # Upload to RDIO as remote file.
-    for rdio in config_data.get("rdio_systems", []):
-        if rdio.get("enabled"):
+    if "rdio" in stages and "rdio" not in retry_stages:
+        rdio_deadline = deadline.stage("rdio")
+        rdio_failed = False
+        call_payload = RdioCallPayload(call_data)
+        previous_stages = set(initial_call_data.get("completed_stages", []))
+        for rdio in config_data.enabled_rdio_systems:
+            system_stage = rdio_system_stage(rdio.rdio_url)
+            if system_stage in previous_stages:
+                module_logger.debug(f"RDIO {rdio.rdio_url} already accepted this call, skipping.")
+                continue
             try:
-                upload_trunk_recorder_call(rdio, call_data)
+                bandwidth_limiters = upload_limiters(config_data.bandwidth, f"rdio:{rdio.rdio_url}", rdio.max_upload_kbps)
+                upload_trunk_recorder_call(rdio, call_payload, rdio_deadline.timeout(), bandwidth_limiters)
+                completed_stages.append(system_stage)
+                if stage_completed is not None:
+                    stage_completed(system_stage, call_data)
             except TrunkRecorderUploadError as e:
+                rdio_failed = True
                 module_logger.error(f"RDIO Upload failed: {e}")
+            except DeadlineExceededError as e:
+                rdio_failed = True
+                module_logger.error(f"RDIO Upload skipped for {rdio.rdio_url}: {e}")
+        if not rdio_failed:
+            completed_stages.append("rdio")
+            if stage_completed is not None:
+                stage_completed("rdio", call_data)
 
-    # End Processing
\ No newline at end of file
+    # End Processing
+    call_data["completed_stages"] = completed_stages
+    if retry_stages:
+        call_data["retry_stages"] = retry_stages
+    return call_data
\ No newline at end of file
@@ -1,14 +1,51 @@
+import copy
+import dataclasses
 import json
 import logging
+import os
+import threading
 import traceback
+from dataclasses import dataclass, field
+from typing import Optional, Tuple, Union, get_args, get_origin
 
 module_logger = logging.getLogger('tr_rdio_uploader.config')
 
 default_config = {
     "log_level": 1,
     "temp_file_path": "/dev/shm",
+    "staging": {
+        "enabled": True,
+        "memory_budget_mb": 256,
+        "max_wait_seconds": 5,
+        "keep_m4a": True
+    },
+    "call_deadline": {
+        "enabled": True,
+        "total_seconds": 300,
+        "stage_shares": {
+            "encode": 2,
+            "archive": 2,
+            "rdio": 1
+        }
+    },
     "m4a_audio_compression": {
         "enabled": True,
+        "encoder": "ffmpeg",
+        "batch": {
+            "enabled": False,
+            "window_ms": 250,
+            "max_batch_size": 16
+        },
+        "resources": {
+            "cpu_affinity": [],
+            "threads": 0,
+            "nice": 0,
+            "ionice_class": "",
+            "ionice_level": 4,
+            "max_concurrent": 0,
+            "slot_path": "var/encode_slots",
+            "metrics_interval_seconds": 300
+        },
         "sample_rate": 16000,
         "bitrate": 96,
         "normalization": True,
@@ -20,22 +57,75 @@ default_config = {
             "linear": "true"
         }
     },
+    "watch": {
+        "capture_paths": [],
+        "workers": 2,
+        "scan_on_startup": True,
+        "scan_max_age_hours": 24,
+        "ledger_path": "var/watch_processed.log",
+        "system_weights": {}
+    },
+    "distributed": {
+        "enabled": False,
+        "backend": "sqlite",
+        "queue_path": "var/work_queue.db",
+        "node_name": "",
+        "lease_seconds": 300,
+        "max_attempts": 3,
+        "retain_done_hours": 48
+    },
+    "bandwidth": {
+        "uplink_max_kbps": 0,
+        "bulk_share": 0.5
+    },
+    "simulcast_dedup": {
+        "enabled": False,
+        "ttl_seconds": 120,
+        "start_time_window_seconds": 3,
+        "max_bit_error_rate": 0.25,
+        "action": "drop",
+        "keep": "first"
+    },
+    "backfill": {
+        "workers": 4,
+        "checkpoint_path": "var/backfill_checkpoint.jsonl",
+        "rate_limits": {
+            "encode": 0,
+            "archive": 10,
+            "rdio": 5
+        }
+    },
     "archive": {
         "enabled": 0,
         "archive_type": "scp",
         "archive_path": "",
         "archive_days": 0,
         "archive_extensions": [".wav", ".m4a", ".json"],
+        "max_attempts": 3,
+        "retry_delay": 5,
+        "skip_if_present": False,
+        "hash_index_path": "var/archive_hash_index.sqlite",
+        "metadata_mode": "file",
+        "metadata_segments": {
+            "spool_path": "var/metadata_spool",
+            "compress": True,
+            "max_segment_bytes": 1048576,
+            "max_segment_age_seconds": 900
+        },
         "google_cloud": {
             "project_id": "",
             "bucket_name": "",
-            "credentials_file": ""
+            "credentials_file": "",
+            "timeout": 60,
+            "max_upload_kbps": 0
         },
         "aws_s3": {
             "access_key_id": "",
             "secret_access_key": "",
             "bucket_name": "",
-            "region": ""
+            "region": "",
+            "timeout": 60,
+            "max_upload_kbps": 0
         },
         "scp": {
             "host": "",
@@ -43,13 +133,38 @@ default_config = {
             "user": "",
             "password": "",
             "private_key_path": "",
-            "base_url": "https://example.com/audio"
+            "base_url": "https://example.com/audio",
+            "timeout": 60,
+            "max_upload_kbps": 0
         },
         "local": {
             "base_url": "https://example.com/audio",
-            "local_path": "/srv/audio_files"
+            "local_path": "/srv/audio_files",
+            "server": {
+                "bind_address": "0.0.0.0",
+                "port": 8080,
+                "fd_cache_size": 256,
+                "cache_max_age_seconds": 86400,
+                "request_timeout": 30
+            }
         }
-    }
+    },
+    "rdio_systems": [],
+    "system_overrides": {}
+}
+
+# Sections a system_overrides entry may replace for its short_name.
+SYSTEM_OVERRIDE_SECTIONS = ("call_deadline", "m4a_audio_compression", "archive", "rdio_systems")
+
+# Defaults for each entry of rdio_systems.
+default_rdio_system = {
+    "enabled": True,
+    "system_id": None,
+    "rdio_url": "",
+    "rdio_api_key": "",
+    "timeout": 30,
+    "max_upload_kbps": 0,
+    "meta_fields": None
 }
 
 
@@ -57,7 +172,7 @@ def generate_default_config():
     try:
 
         global default_config
-        default_data = default_config.copy()
+        default_data = copy.deepcopy(default_config)
 
         return default_data
 
@@ -67,9 +182,11 @@ def generate_default_config():
         return None
 
 
-def load_config_file(file_path):
+def load_config_file(file_path, create_default=True):
     """
     Loads the configuration file and encryption key.
+
+    :param create_default: Write a default config if the file is missing. Otherwise a missing file returns None.
     """
 
     # Attempt to load the configuration file
@@ -77,6 +194,9 @@ def load_config_file(file_path):
         with open(file_path, 'r') as f:
             config_data = json.load(f)
     except FileNotFoundError:
+        if not create_default:
+            module_logger.error(f'Configuration file {file_path} not found.')
+            return None
         module_logger.warning(f'Configuration file {file_path} not found. Creating default.')
         config_data = generate_default_config()
         if config_data:
@@ -103,3 +223,485 @@ def save_config_file(file_path, default_data):
         module_logger.error(f'Unexpected Exception Saving file {file_path} - {e}')
         return None
 
+
+
+class ConfigValidationError(Exception):
+    """Raised when the configuration does not match the expected schema."""
+    pass
+
+
+@dataclass(frozen=True)
+class CallDeadlineConfig:
+    enabled: bool
+    total_seconds: float
+    stage_shares: Tuple[Tuple[str, float], ...]
+
+
+@dataclass(frozen=True)
+class StagingConfig:
+    enabled: bool
+    memory_budget_mb: float
+    max_wait_seconds: float
+    keep_m4a: bool
+
+
+@dataclass(frozen=True)
+class BatchEncodeConfig:
+    enabled: bool
+    window_ms: float
+    max_batch_size: int
+
+
+@dataclass(frozen=True)
+class EncodeResourceConfig:
+    cpu_affinity: Tuple[int, ...]
+    threads: int
+    nice: int
+    ionice_class: str
+    ionice_level: int
+    max_concurrent: int
+    slot_path: str
+    metrics_interval_seconds: float
+
+
+@dataclass(frozen=True)
+class CompressionConfig:
+    enabled: bool
+    encoder: str
+    batch: BatchEncodeConfig
+    resources: EncodeResourceConfig
+    sample_rate: int
+    bitrate: int
+    normalization: bool
+    use_loudnorm: bool
+    loudnorm_params: Tuple[Tuple[str, Union[float, str]], ...]
+
+    # Derived once at load so the encoder doesn't rebuild them per call.
+    two_pass_loudnorm: bool = field(init=False)
+    loudnorm_first_pass_filter: str = field(init=False)
+    loudnorm_second_pass_params: str = field(init=False)
+
+    def __post_init__(self):
+        loudnorm_params = dict(self.loudnorm_params)
+        for k, v in {"I": -16.0, "TP": -1.5, "LRA": 11.0}.items():
+            loudnorm_params.setdefault(k, v)
+
+        first_pass_filter_parts = [f"{k}={v}" for k, v in loudnorm_params.items()]
+        second_pass_filter_parts = [f"{k}={v}" for k, v in loudnorm_params.items() if k.lower() != "print_format"]
+
+        object.__setattr__(self, "two_pass_loudnorm", self.normalization and self.use_loudnorm)
+        object.__setattr__(self, "loudnorm_first_pass_filter",
+                           "loudnorm=" + ":".join(first_pass_filter_parts) + ":print_format=json")
+        object.__setattr__(self, "loudnorm_second_pass_params", ":".join(second_pass_filter_parts))
+
+
+@dataclass(frozen=True)
+class WatchConfig:
+    capture_paths: Tuple[str, ...]
+    workers: int
+    scan_on_startup: bool
+    scan_max_age_hours: float
+    ledger_path: str
+    system_weights: Tuple[Tuple[str, float], ...]
+
+
+@dataclass(frozen=True)
+class DistributedConfig:
+    enabled: bool
+    backend: str
+    queue_path: str
+    node_name: str
+    lease_seconds: float
+    max_attempts: int
+    retain_done_hours: float
+
+
+@dataclass(frozen=True)
+class BandwidthConfig:
+    uplink_max_kbps: float
+    bulk_share: float
+
+
+@dataclass(frozen=True)
+class SimulcastDedupConfig:
+    enabled: bool
+    ttl_seconds: float
+    start_time_window_seconds: float
+    max_bit_error_rate: float
+    action: str
+    keep: str
+
+
+@dataclass(frozen=True)
+class BackfillConfig:
+    workers: int
+    checkpoint_path: str
+    rate_limits: Tuple[Tuple[str, float], ...]
+
+
+@dataclass(frozen=True)
+class GoogleCloudConfig:
+    project_id: str
+    bucket_name: str
+    credentials_file: str
+    timeout: float
+    max_upload_kbps: float
+
+
+@dataclass(frozen=True)
+class AWSS3Config:
+    access_key_id: str
+    secret_access_key: str
+    bucket_name: str
+    region: str
+    timeout: float
+    max_upload_kbps: float
+
+
+@dataclass(frozen=True)
+class SCPConfig:
+    host: str
+    port: int
+    user: str
+    password: str
+    private_key_path: str
+    base_url: str
+    timeout: float
+    max_upload_kbps: float
+
+
+@dataclass(frozen=True)
+class LocalServerConfig:
+    bind_address: str
+    port: int
+    fd_cache_size: int
+    cache_max_age_seconds: float
+    request_timeout: float
+
+
+@dataclass(frozen=True)
+class LocalConfig:
+    base_url: str
+    local_path: str
+    server: LocalServerConfig
+
+
+@dataclass(frozen=True)
+class MetadataSegmentConfig:
+    spool_path: str
+    compress: bool
+    max_segment_bytes: int
+    max_segment_age_seconds: float
+
+
+@dataclass(frozen=True)
+class ArchiveConfig:
+    enabled: bool
+    archive_type: str
+    archive_path: str
+    archive_days: int
+    archive_extensions: Tuple[str, ...]
+    max_attempts: int
+    retry_delay: float
+    skip_if_present: bool
+    hash_index_path: str
+    metadata_mode: str
+    metadata_segments: MetadataSegmentConfig
+    google_cloud: GoogleCloudConfig
+    aws_s3: AWSS3Config
+    scp: SCPConfig
+    local: LocalConfig
+
+
+@dataclass(frozen=True)
+class RdioSystemConfig:
+    enabled: bool
+    system_id: Optional[int]
+    rdio_url: str
+    rdio_api_key: str
+    timeout: float
+    max_upload_kbps: float
+    # Call JSON fields sent as meta. None sends RDIO_META_FIELDS, the list ["*"] the whole call.
+    meta_fields: Optional[Tuple[str, ...]]
+
+
+@dataclass(frozen=True)
+class AppConfig:
+    log_level: int
+    temp_file_path: str
+    staging: StagingConfig
+    call_deadline: CallDeadlineConfig
+    m4a_audio_compression: CompressionConfig
+    watch: WatchConfig
+    distributed: DistributedConfig
+    bandwidth: BandwidthConfig
+    simulcast_dedup: SimulcastDedupConfig
+    backfill: BackfillConfig
+    archive: ArchiveConfig
+    rdio_systems: Tuple[RdioSystemConfig, ...]
+
+    # Derived once at load so the RDIO stage doesn't filter the list per call.
+    enabled_rdio_systems: Tuple[RdioSystemConfig, ...] = field(init=False)
+    # short_name -> AppConfig with that system's overrides applied. Filled in by build_config.
+    system_configs: dict = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "enabled_rdio_systems", tuple(rdio for rdio in self.rdio_systems if rdio.enabled))
+        object.__setattr__(self, "system_configs", {})
+
+    def for_system(self, short_name):
+        """Config for calls from short_name: this config with the system's overrides applied, if it has any."""
+        return self.system_configs.get(short_name, self)
+
+
+def _merge_defaults(defaults, data):
+    """Deep merge data over defaults. Lists and scalars in data replace the default outright."""
+    merged = copy.deepcopy(defaults)
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge_defaults(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+
+def _coerce_value(expected_type, value, path):
+    """Check value against expected_type, converting JSON lists/objects to immutable tuples."""
+    origin = get_origin(expected_type)
+
+    if origin is Union:
+        options = get_args(expected_type)
+        if value is None and type(None) in options:
+            return None
+        errors = []
+        for option in options:
+            if option is type(None):
+                continue
+            try:
+                return _coerce_value(option, value, path)
+            except ConfigValidationError as e:
+                errors.append(str(e))
+        raise ConfigValidationError(errors[0] if errors else f"{path} has an invalid value {value!r}")
+
+    if origin is tuple:
+        item_type = get_args(expected_type)[0]
+        # Objects are stored as tuples of (key, value) pairs.
+        if get_origin(item_type) is tuple and isinstance(value, dict):
+            key_type, value_type = get_args(item_type)
+            return tuple((_coerce_value(key_type, k, f"{path}.{k}"), _coerce_value(value_type, v, f"{path}.{k}"))
+                         for k, v in value.items())
+        if not isinstance(value, list):
+            raise ConfigValidationError(f"{path} must be a list.")
+        return tuple(_coerce_value(item_type, item, f"{path}[{index}]") for index, item in enumerate(value))
+
+    if dataclasses.is_dataclass(expected_type):
+        return _build_section(expected_type, value, path)
+
+    if expected_type is bool:
+        # Older configs use 0/1 for switches.
+        if isinstance(value, bool) or value in (0, 1):
+            return bool(value)
+        raise ConfigValidationError(f"{path} must be true or false, got {value!r}.")
+
+    if expected_type is int:
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+        # Older configs quote some ids, e.g. "system_id": "1", which used to be passed along as-is.
+        if isinstance(value, str) and value.strip().lstrip("-").isdigit():
+            module_logger.warning(f"{path} should be a number, not a string. Using {int(value)}.")
+            return int(value)
+        raise ConfigValidationError(f"{path} must be an integer, got {value!r}.")
+
+    if expected_type is float:
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return float(value)
+        raise ConfigValidationError(f"{path} must be a number, got {value!r}.")
+
+    if expected_type is str:
+        if isinstance(value, str):
+            return value
+        raise ConfigValidationError(f"{path} must be a string, got {value!r}.")
+
+    raise ConfigValidationError(f"{path} has unsupported type {expected_type}.")
+
+
+def _build_section(section_class, section_data, path):
+    """Validate a config object against section_class's fields and build it."""
+    if not isinstance(section_data, dict):
+        raise ConfigValidationError(f"{path} must be an object.")
+
+    values = {}
+    known_keys = set()
+    for section_field in dataclasses.fields(section_class):
+        if not section_field.init:
+            continue
+        known_keys.add(section_field.name)
+        if section_field.name not in section_data:
+            raise ConfigValidationError(f"{path}.{section_field.name} is required.")
+        values[section_field.name] = _coerce_value(section_field.type, section_data[section_field.name],
+                                                   f"{path}.{section_field.name}")
+
+    unknown_keys = set(section_data) - known_keys
+    if unknown_keys:
+        module_logger.warning(f"Ignoring unknown config keys in {path}: {', '.join(sorted(unknown_keys))}")
+
+    return section_class(**values)
+
+
+def build_config(config_data):
+    """
+    Validate a raw configuration dict and build the immutable AppConfig used by the call stages.
+    Missing keys are filled from default_config.
+
+    :raises ConfigValidationError: If a value is missing or has the wrong type.
+    """
+    if not isinstance(config_data, dict):
+        raise ConfigValidationError("Configuration must be a JSON object.")
+
+    merged_data = _merge_defaults(default_config, config_data)
+    system_overrides = merged_data.pop("system_overrides")
+    if not isinstance(system_overrides, dict):
+        raise ConfigValidationError("config.system_overrides must be an object.")
+
+    app_config = _build_app_config(merged_data, "config")
+
+    for short_name, override_data in system_overrides.items():
+        path = f"config.system_overrides.{short_name}"
+        if not isinstance(override_data, dict):
+            raise ConfigValidationError(f"{path} must be an object.")
+        unknown_sections = set(override_data) - set(SYSTEM_OVERRIDE_SECTIONS)
+        if unknown_sections:
+            raise ConfigValidationError(f"{path} can only override {', '.join(SYSTEM_OVERRIDE_SECTIONS)}, "
+                                        f"not {', '.join(sorted(unknown_sections))}.")
+        app_config.system_configs[short_name] = _build_app_config(_merge_defaults(merged_data, override_data), path)
+
+    return app_config
+
+
+def _build_app_config(merged_data, path):
+    """Build and cross-check one AppConfig from a config dict already merged over the defaults."""
+    rdio_systems = merged_data.get("rdio_systems")
+    if not isinstance(rdio_systems, list):
+        raise ConfigValidationError(f"{path}.rdio_systems must be a list.")
+    merged_data = dict(merged_data, rdio_systems=[_merge_defaults(default_rdio_system, rdio) if isinstance(rdio, dict) else rdio
+                                                  for rdio in rdio_systems])
+
+    app_config = _build_section(AppConfig, merged_data, path)
+
+    if not 0 < app_config.bandwidth.bulk_share <= 1:
+        raise ConfigValidationError(f"{path}.bandwidth.bulk_share must be greater than 0 and at most 1.")
+    if app_config.m4a_audio_compression.encoder not in ("ffmpeg", "pyav"):
+        raise ConfigValidationError(f"{path}.m4a_audio_compression.encoder must be \"ffmpeg\" or \"pyav\".")
+    encode_resources = app_config.m4a_audio_compression.resources
+    if encode_resources.ionice_class not in ("", "best-effort", "idle"):
+        raise ConfigValidationError(f"{path}.m4a_audio_compression.resources.ionice_class must be \"\", \"best-effort\" or \"idle\".")
+    if not 0 <= encode_resources.nice <= 19:
+        raise ConfigValidationError(f"{path}.m4a_audio_compression.resources.nice must be from 0 to 19.")
+    if not 0 <= encode_resources.ionice_level <= 7:
+        raise ConfigValidationError(f"{path}.m4a_audio_compression.resources.ionice_level must be from 0 to 7.")
+    if any(cpu < 0 for cpu in encode_resources.cpu_affinity):
+        raise ConfigValidationError(f"{path}.m4a_audio_compression.resources.cpu_affinity must list CPU numbers.")
+    if app_config.archive.metadata_mode not in ("file", "segments"):
+        raise ConfigValidationError(f"{path}.archive.metadata_mode must be \"file\" or \"segments\".")
+    if app_config.simulcast_dedup.action not in ("drop", "link"):
+        raise ConfigValidationError(f"{path}.simulcast_dedup.action must be \"drop\" or \"link\".")
+    if (app_config.simulcast_dedup.enabled and app_config.simulcast_dedup.action == "link"
+            and ".json" not in app_config.archive.archive_extensions):
+        raise ConfigValidationError(f"{path}.simulcast_dedup.action \"link\" archives the duplicate's metadata, "
+                                    f"so {path}.archive.archive_extensions must include \".json\".")
+    if app_config.simulcast_dedup.keep not in ("first", "best_signal"):
+        raise ConfigValidationError(f"{path}.simulcast_dedup.keep must be \"first\" or \"best_signal\".")
+    if app_config.distributed.backend not in ("sqlite", "memory"):
+        raise ConfigValidationError(f"{path}.distributed.backend must be \"sqlite\" or \"memory\".")
+    if app_config.distributed.lease_seconds <= 0:
+        raise ConfigValidationError(f"{path}.distributed.lease_seconds must be greater than 0.")
+    for short_name, weight in app_config.watch.system_weights:
+        if weight <= 0:
+            raise ConfigValidationError(f"{path}.watch.system_weights.{short_name} must be greater than 0.")
+
+    for index, rdio in enumerate(app_config.enabled_rdio_systems):
+        if not rdio.rdio_url or not rdio.rdio_api_key:
+            raise ConfigValidationError(f"{path}.rdio_systems[{index}] is enabled but has no rdio_url or rdio_api_key.")
+
+    return app_config
+
+
+class ConfigManager:
+    """
+    Holds the current AppConfig and swaps in a new one when the config file changes.
+
+    Callers read `current` once per call and use that snapshot for the whole call, so a reload
+    never changes settings under a call in progress and queued work is untouched. A changed file
+    that fails validation is logged and the previous config stays in effect.
+
+    :param file_path: Path of the JSON config file.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._file_signature = None
+        self._stop_event = threading.Event()
+        self.current = self._load()
+        if self.current is None:
+            raise ConfigValidationError(f"Unable to load configuration from {file_path}.")
+
+    def _signature(self):
+        try:
+            file_stat = os.stat(self.file_path)
+            return file_stat.st_mtime_ns, file_stat.st_size
+        except FileNotFoundError:
+            return None
+
+    def _load(self, create_default=True):
+        signature = self._signature()
+        config_data = load_config_file(self.file_path, create_default)
+        if config_data is None:
+            return None
+
+        app_config = build_config(config_data)
+        # The file was missing and load_config_file just wrote the defaults.
+        self._file_signature = signature if signature is not None else self._signature()
+        return app_config
+
+    def reload_if_changed(self):
+        """
+        Reload the config file if it changed since the last load. Returns True if a new config was swapped in.
+
+        A missing, unreadable or invalid file keeps the current config. Its signature is still
+        recorded, so the same bad edit is logged once rather than on every check.
+        """
+        signature = self._signature()
+        if signature == self._file_signature:
+            return False
+
+        try:
+            # Never write defaults over a config that is in use, e.g. while an editor replaces the file.
+            app_config = self._load(create_default=False)
+        except ConfigValidationError as e:
+            module_logger.error(f"Configuration file {self.file_path} changed but is invalid, keeping current config: {e}")
+            self._file_signature = signature
+            return False
+
+        if app_config is None:
+            module_logger.error(f"Configuration file {self.file_path} changed but could not be loaded, keeping current config.")
+            self._file_signature = signature
+            return False
+
+        if app_config.log_level != self.current.log_level:
+            module_logger.warning("log_level changes take effect after a restart.")
+
+        # A single reference assignment, so readers see either the old or the new config, never a mix.
+        self.current = app_config
+        module_logger.info(f"Reloaded configuration from {self.file_path}")
+        return True
+
+    def start_watching(self, interval_seconds=2):
+        """Check the config file for changes every interval_seconds on a background thread."""
+        def watch_config_file():
+            while not self._stop_event.wait(interval_seconds):
+                self.reload_if_changed()
+
+        threading.Thread(target=watch_config_file, name="ConfigWatcher", daemon=True).start()
+
+    def stop_watching(self):
+        self._stop_event.set()
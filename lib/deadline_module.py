@@ -0,0 +1,171 @@
+import logging
+import time
+
+module_logger = logging.getLogger('tr_rdio_uploader.deadline')
+
+
+class DeadlineExceededError(Exception):
+    """Raised when a call or one of its stages runs out of time budget."""
+    pass
+
+
+class NonRetryableError(Exception):
+    """Raised by a task when another attempt would fail the same way, e.g. a missing file or a config error."""
+    pass
+
+
+class CallDeadline:
+    """
+    Time budget for processing a single call, split across the processing stages.
+
+    Each stage is allotted a share of whatever budget is still remaining when it starts,
+    so time a fast stage does not use is carried forward to the stages after it.
+
+    :param total_seconds: Total budget for the call. None or 0 disables the deadline.
+    :param stage_shares: Ordered dict (or pairs) of stage name -> relative share of the budget.
+    """
+
+    def __init__(self, total_seconds=None, stage_shares=None):
+        self.total_seconds = total_seconds if total_seconds else None
+        self.stage_shares = dict(stage_shares or ())
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + self.total_seconds if self.total_seconds else None
+
+    @classmethod
+    def from_config(cls, deadline_config):
+        """Build from a CallDeadlineConfig."""
+        if not deadline_config.enabled:
+            return cls()
+        return cls(deadline_config.total_seconds, deadline_config.stage_shares)
+
+    def remaining(self):
+        """Seconds left in the call budget, or None if there is no deadline."""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def check(self, stage_name):
+        """Raise DeadlineExceededError if the call budget is used up before a stage starts."""
+        if self.expired():
+            raise DeadlineExceededError(f"Call deadline of {self.total_seconds}s exceeded before <<{stage_name}>> stage.")
+
+    def stage_timeout(self, stage_name):
+        """
+        Seconds allotted to a stage starting now, or None if there is no deadline.
+
+        The remaining budget is divided between this stage and the stages configured after it
+        in proportion to their shares.
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return None
+
+        stage_names = list(self.stage_shares.keys())
+        if stage_name not in stage_names:
+            return remaining
+
+        following_shares = [self.stage_shares[name] for name in stage_names[stage_names.index(stage_name):]]
+        total_share = sum(following_shares)
+        if total_share <= 0:
+            return remaining
+
+        return remaining * (self.stage_shares[stage_name] / total_share)
+
+    def stage(self, stage_name):
+        """Check the call budget and return a StageDeadline for the stage starting now."""
+        self.check(stage_name)
+        return StageDeadline(stage_name, self.stage_timeout(stage_name))
+
+
+class StageDeadline:
+    """Time budget for a single stage. Operations inside a stage ask it for their timeout."""
+
+    def __init__(self, stage_name, timeout_seconds=None):
+        self.stage_name = stage_name
+        self.timeout_seconds = timeout_seconds
+        self.expires_at = time.monotonic() + timeout_seconds if timeout_seconds is not None else None
+
+    def remaining(self):
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def timeout(self, cap=None):
+        """
+        Timeout for the next blocking operation in this stage.
+
+        :param cap: Optional upper bound used when the stage itself has no deadline.
+        :raises DeadlineExceededError: If the stage budget is already used up.
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return cap
+        if remaining <= 0:
+            raise DeadlineExceededError(f"<<{self.stage_name}>> stage exceeded its {self.timeout_seconds:.1f}s budget.")
+        return min(remaining, cap) if cap is not None else remaining
+
+
+class RetryScheduler:
+    """
+    Runs a set of tasks one attempt each and sorts out the failures worth another attempt.
+
+    Nothing here waits for a backoff. The caller re-queues the call, or just the failed stage,
+    after retry_delay_after(attempt), so the worker thread is free to process other calls in
+    the meantime. A task that raises NonRetryableError, such as for a missing file, is not
+    offered for a retry.
+
+    :param stage_deadline: StageDeadline bounding the run. Tasks it leaves no time for are retried.
+    :param max_attempts: Attempts before giving up.
+    :param retry_delay: Base delay before the second attempt, doubled on each later attempt.
+    """
+
+    def __init__(self, stage_deadline=None, max_attempts=3, retry_delay=5):
+        self.stage_deadline = stage_deadline or StageDeadline("retry")
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+    def run(self, tasks):
+        """
+        :param tasks: Dict of task key -> callable. A callable returns a truthy result on success.
+        :return: Tuple of (dict of task key -> result for the tasks that succeeded,
+                 list of the keys of failed tasks worth retrying).
+        """
+        results = {}
+        retry_keys = []
+
+        for key, task in tasks.items():
+            if self.stage_deadline.expired():
+                module_logger.warning(f"Stage deadline reached before {key}, leaving it for a retry.")
+                retry_keys.append(key)
+                continue
+
+            try:
+                result = task()
+            except NonRetryableError as e:
+                module_logger.error(f"{key} failed and will not be retried: {e}")
+                continue
+            except DeadlineExceededError as e:
+                module_logger.warning(f"{key} ran out of time, leaving it for a retry: {e}")
+                retry_keys.append(key)
+                continue
+
+            if result:
+                results[key] = result
+            else:
+                retry_keys.append(key)
+
+        return results, retry_keys
+
+    def retry_delay_after(self, attempt):
+        """Seconds to wait before the attempt after attempt, or None if attempt was the last one allowed."""
+        if attempt >= self.max_attempts:
+            return None
+        return self.retry_delay * (2 ** (attempt - 1))
@@ -0,0 +1,167 @@
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import threading
+
+from lib.audio_file_handler import loudnorm_second_pass_filter
+from lib.deadline_module import DeadlineExceededError
+from lib.encode_resources_module import run_ffmpeg
+
+module_logger = logging.getLogger('tr_rdio_uploader.encode_batch')
+
+# loudnorm prints its JSON summary after a "[Parsed_loudnorm_<n> @ 0x...]" line naming the filter instance.
+LOUDNORM_SUMMARY = re.compile(r"\[Parsed_loudnorm_(\d+) @ [^\]]+\]\s*(\{.*?\})", flags=re.DOTALL)
+
+
+class _EncodeRequest:
+    def __init__(self, input_wav, output_m4a, stage_deadline):
+        self.input_wav = input_wav
+        self.output_m4a = output_m4a
+        self.stage_deadline = stage_deadline
+        self.encoded = False
+        self.done = threading.Event()
+
+
+class _Batch:
+    def __init__(self):
+        self.requests = []
+        self.full = threading.Event()
+
+
+class FFmpegBatcher:
+    """
+    Collects encodes that arrive within batch.window_ms of each other and runs them through one
+    ffmpeg process with one input, filter chain and output per call. During bursts of short
+    calls this spreads the cost of starting ffmpeg across the burst.
+
+    The first call of a batch waits out the window (or until max_batch_size calls have joined)
+    and runs the batch. The calls that joined wait for it. If the batch fails, or one of its
+    outputs is missing, each affected call is encoded on its own with compress_wav_to_m4a.
+    Calls are only batched with others that use the same CompressionConfig.
+
+    A batch holds one encode slot per call, so resources.max_concurrent also caps the batch size.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def encode(self, input_wav, output_m4a, compression_config, stage_deadline, encode_single):
+        """
+        :param encode_single: Callable(input_wav, output_m4a, compression_config, stage_deadline)
+                              used when a call can't be batched or its batch fails.
+        """
+        batch_config = compression_config.batch
+        window_seconds = batch_config.window_ms / 1000
+        max_batch_size = batch_config.max_batch_size
+        if compression_config.resources.max_concurrent > 0:
+            max_batch_size = min(max_batch_size, compression_config.resources.max_concurrent)
+        remaining = stage_deadline.remaining() if stage_deadline is not None else None
+        if (not compression_config.enabled or max_batch_size < 2
+                or (remaining is not None and remaining <= window_seconds * 2)):
+            encode_single(input_wav, output_m4a, compression_config, stage_deadline)
+            return
+
+        request = _EncodeRequest(input_wav, output_m4a, stage_deadline)
+        with self._lock:
+            batch = self._pending.get(compression_config)
+            is_leader = batch is None
+            if is_leader:
+                batch = self._pending[compression_config] = _Batch()
+            batch.requests.append(request)
+            if len(batch.requests) >= max_batch_size:
+                self._pending.pop(compression_config, None)
+                batch.full.set()
+
+        if is_leader:
+            batch.full.wait(window_seconds)
+            with self._lock:
+                if self._pending.get(compression_config) is batch:
+                    del self._pending[compression_config]
+            self._run_batch(batch.requests, compression_config)
+        else:
+            request.done.wait()
+
+        if not request.encoded:
+            encode_single(input_wav, output_m4a, compression_config, stage_deadline)
+
+    def _run_batch(self, requests, compression_config):
+        """Encode requests in one ffmpeg run, marking each that produced its output. Always releases every waiter."""
+        try:
+            if len(requests) < 2 or shutil.which("ffmpeg") is None:
+                return
+
+            # A disabled call deadline has no remaining time, which means no timeout.
+            timeouts = [remaining for remaining in (request.stage_deadline.remaining() for request in requests
+                                                    if request.stage_deadline is not None)
+                        if remaining is not None]
+            timeout = min(timeouts) if timeouts else None
+
+            measured_filters = None
+            if compression_config.two_pass_loudnorm:
+                measured_filters = self._measure_loudness(requests, compression_config, timeout)
+
+            command = ["ffmpeg", "-hide_banner", "-y"]
+            for request in requests:
+                command += ["-i", request.input_wav]
+
+            if measured_filters:
+                command += ["-filter_complex", ";".join(f"[{index}:a]{audio_filter}[out{index}]"
+                                                        for index, audio_filter in enumerate(measured_filters))]
+            for index, request in enumerate(requests):
+                command += ["-map", f"[out{index}]" if measured_filters else f"{index}:a",
+                            "-ar", str(compression_config.sample_rate),
+                            "-c:a", "aac",
+                            "-b:a", f"{compression_config.bitrate}k",
+                            "-vn", "-sn",
+                            request.output_m4a]
+
+            run_ffmpeg(command, compression_config.resources, timeout, encodes=len(requests))
+
+            for request in requests:
+                request.encoded = os.path.isfile(request.output_m4a) and os.path.getsize(request.output_m4a) > 0
+
+            module_logger.info(f"Encoded a batch of {sum(request.encoded for request in requests)}/{len(requests)} calls in one ffmpeg run.")
+
+        except (subprocess.TimeoutExpired, DeadlineExceededError):
+            module_logger.warning(f"Batch of {len(requests)} calls timed out. Encoding them individually.")
+        except subprocess.CalledProcessError as e:
+            module_logger.warning(f"Batch of {len(requests)} calls failed, encoding them individually: {e.stderr}")
+        except (ValueError, KeyError) as e:
+            module_logger.warning(f"Batch loudness measurement unusable, encoding {len(requests)} calls individually: {e}")
+        finally:
+            for request in requests:
+                request.done.set()
+
+    @staticmethod
+    def _measure_loudness(requests, compression_config, timeout):
+        """
+        First loudnorm pass for every request in one ffmpeg run.
+
+        :return: The second-pass loudnorm filter for each request, in request order.
+        :raises ValueError: If a summary is missing, so the batch falls back to single encodes.
+        """
+        command = ["ffmpeg", "-hide_banner", "-y"]
+        for request in requests:
+            command += ["-i", request.input_wav]
+
+        first_pass_filter = compression_config.loudnorm_first_pass_filter
+        command += ["-filter_complex", ";".join(f"[{index}:a]{first_pass_filter}[measure{index}]"
+                                                for index in range(len(requests)))]
+        for index in range(len(requests)):
+            command += ["-map", f"[measure{index}]", "-f", "null", "-"]
+
+        measure_process = run_ffmpeg(command, compression_config.resources, timeout, encodes=len(requests))
+
+        # Filters are numbered in the order the chains appear, so instance n belongs to input n.
+        summaries = {int(instance): json.loads(summary) for instance, summary in LOUDNORM_SUMMARY.findall(measure_process.stderr)}
+        if len(summaries) != len(requests):
+            raise ValueError(f"found {len(summaries)} loudnorm summaries for {len(requests)} inputs")
+
+        return [loudnorm_second_pass_filter(compression_config, summaries[index]) for index in range(len(requests))]
+
+
+ffmpeg_batcher = FFmpegBatcher()
@@ -0,0 +1,299 @@
+import fcntl
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from lib.deadline_module import DeadlineExceededError
+
+module_logger = logging.getLogger('tr_rdio_uploader.encode_resources')
+
+IONICE_CLASSES = {"best-effort": "2", "idle": "3"}
+
+
+class EncodeSlots:
+    """
+    Caps how many encodes run at once on the host. A semaphore queues the threads of this
+    process, and flock'd slot files under slot_path are shared with other uploader processes
+    (backfill pools, one process per call from uploadScript). A slot held by a process that
+    dies is freed with its file lock.
+
+    A batched ffmpeg run holds one slot per call it encodes. Slots for a batch are taken all at
+    once or not at all, so two batches can't each hold part of what the other is waiting for.
+
+    :param max_concurrent: Encodes allowed at once.
+    :param slot_path: Directory for the slot files.
+    """
+
+    def __init__(self, max_concurrent, slot_path):
+        self.max_concurrent = max_concurrent
+        self.slot_path = slot_path
+        self._semaphore = threading.BoundedSemaphore(max_concurrent)
+        # Taking several slots is done one batch at a time, so partial holds can't deadlock.
+        self._multi_slot_lock = threading.Lock()
+
+    def _try_lock_slots(self, count):
+        """Lock count free slot files. Returns their open files, or None, holding none, if fewer are free."""
+        slot_files = []
+        for slot_number in range(self.max_concurrent):
+            slot_file = open(os.path.join(self.slot_path, f"slot-{slot_number}.lock"), 'a')
+            try:
+                fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                slot_files.append(slot_file)
+                if len(slot_files) == count:
+                    return slot_files
+            except BlockingIOError:
+                slot_file.close()
+
+        for slot_file in slot_files:
+            slot_file.close()
+        return None
+
+    @staticmethod
+    def _time_left(give_up_at):
+        """Seconds left before give_up_at, or None to wait without a limit."""
+        return max(0.0, give_up_at - time.monotonic()) if give_up_at is not None else None
+
+    @contextmanager
+    def acquire(self, timeout=None, count=1):
+        """
+        Hold slots for the duration of the block.
+
+        :param timeout: Seconds to wait for the slots, e.g. the remaining encode budget.
+        :param count: Slots to hold, one per call a batched ffmpeg run encodes. At most max_concurrent.
+        :raises DeadlineExceededError: If the slots don't free up within timeout.
+        """
+        count = max(1, min(count, self.max_concurrent))
+        give_up_at = time.monotonic() + timeout if timeout is not None else None
+        acquired = 0
+        try:
+            time_left = self._time_left(give_up_at)
+            if count > 1 and not self._multi_slot_lock.acquire(timeout=-1 if time_left is None else time_left):
+                raise DeadlineExceededError(f"No encode slot free within {timeout:.1f}s.")
+            try:
+                while acquired < count:
+                    if not self._semaphore.acquire(timeout=self._time_left(give_up_at)):
+                        raise DeadlineExceededError(f"No encode slot free within {timeout:.1f}s.")
+                    acquired += 1
+
+                os.makedirs(self.slot_path, exist_ok=True)
+                wait_seconds = 0.05
+                while True:
+                    slot_files = self._try_lock_slots(count)
+                    if slot_files is not None:
+                        break
+                    time_left = self._time_left(give_up_at)
+                    if time_left == 0.0:
+                        raise DeadlineExceededError(f"No encode slot free within {timeout:.1f}s.")
+                    time.sleep(wait_seconds if time_left is None else min(wait_seconds, time_left))
+                    wait_seconds = min(wait_seconds * 2, 1.0)
+            finally:
+                if count > 1:
+                    self._multi_slot_lock.release()
+
+            with ExitStack() as held_slots:
+                for slot_file in slot_files:
+                    held_slots.enter_context(slot_file)
+                yield
+        finally:
+            for _ in range(acquired):
+                self._semaphore.release()
+
+
+class EncodeMetrics:
+    """
+    Totals of what encoding costs the host, logged every interval_seconds so encode settings
+    can be tuned against the recorder's needs.
+
+    The logged figures are:
+    - Encode CPU time. For ffmpeg this is this process's reaped children from RUSAGE_CHILDREN,
+      since ffmpeg is the only child the uploader starts. For in-process encoders it is the
+      encoding thread's CPU time.
+    - The run queue from /proc/loadavg. A queue longer than the CPU count means runnable
+      threads, the recorder's included, are waiting for a core.
+    - Time spent waiting for an encode slot.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset(time.monotonic(), resource.getrusage(resource.RUSAGE_CHILDREN))
+
+    def _reset(self, now, children_usage):
+        self._started = now
+        self._children_cpu_seconds = children_usage.ru_utime + children_usage.ru_stime
+        self._encodes = 0
+        self._encode_seconds = 0.0
+        self._thread_cpu_seconds = 0.0
+        self._slot_wait_seconds = 0.0
+        self._run_queue_samples = []
+
+    @staticmethod
+    def run_queue():
+        """Runnable threads on the host, from /proc/loadavg, or None where that isn't available."""
+        try:
+            with open("/proc/loadavg", 'r') as f:
+                return int(f.read().split()[3].split("/")[0])
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def record(self, interval_seconds, encode_seconds, slot_wait_seconds, thread_cpu_seconds=0.0):
+        """Add one encoder run, and log the totals if interval_seconds have passed since the last log."""
+        run_queue = self.run_queue()
+        with self._lock:
+            self._encodes += 1
+            self._encode_seconds += encode_seconds
+            self._slot_wait_seconds += slot_wait_seconds
+            self._thread_cpu_seconds += thread_cpu_seconds
+            if run_queue is not None:
+                self._run_queue_samples.append(run_queue)
+
+            now = time.monotonic()
+            elapsed = now - self._started
+            if not interval_seconds or elapsed < interval_seconds:
+                return
+
+            children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu_seconds = (children_usage.ru_utime + children_usage.ru_stime - self._children_cpu_seconds
+                           + self._thread_cpu_seconds)
+            run_queue_text = "n/a"
+            if self._run_queue_samples:
+                run_queue_text = (f"avg {sum(self._run_queue_samples) / len(self._run_queue_samples):.1f} "
+                                  f"max {max(self._run_queue_samples)}")
+            module_logger.info(f"<<Encode>> {self._encodes} runs in {elapsed:.0f}s: {self._encode_seconds:.1f}s encoding, "
+                               f"{cpu_seconds:.1f}s CPU ({cpu_seconds / elapsed:.2f} cores), "
+                               f"run queue {run_queue_text} on {os.cpu_count()} CPUs, "
+                               f"{self._slot_wait_seconds:.1f}s waiting for slots.")
+            self._reset(now, children_usage)
+
+
+encode_metrics = EncodeMetrics()
+
+
+class EncodeResourcePolicy:
+    """
+    How encoders share the host with trunk-recorder, built from m4a_audio_compression.resources.
+
+    ffmpeg is started through taskset, nice and ionice, so the CPU mask and priorities are in
+    place before it runs. Doing this with a preexec_fn isn't safe from the worker threads. Its
+    decoder and filter threads are capped at threads. In-process encoders run with the calling
+    thread pinned to the CPU mask for the duration of the encode. Every encoder run takes an
+    EncodeSlots slot when max_concurrent is set.
+
+    :param resources_config: EncodeResourceConfig.
+    """
+
+    def __init__(self, resources_config):
+        self.resources_config = resources_config
+        self.threads = resources_config.threads
+        self.cpu_affinity = set(resources_config.cpu_affinity)
+        self.command_prefix = self._command_prefix(resources_config)
+        self.slots = EncodeSlots(resources_config.max_concurrent, resources_config.slot_path) if resources_config.max_concurrent > 0 else None
+
+    @staticmethod
+    def _command_prefix(resources_config):
+        wanted = []
+        if resources_config.cpu_affinity:
+            wanted.append(["taskset", "-c", ",".join(str(cpu) for cpu in resources_config.cpu_affinity)])
+        if resources_config.nice:
+            wanted.append(["nice", "-n", str(resources_config.nice)])
+        if resources_config.ionice_class:
+            ionice = ["ionice", "-c", IONICE_CLASSES[resources_config.ionice_class]]
+            if resources_config.ionice_class == "best-effort":
+                ionice += ["-n", str(resources_config.ionice_level)]
+            wanted.append(ionice)
+
+        command_prefix = []
+        for tool_command in wanted:
+            if shutil.which(tool_command[0]) is None:
+                module_logger.warning(f"<<Encode>> {tool_command[0]} is not installed. Encoding without '{' '.join(tool_command)}'.")
+                continue
+            command_prefix += tool_command
+        return command_prefix
+
+    def ffmpeg_command(self, command):
+        """command, an ffmpeg argument list, run under the policy's CPU mask, priorities and thread caps."""
+        if self.threads:
+            capped_command = [command[0], "-filter_threads", str(self.threads), "-filter_complex_threads", str(self.threads)]
+            for argument in command[1:]:
+                if argument == "-i":
+                    capped_command += ["-threads", str(self.threads)]
+                capped_command.append(argument)
+            command = capped_command
+        return self.command_prefix + command
+
+    @contextmanager
+    def slot(self, timeout=None, count=1):
+        """Hold count encode slots, if concurrency is capped. Yields the seconds spent waiting for them."""
+        if self.slots is None:
+            yield 0.0
+            return
+
+        wait_started = time.monotonic()
+        with self.slots.acquire(timeout, count):
+            yield time.monotonic() - wait_started
+
+    @contextmanager
+    def pinned_thread(self):
+        """Restrict the calling thread to cpu_affinity for the block. Used by in-process encoders."""
+        if not self.cpu_affinity or not hasattr(os, "sched_setaffinity"):
+            yield
+            return
+
+        # On Linux pid 0 is the calling thread, not the whole process.
+        previous_affinity = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, self.cpu_affinity)
+        try:
+            yield
+        finally:
+            os.sched_setaffinity(0, previous_affinity)
+
+    @contextmanager
+    def in_process_encode(self, timeout=None):
+        """Slot, CPU mask and metrics for an encode that runs in the calling thread."""
+        with self.slot(timeout) as slot_wait_seconds, self.pinned_thread():
+            started = time.monotonic()
+            thread_cpu_started = time.thread_time()
+            try:
+                yield
+            finally:
+                encode_metrics.record(self.resources_config.metrics_interval_seconds, time.monotonic() - started,
+                                      slot_wait_seconds, time.thread_time() - thread_cpu_started)
+
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def resource_policy(resources_config):
+    """The EncodeResourcePolicy for resources_config, shared by every thread using the same settings."""
+    with _policies_lock:
+        policy = _policies.get(resources_config)
+        if policy is None:
+            policy = _policies[resources_config] = EncodeResourcePolicy(resources_config)
+        return policy
+
+
+def run_ffmpeg(command, resources_config, timeout=None, encodes=1):
+    """
+    subprocess.run for ffmpeg under the encode resource policy. The wait for an encode slot
+    counts against timeout.
+
+    :param encodes: Calls the command encodes, and so the encode slots it holds. More than one for a batch.
+
+    :return: The CompletedProcess, with text output captured.
+    :raises subprocess.CalledProcessError: If ffmpeg fails.
+    :raises subprocess.TimeoutExpired: If ffmpeg runs past what is left of timeout after getting a slot.
+    :raises DeadlineExceededError: If no encode slot frees up within timeout.
+    """
+    policy = resource_policy(resources_config)
+    with policy.slot(timeout, encodes) as slot_wait_seconds:
+        started = time.monotonic()
+        try:
+            return subprocess.run(policy.ffmpeg_command(command), capture_output=True, text=True, check=True,
+                                  timeout=max(0.0, timeout - slot_wait_seconds) if timeout is not None else None)
+        finally:
+            encode_metrics.record(resources_config.metrics_interval_seconds, time.monotonic() - started, slot_wait_seconds)
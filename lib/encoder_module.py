@@ -0,0 +1,243 @@
+import logging
+import math
+import os
+import random
+import statistics
+import struct
+import tempfile
+import threading
+import time
+import wave
+
+from lib.audio_file_handler import compress_wav_to_m4a
+from lib.deadline_module import DeadlineExceededError
+from lib.encode_batch_module import ffmpeg_batcher
+from lib.encode_resources_module import resource_policy
+
+try:
+    import av
+except ImportError:
+    av = None
+
+module_logger = logging.getLogger('tr_rdio_uploader.encoder')
+
+
+class Encoder:
+    """
+    Converts a call WAV to M4A. Implementations are used by one worker thread at a time, so
+    they may keep state between calls (see get_encoder).
+    """
+
+    name = None
+
+    def encode(self, input_wav, output_m4a, compression_config, stage_deadline=None):
+        """
+        :param compression_config: CompressionConfig.
+        :param stage_deadline: Optional StageDeadline for the encode stage.
+        :raises DeadlineExceededError: If encoding does not finish within the stage budget.
+        """
+        raise NotImplementedError
+
+
+class FFmpegSubprocessEncoder(Encoder):
+    """
+    Runs the ffmpeg command line, one or two processes per call. With batch.enabled, calls
+    encoded around the same time by other workers share ffmpeg runs (see FFmpegBatcher).
+    """
+
+    name = "ffmpeg"
+
+    def encode(self, input_wav, output_m4a, compression_config, stage_deadline=None):
+        if compression_config.batch.enabled:
+            ffmpeg_batcher.encode(input_wav, output_m4a, compression_config, stage_deadline, compress_wav_to_m4a)
+        else:
+            compress_wav_to_m4a(input_wav, output_m4a, compression_config, stage_deadline)
+
+
+class PyAVEncoder(Encoder):
+    """
+    Encodes in-process through libav with PyAV, so short calls don't pay for starting ffmpeg
+    and loading its codecs every time. PyAV releases the GIL inside libav calls, so encoder
+    threads run in parallel.
+
+    Only the AAC codec lookup is kept between calls. Each call still opens its own encoder
+    context, because PyAV creates the context with the output stream and can't attach an
+    already open one to a new container.
+
+    Loudness normalization runs loudnorm in a single pass, in its dynamic mode. The ffmpeg
+    backend measures first and then applies a linear gain. That costs a second decode, which
+    this backend exists to avoid.
+
+    The resource policy's CPU mask, thread cap and encode slots apply here too. nice and ionice
+    only apply to ffmpeg processes, since a worker thread can't give its priority back.
+    """
+
+    name = "pyav"
+
+    def __init__(self):
+        if av is None:
+            raise EnvironmentError("The pyav encoder needs PyAV. Install it with 'pip install av'.")
+        # Only the codec lookup is reused. add_stream opens a new encoder context for every call.
+        self.aac_codec = av.codec.Codec("aac", "w")
+
+    def encode(self, input_wav, output_m4a, compression_config, stage_deadline=None):
+        if not compression_config.enabled:
+            module_logger.warning("Compression is disabled in config. Skipping conversion.")
+            return
+
+        if not os.path.isfile(input_wav):
+            raise FileNotFoundError(f"Input file '{input_wav}' does not exist.")
+
+        policy = resource_policy(compression_config.resources)
+        try:
+            with policy.in_process_encode(stage_deadline.timeout() if stage_deadline is not None else None), \
+                    av.open(input_wav) as input_container, av.open(output_m4a, "w", format="mp4") as output_container:
+                input_stream = input_container.streams.audio[0]
+                if policy.threads:
+                    input_stream.codec_context.thread_count = policy.threads
+
+                output_stream = output_container.add_stream(self.aac_codec.name, rate=compression_config.sample_rate)
+                output_stream.bit_rate = compression_config.bitrate * 1000
+                output_stream.codec_context.layout = input_stream.codec_context.layout
+                if policy.threads:
+                    output_stream.codec_context.thread_count = policy.threads
+
+                filter_graph = self._loudnorm_graph(input_stream, compression_config) if compression_config.two_pass_loudnorm else None
+
+                for frame in input_container.decode(input_stream):
+                    if stage_deadline is not None and stage_deadline.expired():
+                        raise DeadlineExceededError(f"Encoding {input_wav} exceeded its {stage_deadline.timeout_seconds:.1f}s budget.")
+                    self._encode_frames(output_container, output_stream, self._filter(filter_graph, frame))
+
+                self._encode_frames(output_container, output_stream, self._filter(filter_graph, None))
+                # The encoder resamples and buffers into AAC-sized frames internally. Flush it.
+                for packet in output_stream.encode(None):
+                    output_container.mux(packet)
+
+        except DeadlineExceededError:
+            self._remove_partial(output_m4a)
+            raise
+        except av.error.FFmpegError as e:
+            self._remove_partial(output_m4a)
+            raise RuntimeError(f"PyAV failed to encode '{input_wav}': {e}") from e
+
+        module_logger.info(f"Successfully compressed '{input_wav}' to '{output_m4a}' in-process.")
+
+    @staticmethod
+    def _loudnorm_graph(input_stream, compression_config):
+        filter_graph = av.filter.Graph()
+        source = filter_graph.add_abuffer(template=input_stream)
+        loudnorm = filter_graph.add("loudnorm", compression_config.loudnorm_second_pass_params)
+        sink = filter_graph.add("abuffersink")
+        source.link_to(loudnorm)
+        loudnorm.link_to(sink)
+        filter_graph.configure()
+        return filter_graph
+
+    @staticmethod
+    def _filter(filter_graph, frame):
+        """Frames out of the filter graph for one input frame, or the remainder when frame is None."""
+        if filter_graph is None:
+            return [frame] if frame is not None else []
+
+        filter_graph.push(frame)
+        filtered_frames = []
+        while True:
+            try:
+                filtered_frames.append(filter_graph.pull())
+            except (BlockingIOError, EOFError):
+                return filtered_frames
+
+    @staticmethod
+    def _encode_frames(output_container, output_stream, frames):
+        for frame in frames:
+            # Timestamps are regenerated by the encoder after resampling.
+            frame.pts = None
+            for packet in output_stream.encode(frame):
+                output_container.mux(packet)
+
+    @staticmethod
+    def _remove_partial(output_m4a):
+        try:
+            os.remove(output_m4a)
+        except FileNotFoundError:
+            pass
+
+
+ENCODERS = {encoder_class.name: encoder_class for encoder_class in (FFmpegSubprocessEncoder, PyAVEncoder)}
+
+_thread_encoders = threading.local()
+
+
+def get_encoder(name):
+    """
+    The calling thread's encoder for name, created on first use and kept for the thread's later
+    calls. Watch mode workers and backfill processes each reuse one encoder across calls.
+
+    :raises ValueError: If name is not a known encoder.
+    :raises EnvironmentError: If the encoder's library is not installed.
+    """
+    encoders = getattr(_thread_encoders, "encoders", None)
+    if encoders is None:
+        encoders = _thread_encoders.encoders = {}
+
+    encoder = encoders.get(name)
+    if encoder is None:
+        if name not in ENCODERS:
+            raise ValueError(f"Unknown encoder '{name}'. Choose from {', '.join(ENCODERS)}.")
+        encoder = encoders[name] = ENCODERS[name]()
+    return encoder
+
+
+def _write_test_call(wav_path, duration_seconds, sample_rate=8000):
+    """Write a voice-band test call: a warbling tone with noise, like a short radio transmission."""
+    samples = []
+    for index in range(int(duration_seconds * sample_rate)):
+        t = index / sample_rate
+        tone = math.sin(2 * math.pi * (700 + 200 * math.sin(2 * math.pi * 3 * t)) * t)
+        samples.append(int(max(-1.0, min(1.0, 0.5 * tone + random.uniform(-0.05, 0.05))) * 32767))
+
+    with wave.open(wav_path, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(struct.pack(f"<{len(samples)}h", *samples))
+
+
+def benchmark_encoders(compression_config, encoder_names, durations=(1, 2, 5), iterations=20):
+    """
+    Time each encoder on synthetic calls of the given durations.
+
+    :return: Dict of encoder name -> {duration: (median seconds, p95 seconds)}. Encoders that
+             can't run here are reported with the error string instead.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="tr_rdio_encoder_benchmark_") as work_path:
+        test_calls = {}
+        for duration in durations:
+            test_calls[duration] = os.path.join(work_path, f"call_{duration}s.wav")
+            _write_test_call(test_calls[duration], duration)
+
+        for encoder_name in encoder_names:
+            try:
+                encoder = get_encoder(encoder_name)
+                # Warm-up, so one-off library loading isn't counted against the first call.
+                encoder.encode(test_calls[durations[0]], os.path.join(work_path, "warmup.m4a"), compression_config)
+            except Exception as e:
+                results[encoder_name] = str(e)
+                continue
+
+            results[encoder_name] = {}
+            for duration, wav_path in test_calls.items():
+                timings = []
+                for iteration in range(iterations):
+                    output_m4a = os.path.join(work_path, f"{encoder_name}_{duration}s_{iteration}.m4a")
+                    start_time = time.perf_counter()
+                    encoder.encode(wav_path, output_m4a, compression_config)
+                    timings.append(time.perf_counter() - start_time)
+                    os.remove(output_m4a)
+                timings.sort()
+                results[encoder_name][duration] = (statistics.median(timings),
+                                                   timings[min(len(timings) - 1, int(len(timings) * 0.95))])
+
+    return results
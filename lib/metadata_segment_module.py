@@ -0,0 +1,236 @@
+import fcntl
+import gzip
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+module_logger = logging.getLogger('tr_rdio_uploader.metadata_segment')
+
+OPEN_DIRECTORY_NAME = "open"
+SEALED_DIRECTORY_NAME = "sealed"
+INDEX_SUFFIX = ".idx"
+
+
+class MetadataSegmentSpool:
+    """
+    Local spool of per-system, per-hour NDJSON segments of call metadata, archived in place of
+    one .json object per call.
+
+    Records are appended to an open segment under <spool_path>/open/<short_name>/. A segment is
+    sealed (moved to <spool_path>/sealed/<short_name>/) once it reaches max_segment_bytes or has
+    been open for max_segment_age_seconds, and sealed segments are uploaded through the archive
+    class and removed. Segment names are fixed when they are opened, so a call's metadata URL is
+    known as soon as it is appended.
+
+    With compress set, every record is its own gzip member. The segment as a whole is still a
+    valid gzip file, and one record's byte range decompresses on its own.
+
+    Next to each segment is an offset index with one "<call id>\\t<offset>\\t<length>" line per
+    record, uploaded as <segment>.idx, so a single call can be fetched with a Range request.
+
+    A call archived again, e.g. by a backfill or a replay, while its record is still in the open
+    segment keeps that record rather than adding a second one.
+
+    All access goes through a file lock in the spool directory, so the worker threads of one
+    uploader and separate uploader processes (backfill workers) can share a spool.
+
+    :param segment_config: MetadataSegmentConfig.
+    """
+
+    def __init__(self, segment_config):
+        self.spool_path = segment_config.spool_path
+        self.compress = segment_config.compress
+        self.max_segment_bytes = segment_config.max_segment_bytes
+        self.max_segment_age_seconds = segment_config.max_segment_age_seconds
+        self.extension = ".ndjson.gz" if self.compress else ".ndjson"
+        self.lock_path = os.path.join(self.spool_path, ".lock")
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(self.spool_path, exist_ok=True)
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _segment_directory(self, state, system_short_name):
+        return os.path.join(self.spool_path, state, system_short_name)
+
+    @staticmethod
+    def generated_folder_path(system_short_name, segment_hour):
+        """Archive folder for a segment, the same <short_name>/Y/M/D folder as the call audio."""
+        return os.path.join(system_short_name, str(segment_hour.year), str(segment_hour.month), str(segment_hour.day))
+
+    @staticmethod
+    def _segment_hour(segment_name):
+        """UTC hour a segment covers, from its <short_name>-<YYYYmmddHH>-<opened ms> name."""
+        return datetime.strptime(segment_name.rsplit("-", 2)[1], "%Y%m%d%H")
+
+    @staticmethod
+    def _segment_opened_at(segment_name):
+        return int(segment_name.rsplit("-", 2)[2].split(".", 1)[0]) / 1000
+
+    def _open_segment_name(self, system_short_name, hour_key):
+        """Name of the open segment for this system and hour, opening a new one if there is none."""
+        open_directory = self._segment_directory(OPEN_DIRECTORY_NAME, system_short_name)
+        os.makedirs(open_directory, exist_ok=True)
+
+        prefix = f"{system_short_name}-{hour_key}-"
+        for file_name in os.listdir(open_directory):
+            if file_name.startswith(prefix) and file_name.endswith(self.extension):
+                return file_name
+
+        # A segment opened and sealed within the same millisecond must not be reused.
+        sealed_directory = self._segment_directory(SEALED_DIRECTORY_NAME, system_short_name)
+        opened_ms = int(time.time() * 1000)
+        while os.path.exists(os.path.join(sealed_directory, f"{prefix}{opened_ms}{self.extension}")):
+            opened_ms += 1
+        return f"{prefix}{opened_ms}{self.extension}"
+
+    def append(self, call_data, call_id, system_short_name):
+        """
+        Append one call's metadata to the open segment for its system and start hour.
+
+        :return: Tuple of (segment name, archive folder for the segment, record offset, record length).
+        """
+        record = json.dumps(call_data, separators=(",", ":")).encode() + b"\n"
+        if self.compress:
+            record = gzip.compress(record)
+
+        call_hour = datetime.utcfromtimestamp(call_data['start_time'])
+        hour_key = call_hour.strftime("%Y%m%d%H")
+
+        with self._locked():
+            segment_name = self._open_segment_name(system_short_name, hour_key)
+            segment_path = os.path.join(self._segment_directory(OPEN_DIRECTORY_NAME, system_short_name), segment_name)
+
+            existing_record = self._indexed_record(segment_path, call_id)
+            if existing_record is not None:
+                module_logger.debug(f"<<Metadata>> {call_id} is already in segment {segment_name}, keeping that record.")
+                offset, length = existing_record
+                return segment_name, self.generated_folder_path(system_short_name, call_hour), offset, length
+
+            with open(segment_path, 'ab') as segment_file:
+                offset = segment_file.tell()
+                segment_file.write(record)
+            with open(segment_path + INDEX_SUFFIX, 'a') as index_file:
+                index_file.write(f"{call_id}\t{offset}\t{len(record)}\n")
+
+            if offset + len(record) >= self.max_segment_bytes:
+                self._seal(system_short_name, segment_name)
+
+        return segment_name, self.generated_folder_path(system_short_name, call_hour), offset, len(record)
+
+    @staticmethod
+    def _indexed_record(segment_path, call_id):
+        """(offset, length) of call_id's record in a segment, from its index, or None if it has none."""
+        try:
+            with open(segment_path + INDEX_SUFFIX, 'r') as index_file:
+                for line in index_file:
+                    indexed_call_id, offset, length = line.rstrip("\n").split("\t")
+                    if indexed_call_id == call_id:
+                        return int(offset), int(length)
+        except FileNotFoundError:
+            pass
+        return None
+
+    def _seal(self, system_short_name, segment_name):
+        """Move an open segment and its index to the sealed directory. Caller holds the lock."""
+        open_directory = self._segment_directory(OPEN_DIRECTORY_NAME, system_short_name)
+        sealed_directory = self._segment_directory(SEALED_DIRECTORY_NAME, system_short_name)
+        os.makedirs(sealed_directory, exist_ok=True)
+
+        # Index first, so a sealed segment always has its index beside it.
+        os.replace(os.path.join(open_directory, segment_name + INDEX_SUFFIX),
+                   os.path.join(sealed_directory, segment_name + INDEX_SUFFIX))
+        os.replace(os.path.join(open_directory, segment_name), os.path.join(sealed_directory, segment_name))
+        module_logger.debug(f"<<Metadata>> Sealed segment {segment_name}")
+
+    def seal_due(self, force=False):
+        """Seal open segments that are past max_segment_age_seconds, or all of them with force."""
+        open_root = os.path.join(self.spool_path, OPEN_DIRECTORY_NAME)
+        if not os.path.isdir(open_root):
+            return
+
+        now = time.time()
+        with self._locked():
+            for system_short_name in os.listdir(open_root):
+                for file_name in os.listdir(os.path.join(open_root, system_short_name)):
+                    if not file_name.endswith(self.extension):
+                        continue
+                    if force or now - self._segment_opened_at(file_name) >= self.max_segment_age_seconds:
+                        self._seal(system_short_name, file_name)
+
+    def has_sealed(self):
+        """True if there are sealed segments waiting to be uploaded."""
+        sealed_root = os.path.join(self.spool_path, SEALED_DIRECTORY_NAME)
+        if not os.path.isdir(sealed_root):
+            return False
+        return any(file_name.endswith(self.extension)
+                   for system_short_name in os.listdir(sealed_root)
+                   for file_name in os.listdir(os.path.join(sealed_root, system_short_name)))
+
+    def upload_sealed(self, archive_class, archive_path, timeout=None):
+        """
+        Upload sealed segments and their indexes, removing each from the spool once both are stored.
+        A segment that fails stays sealed and is tried again on the next flush.
+
+        :return: Number of segments uploaded.
+        """
+        sealed_root = os.path.join(self.spool_path, SEALED_DIRECTORY_NAME)
+        if not os.path.isdir(sealed_root):
+            return 0
+
+        uploaded = 0
+        for system_short_name in os.listdir(sealed_root):
+            sealed_directory = os.path.join(sealed_root, system_short_name)
+            for file_name in os.listdir(sealed_directory):
+                if file_name.endswith(INDEX_SUFFIX):
+                    continue
+                if self._upload_segment(archive_class, archive_path, system_short_name, sealed_directory, file_name, timeout):
+                    uploaded += 1
+
+        return uploaded
+
+    def _upload_segment(self, archive_class, archive_path, system_short_name, sealed_directory, segment_name, timeout):
+        segment_path = os.path.join(sealed_directory, segment_name)
+        try:
+            segment_file = open(segment_path, 'rb')
+        except FileNotFoundError:
+            # Uploaded and removed by another worker.
+            return False
+
+        with segment_file:
+            try:
+                # Only one worker uploads a given segment.
+                fcntl.flock(segment_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            if not os.path.exists(segment_path):
+                return False
+
+            generated_folder_path = self.generated_folder_path(system_short_name, self._segment_hour(segment_name))
+            destination_path = os.path.join(archive_path, generated_folder_path, segment_name)
+
+            for source_path, destination_file_path in ((segment_path + INDEX_SUFFIX, destination_path + INDEX_SUFFIX),
+                                                       (segment_path, destination_path)):
+                if not archive_class.upload_file(source_path, destination_file_path, generated_folder_path,
+                                                 max_attempts=1, timeout=timeout):
+                    module_logger.warning(f"<<Metadata>> Upload of segment {segment_name} failed. Will retry on the next flush.")
+                    return False
+
+            os.remove(segment_path + INDEX_SUFFIX)
+            os.remove(segment_path)
+
+        module_logger.info(f"<<Metadata>> Archived segment {segment_name}")
+        return True
+
+    def flush(self, archive_class, archive_path, timeout=None, force=False):
+        """Seal segments that are due and upload everything sealed."""
+        self.seal_due(force)
+        return self.upload_sealed(archive_class, archive_path, timeout)
@@ -0,0 +1,192 @@
+import logging
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+module_logger = logging.getLogger('tr_rdio_uploader.rate_limit')
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket.
+
+    Tokens refill continuously at `rate` per second up to `capacity`. A rate of None or 0
+    disables limiting and acquire() returns immediately.
+
+    :param rate: Tokens added per second.
+    :param capacity: Maximum tokens held. Defaults to one second's worth (at least 1).
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate if rate else None
+        self.capacity = capacity if capacity else max(1.0, self.rate or 1.0)
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` are available and take them."""
+        if self.rate is None:
+            return
+
+        # Requests larger than the bucket are allowed through once the bucket is full,
+        # otherwise they would never be satisfied.
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait_seconds = (tokens - self._tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BULK = "bulk"
+
+# Largest piece of a read paid for at once, so throttled streams move steadily instead of in bursts.
+THROTTLE_CHUNK_BYTES = 64 * 1024
+
+
+class BandwidthLimiter:
+    """
+    Byte-rate limit for one link or endpoint, shared by every transfer through it.
+
+    Transfers are either interactive (call metadata, m4a, RDIO posts) or bulk (WAV archive
+    uploads). While any interactive transfer is running, bulk transfers are held to bulk_share
+    of the rate so the interactive ones keep the rest. With no interactive traffic, bulk gets
+    the full rate.
+
+    :param max_kbps: Limit in kilobits per second. None or 0 disables limiting.
+    :param bulk_share: Fraction of the rate bulk transfers may use while interactive ones are running.
+    """
+
+    def __init__(self, max_kbps, bulk_share=0.5):
+        self.max_kbps = max_kbps
+        self.bulk_share = bulk_share
+        bytes_per_second = max_kbps * 1000 / 8 if max_kbps else None
+        self._bucket = TokenBucket(bytes_per_second)
+        self._bulk_bucket = TokenBucket(bytes_per_second * bulk_share if bytes_per_second and bulk_share else None)
+        self._interactive_transfers = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def transfer(self, priority):
+        """Mark a transfer as running for the duration of the block."""
+        if priority != PRIORITY_INTERACTIVE:
+            yield
+            return
+
+        with self._lock:
+            self._interactive_transfers += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._interactive_transfers -= 1
+
+    def consume(self, byte_count, priority):
+        """Block until byte_count bytes may be sent."""
+        if self._bucket.rate is None:
+            return
+
+        # Pieces must fit the bucket, which lets oversized requests through once it is full.
+        piece_bytes = max(1, min(THROTTLE_CHUNK_BYTES, int(self._bucket.capacity), int(self._bulk_bucket.capacity)))
+        for start in range(0, byte_count, piece_bytes):
+            chunk_bytes = min(piece_bytes, byte_count - start)
+            if priority == PRIORITY_BULK and self._interactive_transfers:
+                self._bulk_bucket.acquire(chunk_bytes)
+            self._bucket.acquire(chunk_bytes)
+
+
+class ThrottledReader:
+    """
+    File-like wrapper that paces reads through bandwidth limiters, for upload clients that pull
+    their request body from a file object.
+
+    Bytes are only paid for the first time they are read. Clients that read the body once to
+    hash it and then rewind to send it are not charged twice.
+    """
+
+    def __init__(self, fileobj, limiters, priority):
+        self.fileobj = fileobj
+        self.limiters = limiters
+        self.priority = priority
+        self._paid_until = fileobj.tell()
+
+    def _pay(self, start, length):
+        unpaid_bytes = start + length - max(start, self._paid_until)
+        if unpaid_bytes > 0:
+            for limiter in self.limiters:
+                limiter.consume(unpaid_bytes, self.priority)
+            self._paid_until = start + length
+
+    def read(self, size=-1):
+        start = self.fileobj.tell()
+        data = self.fileobj.read(size)
+        self._pay(start, len(data))
+        return data
+
+    def readinto(self, buffer):
+        start = self.fileobj.tell()
+        length = self.fileobj.readinto(buffer)
+        self._pay(start, length or 0)
+        return length
+
+    def seek(self, offset, whence=0):
+        return self.fileobj.seek(offset, whence)
+
+    def tell(self):
+        return self.fileobj.tell()
+
+    def seekable(self):
+        return self.fileobj.seekable()
+
+    def readable(self):
+        return True
+
+
+@contextmanager
+def throttled_transfer(limiters, priority):
+    """Mark a transfer as running on every limiter it passes through."""
+    with ExitStack() as stack:
+        for limiter in limiters:
+            stack.enter_context(limiter.transfer(priority))
+        yield
+
+
+_bandwidth_limiters = {}
+_bandwidth_limiters_lock = threading.Lock()
+
+
+def _shared_limiter(name, max_kbps, bulk_share):
+    """Process-wide limiter for name. Replaced when its settings change on a config reload."""
+    with _bandwidth_limiters_lock:
+        limiter = _bandwidth_limiters.get(name)
+        if limiter is None or limiter.max_kbps != max_kbps or limiter.bulk_share != bulk_share:
+            limiter = BandwidthLimiter(max_kbps, bulk_share)
+            _bandwidth_limiters[name] = limiter
+        return limiter
+
+
+def upload_limiters(bandwidth_config, name, max_kbps):
+    """
+    Limiters an upload to one endpoint passes through: the shared uplink limit and the endpoint's own.
+
+    :param bandwidth_config: BandwidthConfig, or None for no uplink limit.
+    :param name: Endpoint name, e.g. "archive:scp" or "rdio:<url>".
+    :param max_kbps: The endpoint's own limit in kilobits per second, 0 for none.
+    """
+    bulk_share = bandwidth_config.bulk_share if bandwidth_config else 1.0
+    limiters = []
+    if bandwidth_config and bandwidth_config.uplink_max_kbps:
+        limiters.append(_shared_limiter("uplink", bandwidth_config.uplink_max_kbps, bulk_share))
+    if max_kbps:
+        limiters.append(_shared_limiter(name, max_kbps, bulk_share))
+    return limiters
@@ -1,32 +1,118 @@
 import json
+import uuid
 
 import requests
 import logging
 
+from lib.rate_limit_module import throttled_transfer, PRIORITY_INTERACTIVE
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 module_logger = logging.getLogger('tr_rdio_uploader.rdio_uploader')
 
+# Call JSON fields rdio-scanner reads from the meta part, plus where the call's metadata record
+# and verified checksums were archived. The rest of the trunk-recorder JSON, and the per-file
+# archive URLs, are left out unless a system asks for them.
+RDIO_META_FIELDS = ("freq", "freqList", "start_time", "stop_time", "call_length", "emergency", "encrypted",
+                    "talkgroup", "talkgroup_tag", "talkgroup_description", "talkgroup_group", "talkgroup_group_tag",
+                    "patched_talkgroups", "srcList", "short_name", "audio_type", "archive_metadata",
+                    "archive_checksums")
+
 
 class TrunkRecorderUploadError(Exception):
     """Custom exception for trunk-recorder call upload failures."""
     pass
 
-def upload_trunk_recorder_call(rdio_data, call_data):
+
+def _dumps(data):
+    """Compact JSON bytes, with orjson when it's installed and can encode data."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(data)
+        except TypeError:
+            # orjson.JSONEncodeError is a TypeError, e.g. for integers wider than 64 bits.
+            pass
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+class RdioCallPayload:
+    """
+    The multipart body for posting one call, built once and shared by every RDIO system it's
+    posted to. The meta JSON is encoded once per distinct meta_fields setting, and the meta and
+    audioUrl parts are reused as encoded bytes. Only each system's key and system id are encoded
+    per post.
+
+    Build it after the archive stage, since audio_url comes from the archived files.
+
+    :param call_data: The call's JSON data.
+    """
+
+    def __init__(self, call_data):
+        self.call_data = call_data
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self._audio_url_part = self._part("audioUrl", call_data.get("audio_url"))
+        self._meta_parts = {}
+
+    def _part(self, name, value, content_type=None):
+        """One encoded form field. A None value is left out of the form, as requests does."""
+        if value is None:
+            return b""
+        if not isinstance(value, bytes):
+            value = str(value).encode("utf-8")
+        headers = f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n'
+        if content_type:
+            headers += f"Content-Type: {content_type}\r\n"
+        return headers.encode("utf-8") + b"\r\n" + value + b"\r\n"
+
+    def meta(self, meta_fields=None):
+        """
+        :param meta_fields: Call JSON fields to send, RDIO_META_FIELDS when None, or the whole call when it contains "*" (["*"] in config).
+        :return: The encoded meta JSON.
+        """
+        meta_fields = RDIO_META_FIELDS if meta_fields is None else tuple(meta_fields)
+        meta_part = self._meta_parts.get(meta_fields)
+        if meta_part is None:
+            if "*" in meta_fields:
+                meta_data = self.call_data
+            else:
+                meta_data = {name: self.call_data[name] for name in meta_fields if name in self.call_data}
+            meta_part = self._meta_parts[meta_fields] = self._part("meta", _dumps(meta_data), "application/json")
+        return meta_part
+
+    def body(self, rdio_data):
+        """The request body for rdio_data, a RdioSystemConfig."""
+        return b"".join((self._part("key", rdio_data.rdio_api_key),
+                         self._audio_url_part,
+                         self._part("system", rdio_data.system_id),
+                         self.meta(rdio_data.meta_fields),
+                         f"--{self.boundary}--\r\n".encode("utf-8")))
+
+
+def upload_trunk_recorder_call(rdio_data, call_payload, timeout=None, bandwidth_limiters=()):
     """
     Send only metadata to the trunk-recorder call upload endpoint.
     Raises TrunkRecorderUploadError with a specific message on failure.
+
+    :param rdio_data: RdioSystemConfig of the system to post to.
+    :param call_payload: RdioCallPayload of the call, shared across the systems it's posted to.
+    :param timeout: Seconds to wait for the endpoint before giving up, capped by the system's timeout setting.
+    :param bandwidth_limiters: BandwidthLimiters the post is paced through. RDIO posts are interactive traffic.
     """
-    url = rdio_data["rdio_url"]
+    url = rdio_data.rdio_url
+    timeout = min(timeout, rdio_data.timeout) if timeout is not None else rdio_data.timeout
     module_logger.info(f'Uploading call to trunk-recorder endpoint: {url}')
 
-    multipart_fields = {
-        "key":  (None, rdio_data["rdio_api_key"]),
-        "audioUrl": (None, call_data.get("audio_url")),
-        "system": (None, rdio_data.get("system_id")),
-        "meta": (None, json.dumps(call_data), "application/json")
-    }
-
     try:
-        response = requests.post(url, files=multipart_fields, verify=False)
+        body = call_payload.body(rdio_data)
+        with throttled_transfer(bandwidth_limiters, PRIORITY_INTERACTIVE):
+            for limiter in bandwidth_limiters:
+                limiter.consume(len(body), PRIORITY_INTERACTIVE)
+            response = requests.post(url, data=body, headers={"Content-Type": call_payload.content_type},
+                                     verify=False, timeout=timeout)
         # This will raise an HTTPError if the status is 4xx or 5xx.
         response.raise_for_status()
 
@@ -43,6 +129,10 @@ def upload_trunk_recorder_call(rdio_data, call_data):
                      f"Response text: {response.text}")
         raise TrunkRecorderUploadError(error_msg) from http_err
 
+    except requests.exceptions.Timeout as timeout_err:
+        error_msg = f"Timed out after {timeout:.1f}s while uploading to {url}: {timeout_err}"
+        raise TrunkRecorderUploadError(error_msg) from timeout_err
+
     except requests.exceptions.RequestException as req_err:
         # Any other network-related error (connection, DNS, timeout, etc.)
         error_msg = f"Request error while uploading to {url}: {req_err}"
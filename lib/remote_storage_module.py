@@ -1,69 +1,194 @@
 from datetime import datetime, timezone, timedelta
+import base64
+import hashlib
+import io
 import logging
 import mimetypes
 import os
 import shutil
-import time
+import sqlite3
+import threading
 import traceback
 from stat import S_ISDIR
-from contextlib import contextmanager
+from contextlib import contextmanager, closing
+import google_crc32c
 from google.cloud import storage
 from google.cloud.exceptions import GoogleCloudError
 from urllib.parse import urljoin, quote
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError, NoCredentialsError, ParamValidationError
 
 from paramiko import SSHClient, AutoAddPolicy, RSAKey, SSHException
 
+from lib.rate_limit_module import ThrottledReader, throttled_transfer, upload_limiters, PRIORITY_BULK, PRIORITY_INTERACTIVE
+
 module_logger = logging.getLogger('tr_rdio_uploader.file_storage')
 
 
-def get_archive_class(archive_config):
-    if archive_config.get("archive_type") == 'scp':
-        return SCPStorage(archive_config.get('scp'))
-    elif archive_config.get("archive_type") == 'google_cloud':
-        return GoogleCloudStorage(archive_config.get('google_cloud'))
-    elif archive_config.get("archive_type") == 'aws_s3':
-        return AWSS3Storage(archive_config.get('aws_s3'))
-    elif archive_config.get("archive_type") == 'local':
-        return LocalStorage(archive_config.get('local'))
+def get_archive_class(archive_config, bandwidth_config=None):
+    """
+    :param bandwidth_config: Optional BandwidthConfig. Uploads are shaped to its uplink limit and
+                             the backend's own max_upload_kbps.
+    """
+    hash_index = UploadHashIndex(archive_config.hash_index_path) if archive_config.skip_if_present else None
+
+    if archive_config.archive_type == 'scp':
+        limiters = upload_limiters(bandwidth_config, "archive:scp", archive_config.scp.max_upload_kbps)
+        return SCPStorage(archive_config.scp, archive_config.skip_if_present, hash_index, limiters)
+    elif archive_config.archive_type == 'google_cloud':
+        limiters = upload_limiters(bandwidth_config, "archive:google_cloud", archive_config.google_cloud.max_upload_kbps)
+        return GoogleCloudStorage(archive_config.google_cloud, archive_config.skip_if_present, limiters)
+    elif archive_config.archive_type == 'aws_s3':
+        limiters = upload_limiters(bandwidth_config, "archive:aws_s3", archive_config.aws_s3.max_upload_kbps)
+        return AWSS3Storage(archive_config.aws_s3, archive_config.skip_if_present, limiters)
+    elif archive_config.archive_type == 'local':
+        return LocalStorage(archive_config.local, archive_config.skip_if_present, hash_index)
     else:
         module_logger.error('Invalid remote storage type.')
         return None
 
 
+class UploadVerificationError(Exception):
+    """The backend reported a checksum or size that doesn't match what was sent."""
+    pass
+
+
+def read_with_checksums(source_file_path, crc32c=False):
+    """
+    Read a file once into memory and checksum it in the same pass.
+
+    The returned bytes are what gets uploaded, so the checksums sent as integrity headers, used for
+    the skip-if-present check and recorded in the call data always describe exactly the bytes
+    sent. Call audio files are small enough to buffer.
+
+    :param crc32c: Also compute the CRC32C, for backends that verify it.
+    :return: Tuple of (file bytes, checksums dict with "md5" as hex, "size" and optionally "crc32c" as base64).
+    """
+    md5 = hashlib.md5()
+    crc32c_checksum = google_crc32c.Checksum() if crc32c else None
+    chunks = []
+    with open(source_file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+            if crc32c_checksum is not None:
+                crc32c_checksum.update(chunk)
+            chunks.append(chunk)
+
+    data = b''.join(chunks)
+    checksums = {"md5": md5.hexdigest(), "size": len(data)}
+    if crc32c_checksum is not None:
+        checksums["crc32c"] = base64.b64encode(crc32c_checksum.digest()).decode()
+    return data, checksums
+
+
+def _md5_base64(checksums):
+    return base64.b64encode(bytes.fromhex(checksums["md5"])).decode()
+
+
+def transfer_priority(source_file_path):
+    """WAVs are bulk transfers. Everything else (m4a, metadata) is small and wanted promptly."""
+    return PRIORITY_BULK if source_file_path.endswith(".wav") else PRIORITY_INTERACTIVE
+
+
+class UploadHashIndex:
+    """
+    Local SQLite index of the MD5 and size of every file uploaded to backends that can't report
+    a checksum themselves (SCP, local). Lets skip_if_present confirm a remote file matches with a
+    stat instead of reading it back.
+
+    :param index_path: Path of the SQLite database. Shared safely between uploader processes.
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS uploads ("
+                "backend TEXT NOT NULL, destination TEXT NOT NULL, md5 TEXT NOT NULL, size INTEGER NOT NULL, "
+                "PRIMARY KEY (backend, destination))")
+
+    def _connect(self):
+        return sqlite3.connect(self.index_path, timeout=30)
+
+    def matches(self, backend, destination, md5, size):
+        """True if destination was last uploaded to backend with this md5 and size."""
+        with self._lock, closing(self._connect()) as connection:
+            row = connection.execute("SELECT md5, size FROM uploads WHERE backend = ? AND destination = ?",
+                                     (backend, destination)).fetchone()
+        return row is not None and row[0] == md5 and row[1] == size
+
+    def record(self, backend, destination, md5, size):
+        with self._lock, closing(self._connect()) as connection, connection:
+            connection.execute("INSERT OR REPLACE INTO uploads (backend, destination, md5, size) VALUES (?, ?, ?, ?)",
+                               (backend, destination, md5, size))
+
+
 class GoogleCloudStorage:
 
-    def __init__(self, storage_config):
+    def __init__(self, storage_config, skip_if_present=False, bandwidth_limiters=()):
+        self.bucket = None
+        self.timeout = storage_config.timeout
+        self.skip_if_present = skip_if_present
+        self.bandwidth_limiters = bandwidth_limiters
+        # destination path -> checksums of the bytes uploaded there by this instance.
+        self.upload_checksums = {}
         try:
+            if not storage_config.credentials_file or not storage_config.bucket_name:
+                module_logger.error(f"Google Cloud Missing required configuration data.")
+                return
+
             self.storage_client = storage.Client.from_service_account_json(
-                storage_config['credentials_file'], project=storage_config['project_id'])
-            self.bucket_name = storage_config['bucket_name']
-            self.bucket = self.storage_client.get_bucket(self.bucket_name)
-        except KeyError as e:
-            module_logger.error(f"Google Cloud Missing required configuration data: {e}")
+                storage_config.credentials_file, project=storage_config.project_id)
+            self.bucket_name = storage_config.bucket_name
+            self.bucket = self.storage_client.get_bucket(self.bucket_name, timeout=self.timeout)
         except GoogleCloudError as e:
             module_logger.error(f"Google Cloud Storage error: {e}")
 
-    def upload_file(self, source_file_path, destination_file_path, destination_generated_path, max_attempts=3):
+    def upload_file(self, source_file_path, destination_file_path, destination_generated_path, max_attempts=3, timeout=None):
         try:
             if not os.path.exists(source_file_path) or not os.path.isfile(source_file_path):
                 logging.error(f'Source file {source_file_path} does not exist or is not a file.')
                 return False
 
+            timeout = min(timeout, self.timeout) if timeout is not None else self.timeout
+
             mime_type, _ = mimetypes.guess_type(source_file_path)
             if mime_type is None:
                 mime_type = 'application/octet-stream'
 
             if self.bucket:
+                priority = transfer_priority(source_file_path)
+                data, checksums = read_with_checksums(source_file_path, crc32c=True)
+                # GCS reports the object's MD5 and CRC32C as base64 in the object metadata.
+                md5_base64 = _md5_base64(checksums)
+
+                if self.skip_if_present:
+                    existing_blob = self.bucket.get_blob(destination_file_path, timeout=timeout)
+                    if existing_blob is not None and existing_blob.md5_hash == md5_base64:
+                        module_logger.debug(f"<<Archive>> {destination_file_path} already present with matching MD5, skipping upload.")
+                        self.upload_checksums[destination_file_path] = checksums
+                        return existing_blob.public_url
+
                 blob = self.bucket.blob(destination_file_path)
+                # Sent with the object metadata. GCS rejects the upload if the data it received doesn't match.
+                blob.md5_hash = md5_base64
+                blob.crc32c = checksums["crc32c"]
+                with throttled_transfer(self.bandwidth_limiters, priority):
+                    blob.upload_from_file(ThrottledReader(io.BytesIO(data), self.bandwidth_limiters, priority),
+                                          content_type=mime_type, size=len(data), timeout=timeout)
 
-                with open(source_file_path, 'rb') as file:
-                    blob.upload_from_file(file, content_type=mime_type)
+                # The blob's properties are now the stored object's.
+                if blob.crc32c != checksums["crc32c"] or blob.md5_hash != md5_base64:
+                    raise UploadVerificationError(f"stored CRC32C {blob.crc32c} / MD5 {blob.md5_hash} do not match "
+                                                  f"uploaded {checksums['crc32c']} / {md5_base64}")
 
-                blob.make_public()
+                blob.make_public(timeout=timeout)
 
+                self.upload_checksums[destination_file_path] = checksums
                 return blob.public_url
             else:
                 module_logger.warning("Google Storage Bucket is not available.")
@@ -71,53 +196,72 @@ class GoogleCloudStorage:
         except GoogleCloudError as e:
             module_logger.error(f"Failed to upload file to Google Cloud Storage: {e}")
             return None
+        except UploadVerificationError as e:
+            module_logger.error(f"Upload of {destination_file_path} to Google Cloud Storage failed verification: {e}")
+            return None
+
+    def file_url(self, destination_file_path, destination_generated_path):
+        """Public URL of an archived file, without contacting the bucket."""
+        return self.bucket.blob(destination_file_path).public_url
 
 
 class AWSS3Storage:
 
-    def __init__(self, storage_config):
+    def __init__(self, storage_config, skip_if_present=False, bandwidth_limiters=()):
+        self.skip_if_present = skip_if_present
+        self.bandwidth_limiters = bandwidth_limiters
+        # destination path -> checksums of the bytes uploaded there by this instance.
+        self.upload_checksums = {}
         try:
 
-            if not storage_config.get("access_key_id", "") or not storage_config.get("secret_access_key",
-                                                                                     "") or not storage_config.get(
-                'bucket_name', ""):
+            if not storage_config.access_key_id or not storage_config.secret_access_key or not storage_config.bucket_name:
                 module_logger.error(f"AWS S3 Missing required configuration data.")
                 return
 
+            # boto3 timeouts are fixed per resource, so the configured timeout caps every request
+            # and the archive stage deadline is checked between uploads.
+            timeout = storage_config.timeout
             self.s3 = boto3.resource(
                 's3',
-                aws_access_key_id=storage_config.get("access_key_id", ""),
-                aws_secret_access_key=storage_config.get("secret_access_key", "")
+                aws_access_key_id=storage_config.access_key_id,
+                aws_secret_access_key=storage_config.secret_access_key,
+                config=Config(connect_timeout=timeout, read_timeout=timeout, retries={"total_max_attempts": 1})
             )
-            self.bucket_name = storage_config.get('bucket_name', "")
+            self.bucket_name = storage_config.bucket_name
             self.bucket = self.s3.Bucket(self.bucket_name)
 
-        except KeyError as e:
-            module_logger.error(f"AWS S3 Missing required configuration data: {e}")
         except NoCredentialsError as e:
             module_logger.error(f"Credentials not available for AWS S3: {e}")
 
-    def upload_file(self, source_file_path, destination_file_path, destination_generated_path, max_attempts=3):\
+    def upload_file(self, source_file_path, destination_file_path, destination_generated_path, max_attempts=3, timeout=None):
 
         if not os.path.exists(source_file_path) or not os.path.isfile(source_file_path):
             logging.error(f'Source file {source_file_path} does not exist or is not a file.')
             return None
 
+        priority = transfer_priority(source_file_path)
         try:
-            with open(source_file_path, 'rb') as file:
-                self.bucket.put_object(Key=destination_file_path, Body=file)
+            data, checksums = read_with_checksums(source_file_path)
+            if self.skip_if_present and self._object_md5(destination_file_path) == checksums["md5"]:
+                module_logger.debug(f"<<Archive>> {destination_file_path} already present with matching ETag, skipping upload.")
+                self.upload_checksums[destination_file_path] = checksums
+                return self.file_url(destination_file_path, destination_generated_path)
+
+            # S3 rejects the upload with BadDigest if the data it received doesn't match Content-MD5.
+            with throttled_transfer(self.bandwidth_limiters, priority):
+                response = self.s3.meta.client.put_object(
+                    Bucket=self.bucket_name, Key=destination_file_path, ContentMD5=_md5_base64(checksums),
+                    Body=ThrottledReader(io.BytesIO(data), self.bandwidth_limiters, priority))
+
+            # The ETag of a single PUT is the MD5, except for objects encrypted with KMS keys.
+            etag = response.get("ETag", "").strip('"')
+            if response.get("ServerSideEncryption") != "aws:kms" and etag != checksums["md5"]:
+                raise UploadVerificationError(f"ETag {etag} does not match uploaded MD5 {checksums['md5']}")
 
             self.s3.ObjectAcl(self.bucket_name, destination_file_path).put(ACL='public-read')
 
-            # Encode the basename of the local_audio_path to ensure it's URL-safe
-            encoded_file_name = quote(os.path.basename(destination_file_path))
-
-            # First, join the base URL with the current_date
-            url_with_date = urljoin(f'https://{self.bucket_name}.s3.amazonaws.com/',
-                                    os.path.dirname(destination_file_path) + '/')
-
-            # Then, join the result with the encoded file name
-            return urljoin(url_with_date, encoded_file_name)
+            self.upload_checksums[destination_file_path] = checksums
+            return self.file_url(destination_file_path, destination_generated_path)
 
         except FileNotFoundError:
             module_logger.error(f"Local file {source_file_path} not found.")
@@ -125,16 +269,56 @@ class AWSS3Storage:
         except (ClientError, ParamValidationError) as e:
             module_logger.error(f"Error uploading file to AWS S3: {e}")
             return None
+        except UploadVerificationError as e:
+            module_logger.error(f"Upload of {destination_file_path} to AWS S3 failed verification: {e}")
+            return None
+
+    def _object_md5(self, destination_file_path):
+        """
+        MD5 hex of an existing object from a HEAD request, or None if it doesn't exist or can't be checked.
+        Objects stored with a single PUT have their MD5 as the ETag.
+        """
+        try:
+            response = self.s3.meta.client.head_object(Bucket=self.bucket_name, Key=destination_file_path)
+        except ClientError as e:
+            error_code = e.response.get("Error", {}).get("Code")
+            if error_code in ("404", "NoSuchKey", "NotFound"):
+                return None
+            if error_code in ("403", "AccessDenied", "Forbidden"):
+                # Without s3:ListBucket, S3 answers 403 for a missing key. Upload as if it weren't there.
+                module_logger.debug(f"<<Archive>> HEAD of {destination_file_path} was denied, uploading without the presence check.")
+                return None
+            raise
+        return response.get("ETag", "").strip('"')
+
+    def file_url(self, destination_file_path, destination_generated_path):
+        """Public URL of an archived file."""
+        # Encode the basename of the local_audio_path to ensure it's URL-safe
+        encoded_file_name = quote(os.path.basename(destination_file_path))
+
+        # First, join the base URL with the current_date
+        url_with_date = urljoin(f'https://{self.bucket_name}.s3.amazonaws.com/',
+                                os.path.dirname(destination_file_path) + '/')
+
+        # Then, join the result with the encoded file name
+        return urljoin(url_with_date, encoded_file_name)
 
 
 class SCPStorage:
-    def __init__(self, storage_config):
-        self.host = storage_config.get("host")
-        self.port = storage_config.get("port", 22)
-        self.username = storage_config.get("user", "")
-        self.password = storage_config.get("password", "")
-        self.private_key_path = storage_config.get('private_key_path', "")
-        self.base_url = storage_config.get('base_url', "")
+    def __init__(self, storage_config, skip_if_present=False, hash_index=None, bandwidth_limiters=()):
+        self.host = storage_config.host
+        self.port = storage_config.port
+        self.username = storage_config.user
+        self.password = storage_config.password
+        self.private_key_path = storage_config.private_key_path
+        self.base_url = storage_config.base_url
+        self.timeout = storage_config.timeout
+        self.skip_if_present = skip_if_present and hash_index is not None
+        self.hash_index = hash_index
+        self.index_backend = f"scp://{self.username}@{self.host}:{self.port}"
+        self.bandwidth_limiters = bandwidth_limiters
+        # destination path -> checksums of the bytes uploaded there by this instance.
+        self.upload_checksums = {}
 
     def ensure_destination_directory_exists(self, sftp, destination_directory):
         """Ensure the remote directory structure exists."""
@@ -154,42 +338,66 @@ class SCPStorage:
                 traceback.print_exc()
                 module_logger.error(f"SCP Unhandled Exception: {e}")
 
-    def upload_file(self, source_file_path, destination_file_path, destination_generated_path, max_attempts=3):
-        """Uploads a file to the SCP storage."""
+    def upload_file(self, source_file_path, destination_file_path, destination_generated_path, max_attempts=3, timeout=None):
+        """
+        Uploads a file to the SCP storage.
+
+        Makes a single attempt. Retries are scheduled by the caller (see archive_files) so a failing
+        host does not hold the worker in a sleep between attempts.
+        """
 
         if not os.path.exists(source_file_path) or not os.path.isfile(source_file_path):
             module_logger.error(f'Source file {source_file_path} does not exist or is not a file.')
             return False
 
-        for attempt in range(1, max_attempts + 1):
-            try:
-                with self._create_sftp_session() as (ssh_client, sftp):
-                    self.ensure_destination_directory_exists(sftp, os.path.dirname(destination_file_path))
+        timeout = min(timeout, self.timeout) if timeout is not None else self.timeout
+        priority = transfer_priority(source_file_path)
 
-                    sftp.put(source_file_path, destination_file_path)
-
-                    # Encode the basename of the local_audio_path to ensure it's URL-safe
-                    encoded_file_name = quote(os.path.basename(destination_file_path))
+        try:
+            with self._create_sftp_session(timeout) as (ssh_client, sftp), throttled_transfer(self.bandwidth_limiters, priority):
+                data, checksums = read_with_checksums(source_file_path)
+                if self.skip_if_present and self._remote_matches(sftp, destination_file_path, checksums["md5"], len(data)):
+                    module_logger.debug(f"<<Archive>> {destination_file_path} already present with matching size and hash, skipping upload.")
+                    self.upload_checksums[destination_file_path] = checksums
+                    return self.file_url(destination_file_path, destination_generated_path)
+
+                self.ensure_destination_directory_exists(sftp, os.path.dirname(destination_file_path))
+                # SFTP can't checksum the remote file, so the size the server reports after the write is checked instead.
+                remote_attributes = sftp.putfo(ThrottledReader(io.BytesIO(data), self.bandwidth_limiters, priority),
+                                               destination_file_path, file_size=len(data), confirm=True)
+                if remote_attributes.st_size != len(data):
+                    raise UploadVerificationError(f"remote size {remote_attributes.st_size} does not match uploaded size {len(data)}")
+
+                if self.skip_if_present:
+                    self.hash_index.record(self.index_backend, destination_file_path, checksums["md5"], len(data))
+
+                self.upload_checksums[destination_file_path] = checksums
+                return self.file_url(destination_file_path, destination_generated_path)
 
-                    # First, join the base URL with the current_date
-                    url_with_date = urljoin(self.base_url + '/', destination_generated_path + '/')
+        except Exception as error:  # Preferably catch more specific exceptions
+            traceback.print_exc()
+            module_logger.warning(f'SCP upload of {source_file_path} failed: {error}')
 
-                    # Then, join the result with the encoded file name
-                    return urljoin(url_with_date, encoded_file_name)
+        return False
 
-            except Exception as error:  # Preferably catch more specific exceptions
-                traceback.print_exc()
-                module_logger.warning(f'Attempt {attempt} failed: {error}')
-                if attempt < max_attempts:
-                    time.sleep(5)
+    def _remote_matches(self, sftp, destination_file_path, md5_hex, size):
+        """True if the remote file has the expected size and the hash index says we uploaded this content there."""
+        if not self.hash_index.matches(self.index_backend, destination_file_path, md5_hex, size):
+            return False
+        try:
+            return sftp.stat(destination_file_path).st_size == size
+        except FileNotFoundError:
+            return False
 
-        module_logger.error(f'All {max_attempts} attempts failed.')
-        return False
+    def file_url(self, destination_file_path, destination_generated_path):
+        """Public URL of an archived file under base_url."""
+        return _base_url_file_url(self.base_url, destination_file_path, destination_generated_path)
 
     @contextmanager
-    def _create_sftp_session(self):
+    def _create_sftp_session(self, timeout=None):
         """Creates and manages an SFTP session using context management.
 
+        :param timeout: Seconds allowed for connecting, authenticating and each SFTP operation.
         :return: Yields a tuple of SSH client and SFTP session.
         :raises: FileNotFoundError if private key file doesn't exist.
                   SSHException for other SSH connection errors.
@@ -205,7 +413,10 @@ class SCPStorage:
                 "username": self.username,
                 "port": self.port,
                 "look_for_keys": False,
-                "allow_agent": False
+                "allow_agent": False,
+                "timeout": timeout,
+                "banner_timeout": timeout,
+                "auth_timeout": timeout
             }
 
             # Use the private key for authentication if specified
@@ -227,6 +438,7 @@ class SCPStorage:
             ssh_client.connect(self.host, **ssh_connect_kwargs)
 
             sftp = ssh_client.open_sftp()
+            sftp.get_channel().settimeout(timeout)
             yield ssh_client, sftp
         except SSHException as e:
             module_logger.error(f'SSH connection error: {e}')
@@ -238,34 +450,63 @@ class SCPStorage:
 
 
 class LocalStorage:
-    def __init__(self, storage_config):
-        self.base_url = storage_config.get("base_url", "")
+    def __init__(self, storage_config, skip_if_present=False, hash_index=None):
+        self.base_url = storage_config.base_url
+        self.skip_if_present = skip_if_present and hash_index is not None
+        self.hash_index = hash_index
+        # destination path -> checksums of the bytes copied there by this instance.
+        self.upload_checksums = {}
 
     def ensure_destination_directory_exists(self, destination_directory):
         """Ensure the local directory structure exists."""
         if not os.path.exists(destination_directory):
             os.makedirs(destination_directory)
 
-    def upload_file(self, source_file_path, destination_file_path, destination_generated_path, max_attempts=None):
+    def upload_file(self, source_file_path, destination_file_path, destination_generated_path, max_attempts=None, timeout=None):
         """Copies a file to the local storage with a date-based directory structure."""
         if not os.path.exists(source_file_path) or not os.path.isfile(source_file_path):
             logging.error(f'Source file {source_file_path} does not exist or is not a file.')
             return False
 
         try:
-            self.ensure_destination_directory_exists(os.path.dirname(destination_file_path))
+            data, checksums = read_with_checksums(source_file_path)
+            if (self.skip_if_present and os.path.isfile(destination_file_path)
+                    and os.path.getsize(destination_file_path) == len(data)
+                    and self.hash_index.matches("local", destination_file_path, checksums["md5"], len(data))):
+                module_logger.debug(f"<<Archive>> {destination_file_path} already present with matching size and hash, skipping copy.")
+                self.upload_checksums[destination_file_path] = checksums
+                return self.file_url(destination_file_path, destination_generated_path)
 
-            shutil.copy(source_file_path, destination_file_path)
-
-            # Encode the basename of the local_audio_path to ensure it's URL-safe
-            encoded_file_name = quote(os.path.basename(destination_file_path))
+            self.ensure_destination_directory_exists(os.path.dirname(destination_file_path))
+            with open(destination_file_path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                written_size = os.fstat(f.fileno()).st_size
+            if written_size != len(data):
+                raise UploadVerificationError(f"wrote {written_size} of {len(data)} bytes")
+            shutil.copymode(source_file_path, destination_file_path)
 
-            # First, join the base URL with the current_date
-            url_with_date = urljoin(self.base_url + '/', destination_generated_path + '/')
+            if self.skip_if_present:
+                self.hash_index.record("local", destination_file_path, checksums["md5"], len(data))
 
-            # Then, join the result with the encoded file name
-            return urljoin(url_with_date, encoded_file_name)
+            self.upload_checksums[destination_file_path] = checksums
+            return self.file_url(destination_file_path, destination_generated_path)
 
         except Exception as error:  # Preferably catch more specific exceptions
             logging.warning(f'Local Archive Failed: {error}')
             return False
+
+    def file_url(self, destination_file_path, destination_generated_path):
+        """Public URL of an archived file under base_url."""
+        return _base_url_file_url(self.base_url, destination_file_path, destination_generated_path)
+
+
+def _base_url_file_url(base_url, destination_file_path, destination_generated_path):
+    # Encode the basename of the local_audio_path to ensure it's URL-safe
+    encoded_file_name = quote(os.path.basename(destination_file_path))
+
+    # First, join the base URL with the current_date
+    url_with_date = urljoin(base_url + '/', destination_generated_path + '/')
+
+    # Then, join the result with the encoded file name
+    return urljoin(url_with_date, encoded_file_name)
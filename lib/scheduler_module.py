@@ -0,0 +1,156 @@
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+module_logger = logging.getLogger('tr_rdio_uploader.scheduler')
+
+# Seconds a call is assumed to take before a system has any completed calls to go by.
+INITIAL_COST_ESTIMATE = 5.0
+# Weight of the latest call when updating a system's average call time.
+COST_SMOOTHING = 0.2
+
+
+class _SystemQueue:
+    def __init__(self):
+        self.calls = deque()
+        self.virtual_time = 0.0
+        self.average_cost = INITIAL_COST_ESTIMATE
+        self.in_flight = 0
+
+
+class FairCallScheduler:
+    """
+    Weighted fair queue of calls across radio systems, used in place of a single FIFO in watch
+    mode so a busy system can't starve a quiet one.
+
+    Each system has its own FIFO and a virtual time that advances by the processing time it
+    uses divided by its weight. Workers always take the next call from the waiting system with
+    the lowest virtual time. A system with weight 2 therefore gets about twice the worker time
+    of a system with weight 1 while both have calls waiting. A system that has been idle starts
+    again level with the busiest one and doesn't bank credit while idle.
+
+    Processing time is charged when a call is handed out, using the system's average call time,
+    and corrected when the worker reports the actual time in task_done().
+
+    put_later() holds a call back until a retry delay has passed, so a worker can hand back a
+    call to retry and move on instead of sleeping. Held calls join the queue when they are due
+    and are not counted by empty() or qsize() until then.
+
+    The put/get/empty/qsize interface matches queue.Queue. task_done takes the finished call
+    and its processing time.
+
+    :param weight_for: Callable returning the weight of a short_name, read on every dispatch so
+                       config reloads apply.
+    """
+
+    def __init__(self, weight_for):
+        self.weight_for = weight_for
+        self._systems = {}
+        self._queued_calls = 0
+        self._delayed_calls = []
+        self._delayed_order = itertools.count()
+        self._condition = threading.Condition()
+
+    def _active_virtual_time(self):
+        """Lowest virtual time among systems with calls waiting or in flight. Caller holds the lock."""
+        active_times = [system.virtual_time for system in self._systems.values() if system.calls or system.in_flight]
+        return min(active_times) if active_times else 0.0
+
+    def _add(self, call):
+        """Queue a call. Caller holds the lock."""
+        short_name = call["short_name"]
+        system = self._systems.get(short_name)
+        if system is None:
+            system = self._systems[short_name] = _SystemQueue()
+        if not system.calls and not system.in_flight:
+            system.virtual_time = max(system.virtual_time, self._active_virtual_time())
+
+        system.calls.append(call)
+        self._queued_calls += 1
+        self._condition.notify()
+
+    def put(self, call):
+        with self._condition:
+            self._add(call)
+
+    def put_later(self, call, delay_seconds):
+        """Queue call once delay_seconds have passed, e.g. to retry a stage without holding a worker."""
+        with self._condition:
+            heapq.heappush(self._delayed_calls, (time.monotonic() + delay_seconds, next(self._delayed_order), call))
+            self._condition.notify()
+
+    def _queue_due_calls(self):
+        """
+        Move held calls that are due into the queue. Caller holds the lock.
+
+        :return: Seconds until the next held call is due, or None if none are held.
+        """
+        now = time.monotonic()
+        while self._delayed_calls and self._delayed_calls[0][0] <= now:
+            self._add(heapq.heappop(self._delayed_calls)[2])
+        return self._delayed_calls[0][0] - now if self._delayed_calls else None
+
+    def get(self, timeout=None):
+        """Next call by weighted fair share. Raises queue.Empty if none arrives within timeout."""
+        give_up_at = time.monotonic() + timeout if timeout is not None else None
+        with self._condition:
+            while True:
+                next_due = self._queue_due_calls()
+                if self._queued_calls > 0:
+                    break
+                wait_seconds = give_up_at - time.monotonic() if give_up_at is not None else None
+                if wait_seconds is not None and wait_seconds <= 0:
+                    raise queue.Empty
+                if next_due is not None:
+                    wait_seconds = next_due if wait_seconds is None else min(wait_seconds, next_due)
+                self._condition.wait(wait_seconds)
+
+            short_name, system = min(((name, system) for name, system in self._systems.items() if system.calls),
+                                     key=lambda item: item[1].virtual_time)
+            call = system.calls.popleft()
+            self._queued_calls -= 1
+            system.in_flight += 1
+            system.virtual_time += system.average_cost / self._weight(short_name)
+            return call
+
+    def task_done(self, call, processing_seconds):
+        """Record that a call from get() finished and how long it took."""
+        short_name = call["short_name"]
+        with self._condition:
+            system = self._systems[short_name]
+            system.in_flight -= 1
+            system.virtual_time += (processing_seconds - system.average_cost) / self._weight(short_name)
+            system.average_cost += COST_SMOOTHING * (processing_seconds - system.average_cost)
+
+            # Forget idle systems so the table doesn't grow with every short_name ever seen.
+            if not system.calls and not system.in_flight and system.virtual_time <= self._active_virtual_time():
+                del self._systems[short_name]
+
+    def _weight(self, short_name):
+        try:
+            weight = float(self.weight_for(short_name))
+        except (TypeError, ValueError):
+            weight = 1.0
+        return weight if weight > 0 else 1.0
+
+    def empty(self):
+        with self._condition:
+            return self._queued_calls == 0
+
+    def qsize(self):
+        with self._condition:
+            return self._queued_calls
+
+    def delayed_count(self):
+        """Calls held back by put_later() that are not due yet."""
+        with self._condition:
+            return len(self._delayed_calls)
+
+    def queued_by_system(self):
+        """Calls waiting per short_name, for logging."""
+        with self._condition:
+            return {name: len(system.calls) for name, system in self._systems.items() if system.calls}
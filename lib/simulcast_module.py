@@ -0,0 +1,188 @@
+import logging
+import threading
+import time
+import wave
+
+import numpy as np
+
+module_logger = logging.getLogger('tr_rdio_uploader.simulcast')
+
+FINGERPRINT_FRAME_MS = 32
+FINGERPRINT_BANDS = 17
+# Voice band covered by the fingerprint. Each site's audio differs outside it (hum, hiss, codec edges).
+FINGERPRINT_LOW_HZ = 300
+FINGERPRINT_HIGH_HZ = 3400
+# Fraction of the shorter call that must overlap for two fingerprints to be compared.
+MIN_OVERLAP_FRACTION = 0.5
+
+
+def compute_fingerprint(wav_path):
+    """
+    Compact audio fingerprint of a call WAV.
+
+    The audio is cut into FINGERPRINT_FRAME_MS frames and split into FINGERPRINT_BANDS bands.
+    Each bit records whether the energy difference between two neighbouring bands rose or fell
+    from one frame to the next. That holds up across sites whose audio differs in level, noise and
+    codec artifacts. Each frame packs into 2 bytes.
+
+    :return: uint8 array of shape (frames, 2), or None if the call is too short to fingerprint.
+    """
+    with wave.open(wav_path, 'rb') as wav_file:
+        channels = wav_file.getnchannels()
+        sample_width = wav_file.getsampwidth()
+        sample_rate = wav_file.getframerate()
+        raw_audio = wav_file.readframes(wav_file.getnframes())
+
+    if sample_width == 1:
+        samples = np.frombuffer(raw_audio, dtype=np.uint8).astype(np.float32) - 128
+    elif sample_width == 2:
+        samples = np.frombuffer(raw_audio, dtype='<i2').astype(np.float32)
+    elif sample_width == 4:
+        samples = np.frombuffer(raw_audio, dtype='<i4').astype(np.float32)
+    else:
+        module_logger.warning(f"<<Simulcast>> Unsupported sample width {sample_width} in {wav_path}.")
+        return None
+
+    if channels > 1:
+        samples = samples[:len(samples) - len(samples) % channels].reshape(-1, channels).mean(axis=1)
+
+    frame_length = int(sample_rate * FINGERPRINT_FRAME_MS / 1000)
+    frame_count = len(samples) // frame_length if frame_length else 0
+    if frame_count < 3:
+        return None
+
+    frames = samples[:frame_count * frame_length].reshape(frame_count, frame_length) * np.hanning(frame_length)
+    power_spectrum = np.abs(np.fft.rfft(frames, axis=1)) ** 2
+
+    band_edges = np.linspace(FINGERPRINT_LOW_HZ, min(FINGERPRINT_HIGH_HZ, sample_rate / 2), FINGERPRINT_BANDS + 1)
+    band_bins = np.clip((band_edges * frame_length / sample_rate).astype(int), 0, power_spectrum.shape[1] - 1)
+    band_energy = np.stack([power_spectrum[:, band_bins[i]:max(band_bins[i + 1], band_bins[i] + 1)].sum(axis=1)
+                            for i in range(FINGERPRINT_BANDS)], axis=1)
+
+    band_difference = band_energy[:, :-1] - band_energy[:, 1:]
+    bits = (band_difference[1:] - band_difference[:-1]) > 0
+
+    return np.packbits(bits, axis=1)
+
+
+def fingerprint_bit_error_rate(first_fingerprint, second_fingerprint, max_offset_frames):
+    """
+    Lowest fraction of differing bits between two fingerprints over alignments up to
+    max_offset_frames apart, or 1.0 if they never overlap enough to compare.
+    """
+    minimum_overlap = max(1, int(min(len(first_fingerprint), len(second_fingerprint)) * MIN_OVERLAP_FRACTION))
+    best_rate = 1.0
+
+    for offset in range(-max_offset_frames, max_offset_frames + 1):
+        if offset >= 0:
+            first_part, second_part = first_fingerprint[offset:], second_fingerprint
+        else:
+            first_part, second_part = first_fingerprint, second_fingerprint[-offset:]
+
+        overlap = min(len(first_part), len(second_part))
+        if overlap < minimum_overlap:
+            continue
+
+        differing_bits = np.unpackbits(np.bitwise_xor(first_part[:overlap], second_part[:overlap])).sum()
+        best_rate = min(best_rate, differing_bits / (overlap * first_part.shape[1] * 8))
+
+    return best_rate
+
+
+def call_signal_quality(call_data):
+    """
+    Higher is better. Uses trunk-recorder's signal/noise levels when the call JSON has them,
+    otherwise the decode error and spike counts across the call's frequencies.
+    """
+    if call_data.get("signal") is not None and call_data.get("noise") is not None:
+        return float(call_data["signal"]) - float(call_data["noise"])
+
+    return -sum(freq.get("error_count", 0) + freq.get("spike_count", 0) for freq in call_data.get("freqList", []))
+
+
+class SimulcastEntry:
+    """A call recently seen by the index. archive_urls is filled in once the kept call is archived."""
+
+    def __init__(self, talkgroup, start_time, fingerprint, quality, wav_path, short_name=None):
+        self.talkgroup = talkgroup
+        self.start_time = start_time
+        self.fingerprint = fingerprint
+        self.quality = quality
+        self.wav_path = wav_path
+        self.short_name = short_name
+        self.archive_urls = {}
+        self.seen_at = time.monotonic()
+
+
+class SimulcastIndex:
+    """
+    Short-lived in-memory index of recent calls by talkgroup, used to spot the same transmission
+    recorded by more than one site. Entries older than the TTL are evicted on each lookup.
+    Shared by the worker threads of one uploader process.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _evict(self, ttl_seconds):
+        cutoff = time.monotonic() - ttl_seconds
+        for talkgroup in list(self._entries):
+            live_entries = [entry for entry in self._entries[talkgroup] if entry.seen_at >= cutoff]
+            if live_entries:
+                self._entries[talkgroup] = live_entries
+            else:
+                del self._entries[talkgroup]
+
+    def check_and_add(self, dedup_config, call_data, wav_path):
+        """
+        Look for an earlier recording of this call and decide what to do with it.
+
+        :param dedup_config: SimulcastDedupConfig.
+        :return: Tuple of (entry for this call, or None if it is a duplicate to suppress;
+                 entry of the matching earlier call, or None if there is no match).
+        """
+        try:
+            fingerprint = compute_fingerprint(wav_path)
+        except (wave.Error, EOFError, OSError) as e:
+            module_logger.warning(f"<<Simulcast>> Unable to fingerprint {wav_path}, not checking for duplicates: {e}")
+            fingerprint = None
+
+        talkgroup = call_data.get("talkgroup")
+        start_time = call_data.get("start_time", 0)
+        quality = call_signal_quality(call_data)
+        new_entry = SimulcastEntry(talkgroup, start_time, fingerprint, quality, wav_path, call_data.get("short_name"))
+
+        if fingerprint is None or talkgroup is None:
+            return new_entry, None
+
+        max_offset_frames = int(dedup_config.start_time_window_seconds * 1000 / FINGERPRINT_FRAME_MS)
+
+        with self._lock:
+            self._evict(dedup_config.ttl_seconds)
+            talkgroup_entries = self._entries.setdefault(talkgroup, [])
+
+            for entry in talkgroup_entries:
+                if entry.wav_path == wav_path:
+                    # A retry of a call already kept, not another site's copy of it.
+                    return entry, None
+                if abs(entry.start_time - start_time) > dedup_config.start_time_window_seconds:
+                    continue
+                if entry.fingerprint is None:
+                    continue
+                if fingerprint_bit_error_rate(entry.fingerprint, fingerprint, max_offset_frames) > dedup_config.max_bit_error_rate:
+                    continue
+
+                if dedup_config.keep == "best_signal" and quality > entry.quality:
+                    # This copy is better. It is processed and becomes the one later copies are compared to.
+                    talkgroup_entries.remove(entry)
+                    talkgroup_entries.append(new_entry)
+                    return new_entry, entry
+
+                return None, entry
+
+            talkgroup_entries.append(new_entry)
+            return new_entry, None
+
+
+simulcast_index = SimulcastIndex()
@@ -0,0 +1,150 @@
+import fcntl
+import logging
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+
+from lib.audio_file_handler import save_temporary_file
+
+module_logger = logging.getLogger('tr_rdio_uploader.staging')
+
+STAGING_DIRECTORY_NAME = "tr_rdio_staging"
+
+# Room left for the m4a written next to the staged WAV, as a fraction of the WAV size.
+M4A_SIZE_ALLOWANCE = 0.5
+
+
+class StagingArea:
+    """
+    Per-call working directories in tmpfs (temp_file_path) for the WAV/JSON and everything
+    derived from them, so encoding doesn't read and write the recorder's capture disk.
+
+    Space is reserved against memory_budget_mb before a call is staged. Reservations are
+    marker files in the staging root, guarded by a file lock, so the budget holds across the
+    worker threads of one uploader and across separate uploader processes. When the budget
+    is full a call waits up to max_wait_seconds for space, then falls back to working in place
+    on disk.
+
+    :param staging_config: StagingConfig.
+    :param temp_file_path: tmpfs mount to stage under, normally /dev/shm.
+    """
+
+    def __init__(self, staging_config, temp_file_path):
+        self.enabled = staging_config.enabled and bool(temp_file_path)
+        self.budget_bytes = int(staging_config.memory_budget_mb * 1024 * 1024)
+        self.max_wait_seconds = staging_config.max_wait_seconds
+        self.keep_m4a = staging_config.keep_m4a
+        self.staging_root = os.path.join(temp_file_path or "", STAGING_DIRECTORY_NAME)
+        self.lock_path = os.path.join(self.staging_root, ".lock")
+
+    def _reserved_bytes(self):
+        """Bytes reserved by live calls. Reservations left behind by dead processes are removed."""
+        reserved_bytes = 0
+        with os.scandir(self.staging_root) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".reservation"):
+                    continue
+                try:
+                    with open(entry.path, 'r') as f:
+                        pid, reservation_bytes = f.read().split()
+                    os.kill(int(pid), 0)
+                    reserved_bytes += int(reservation_bytes)
+                except ProcessLookupError:
+                    module_logger.warning(f"<<Staging>> Removing stale reservation {entry.name}")
+                    self._release(entry.path[:-len(".reservation")])
+                except (OSError, ValueError):
+                    continue
+        return reserved_bytes
+
+    def _try_reserve(self, reservation_bytes):
+        """Reserve space for a call. Returns the call's staging directory, or None if the budget is full."""
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if self._reserved_bytes() + reservation_bytes > self.budget_bytes:
+                    return None
+
+                filesystem = os.statvfs(self.staging_root)
+                if filesystem.f_bavail * filesystem.f_frsize < reservation_bytes:
+                    return None
+
+                call_directory = os.path.join(self.staging_root, f"{os.getpid()}-{uuid.uuid4().hex}")
+                with open(f"{call_directory}.reservation", 'w') as f:
+                    f.write(f"{os.getpid()} {reservation_bytes}")
+                os.makedirs(call_directory)
+                return call_directory
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _release(call_directory):
+        shutil.rmtree(call_directory, ignore_errors=True)
+        try:
+            os.remove(f"{call_directory}.reservation")
+        except FileNotFoundError:
+            pass
+
+    def _reserve(self, reservation_bytes, max_wait_seconds):
+        """Wait up to max_wait_seconds for budget. Returns the staging directory or None to fall back to disk."""
+        if reservation_bytes > self.budget_bytes:
+            module_logger.warning(f"<<Staging>> Call needs {reservation_bytes} bytes, more than the whole staging budget.")
+            return None
+
+        give_up_at = time.monotonic() + max_wait_seconds
+        wait_seconds = 0.05
+        while True:
+            call_directory = self._try_reserve(reservation_bytes)
+            if call_directory or time.monotonic() >= give_up_at:
+                return call_directory
+            time.sleep(min(wait_seconds, max(0.0, give_up_at - time.monotonic())))
+            wait_seconds = min(wait_seconds * 2, 1.0)
+
+    @contextmanager
+    def stage_call(self, wav_file_path, json_file_path, max_wait_seconds=None):
+        """
+        Copy a call's WAV and JSON into a tmpfs working directory for the duration of the block.
+
+        Yields the directory to work in: the staging directory, or the WAV's own directory when
+        staging is disabled or the budget stayed full. The staging directory is removed on exit,
+        after copying the m4a back next to the WAV if keep_m4a is set.
+
+        :param max_wait_seconds: Cap on the backpressure wait, e.g. the remaining call budget.
+        """
+        source_path = os.path.dirname(wav_file_path)
+        if not self.enabled:
+            yield source_path
+            return
+
+        call_directory = None
+        try:
+            os.makedirs(self.staging_root, exist_ok=True)
+            wav_size = os.path.getsize(wav_file_path)
+            reservation_bytes = int(wav_size * (1 + M4A_SIZE_ALLOWANCE)) + os.path.getsize(json_file_path)
+
+            wait_limit = self.max_wait_seconds if max_wait_seconds is None else min(self.max_wait_seconds, max_wait_seconds)
+            call_directory = self._reserve(reservation_bytes, wait_limit)
+            if call_directory is None:
+                module_logger.warning(f"<<Staging>> Budget full, processing {os.path.basename(wav_file_path)} on disk.")
+            else:
+                save_temporary_file(call_directory, wav_file_path)
+                save_temporary_file(call_directory, json_file_path)
+        except OSError as e:
+            if call_directory:
+                self._release(call_directory)
+                call_directory = None
+            module_logger.warning(f"<<Staging>> Unable to stage {wav_file_path}, processing on disk: {e}")
+
+        if call_directory is None:
+            yield source_path
+            return
+
+        try:
+            yield call_directory
+            if self.keep_m4a:
+                staged_m4a_path = os.path.join(call_directory, os.path.basename(wav_file_path).replace(".wav", ".m4a"))
+                if os.path.isfile(staged_m4a_path):
+                    shutil.copy(staged_m4a_path, source_path)
+        finally:
+            self._release(call_directory)
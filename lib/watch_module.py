@@ -0,0 +1,362 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from inotify_simple import INotify, flags
+
+from lib.archive_module import flush_metadata_segments, start_metadata_segment_flusher
+from lib.call_processing_module import process_call, resume_stages
+from lib.deadline_module import RetryScheduler
+from lib.scheduler_module import FairCallScheduler
+from lib.work_queue_module import get_work_queue, start_lease_workers
+
+module_logger = logging.getLogger('tr_rdio_uploader.watch')
+
+WATCH_FLAGS = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.DELETE_SELF
+
+
+class ProcessedLedger:
+    """
+    Append-only record of call JSON paths that have been processed, so the startup scan only
+    enqueues calls that were missed while the uploader was down.
+
+    Each line is "<processed epoch>\\t<json path>". Entries older than max_age_seconds are
+    dropped when the ledger is loaded.
+    """
+
+    def __init__(self, ledger_path, max_age_seconds):
+        self.ledger_path = ledger_path
+        self.max_age_seconds = max_age_seconds
+        self._lock = threading.Lock()
+        self._processed = set()
+        self._load()
+
+    def _load(self):
+        if not self.ledger_path:
+            return
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.ledger_path)), exist_ok=True)
+        if not os.path.exists(self.ledger_path):
+            return
+
+        cutoff = time.time() - self.max_age_seconds
+        kept_lines = []
+        with open(self.ledger_path, 'r') as f:
+            for line in f:
+                try:
+                    processed_at, json_path = line.rstrip("\n").split("\t", 1)
+                    if float(processed_at) >= cutoff:
+                        self._processed.add(json_path)
+                        kept_lines.append(line)
+                except ValueError:
+                    continue
+
+        # Compact the ledger so it only holds entries still inside the scan window.
+        temp_path = f"{self.ledger_path}.tmp"
+        with open(temp_path, 'w') as f:
+            f.writelines(kept_lines)
+        os.replace(temp_path, self.ledger_path)
+
+        module_logger.debug(f"Loaded {len(self._processed)} processed calls from ledger {self.ledger_path}")
+
+    def __contains__(self, json_path):
+        with self._lock:
+            return json_path in self._processed
+
+    def mark_processed(self, json_path):
+        with self._lock:
+            self._processed.add(json_path)
+            if self.ledger_path:
+                with open(self.ledger_path, 'a') as f:
+                    f.write(f"{time.time()}\t{json_path}\n")
+
+
+class CallWatcher:
+    """
+    Watches trunk-recorder capture directories with inotify and enqueues completed calls.
+
+    trunk-recorder writes the call JSON after the WAV is closed, so a close-write (or move into
+    place) of a .json file is treated as the commit marker for the .wav/.json pair.
+
+    :param capture_paths: trunk-recorder captureDir paths. Calls are expected under <path>/<short_name>/Y/M/D.
+    :param call_queue: FairCallScheduler that receives initial call data dicts for process_call.
+    :param short_name: System short name for every call. When None it is taken from the first
+                       directory below the capture path, as trunk-recorder lays them out.
+    :param ledger: Optional ProcessedLedger used to skip calls that are already done.
+    """
+
+    def __init__(self, capture_paths, call_queue, short_name=None, ledger=None):
+        self.capture_paths = [os.path.abspath(path) for path in capture_paths]
+        self.call_queue = call_queue
+        self.short_name = short_name
+        self.ledger = ledger
+        self.inotify = INotify()
+        self._watch_paths = {}
+        self._queued = set()
+        self._queued_lock = threading.Lock()
+
+    def _short_name_for(self, wav_path):
+        if self.short_name:
+            return self.short_name
+
+        for capture_path in self.capture_paths:
+            relative_path = os.path.relpath(wav_path, capture_path)
+            if not relative_path.startswith(".."):
+                return relative_path.split(os.sep, 1)[0]
+        return None
+
+    def enqueue_call(self, json_path):
+        """Queue the call whose JSON is at json_path if its WAV is present and it is not already done."""
+        wav_path = json_path[:-len(".json")] + ".wav"
+
+        if self.ledger is not None and json_path in self.ledger:
+            return False
+
+        if not os.path.isfile(wav_path):
+            module_logger.warning(f"<<Watch>> Call JSON {json_path} has no matching WAV. Skipping.")
+            return False
+
+        short_name = self._short_name_for(wav_path)
+        if not short_name:
+            module_logger.warning(f"<<Watch>> Could not determine system short name for {wav_path}. Skipping.")
+            return False
+
+        with self._queued_lock:
+            if json_path in self._queued:
+                return False
+            self._queued.add(json_path)
+
+        self.call_queue.put({"short_name": short_name, "audio_wav_path": wav_path})
+        return True
+
+    def call_finished(self, json_path, success):
+        """Called by workers when a queued call is done so it can be queued again if it shows up later."""
+        with self._queued_lock:
+            self._queued.discard(json_path)
+        if success and self.ledger is not None:
+            self.ledger.mark_processed(json_path)
+
+    def scan_backlog(self, max_age_seconds):
+        """
+        Walk the capture directories with os.scandir and enqueue completed calls that are not in
+        the ledger, skipping JSON files older than max_age_seconds.
+
+        :return: Number of calls enqueued.
+        """
+        cutoff = time.time() - max_age_seconds if max_age_seconds else 0
+        enqueued = 0
+
+        pending_dirs = list(self.capture_paths)
+        while pending_dirs:
+            directory = pending_dirs.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending_dirs.append(entry.path)
+                        elif entry.name.endswith(".json") and entry.stat().st_mtime >= cutoff:
+                            if self.enqueue_call(entry.path):
+                                enqueued += 1
+            except (FileNotFoundError, PermissionError) as e:
+                module_logger.warning(f"<<Watch>> Unable to scan {directory}: {e}")
+
+        module_logger.info(f"<<Watch>> Backlog scan enqueued {enqueued} calls.")
+        return enqueued
+
+    def _add_watch_tree(self, root_path):
+        """Add inotify watches to root_path and every directory below it."""
+        for directory, sub_directories, _ in os.walk(root_path):
+            try:
+                watch_descriptor = self.inotify.add_watch(directory, WATCH_FLAGS)
+                self._watch_paths[watch_descriptor] = directory
+            except OSError as e:
+                module_logger.warning(f"<<Watch>> Unable to watch {directory}: {e}")
+
+    def start_watching(self):
+        """Add watches on the capture directories. Call before scan_backlog so nothing falls between the two."""
+        for capture_path in self.capture_paths:
+            self._add_watch_tree(capture_path)
+        module_logger.info(f"<<Watch>> Watching {len(self._watch_paths)} directories under {', '.join(self.capture_paths)}")
+
+    def run(self, stop_event, max_age_seconds=0):
+        """Process inotify events until stop_event is set."""
+        while not stop_event.is_set():
+            for event in self.inotify.read(timeout=1000):
+                event_flags = flags.from_mask(event.mask)
+
+                if flags.Q_OVERFLOW in event_flags:
+                    module_logger.warning("<<Watch>> inotify queue overflowed. Rescanning capture directories.")
+                    self.scan_backlog(max_age_seconds)
+                    continue
+
+                directory = self._watch_paths.get(event.wd)
+                if directory is None:
+                    continue
+
+                if flags.DELETE_SELF in event_flags:
+                    self._watch_paths.pop(event.wd, None)
+                    continue
+
+                event_path = os.path.join(directory, event.name)
+                if flags.ISDIR in event_flags:
+                    if flags.CREATE in event_flags or flags.MOVED_TO in event_flags:
+                        # New day directories are created while we run. Files may land in them
+                        # before the watch is added, so sweep the new tree once.
+                        self._add_watch_tree(event_path)
+                        for sub_directory, _, file_names in os.walk(event_path):
+                            for file_name in file_names:
+                                if file_name.endswith(".json"):
+                                    self.enqueue_call(os.path.join(sub_directory, file_name))
+                    continue
+
+                if event.name.endswith(".json") and (flags.CLOSE_WRITE in event_flags or flags.MOVED_TO in event_flags):
+                    self.enqueue_call(event_path)
+
+        self.inotify.close()
+
+
+class WorkQueueFeeder:
+    """
+    Takes the place of the local scheduler when distributed.enabled is set. Calls go straight
+    into the shared work queue, where this node's workers and any worker mode nodes claim them.
+    Once a call is in the queue it is no longer this watcher's to track, so it is marked in the
+    ledger right away.
+    """
+
+    def __init__(self, work_queue):
+        self.work_queue = work_queue
+        self.watcher = None
+
+    def put(self, call):
+        wav_path = call["audio_wav_path"]
+        try:
+            if self.work_queue.enqueue(call["short_name"], wav_path):
+                module_logger.debug(f"<<Watch>> Queued {wav_path} for the cluster.")
+            success = True
+        except sqlite3.Error as e:
+            module_logger.error(f"<<Watch>> Unable to add {wav_path} to the work queue: {e}")
+            success = False
+        self.watcher.call_finished(wav_path[:-len(".wav")] + ".json", success)
+
+    def empty(self):
+        return True
+
+    def qsize(self):
+        return 0
+
+    def delayed_count(self):
+        return 0
+
+
+def _retry_later(call_queue, initial_call_data, call_data, config_data):
+    """
+    Hand a call whose archive needs another attempt back to the queue after the archive retry delay.
+
+    :return: True if the call was queued again, False if it is out of attempts.
+    """
+    archive_config = config_data.for_system(initial_call_data["short_name"]).archive
+    attempt = initial_call_data.get("attempt", 1)
+    delay = RetryScheduler(max_attempts=archive_config.max_attempts,
+                           retry_delay=archive_config.retry_delay).retry_delay_after(attempt)
+    wav_path = initial_call_data["audio_wav_path"]
+    if delay is None:
+        module_logger.error(f"<<Watch>> Giving up on {', '.join(call_data['retry_stages'])} for {wav_path} after {attempt} attempts.")
+        return False
+
+    module_logger.warning(f"<<Watch>> Retrying {', '.join(call_data['retry_stages'])} for {wav_path} in {delay}s.")
+    call_queue.put_later(dict(initial_call_data, stages=resume_stages(wav_path, call_data["retry_stages"]),
+                              attempt=attempt + 1), delay)
+    return True
+
+
+def _call_worker(call_queue, watcher, config_manager, stop_event):
+    while not stop_event.is_set() or not call_queue.empty():
+        try:
+            initial_call_data = call_queue.get(timeout=1)
+        except queue.Empty:
+            continue
+
+        wav_path = initial_call_data["audio_wav_path"]
+        json_path = wav_path[:-len(".wav")] + ".json"
+        success = False
+        retrying = False
+        start_time = time.monotonic()
+        try:
+            module_logger.info(f"Processing Call {wav_path}")
+            # Each call runs with the config current when it starts, so reloads apply between calls.
+            config_data = config_manager.current
+            call_data = process_call(initial_call_data, config_data, stages=initial_call_data.get("stages"))
+            if call_data and call_data.get("retry_stages"):
+                # Requeued rather than waited for here, so this worker moves on to the next call.
+                retrying = _retry_later(call_queue, initial_call_data, call_data, config_data)
+            else:
+                success = True
+                module_logger.info(f"Completed Processing Call {wav_path} in {time.monotonic() - start_time:.2f} seconds.")
+        except Exception as e:
+            module_logger.error(f"Unexpected error when processing file {wav_path}: {e}")
+        finally:
+            # A call waiting for a retry is still queued, so another event for it doesn't queue it twice.
+            if not retrying:
+                watcher.call_finished(json_path, success)
+            call_queue.task_done(initial_call_data, time.monotonic() - start_time)
+
+
+def run_watch_mode(config_manager, capture_paths, short_name=None, stop_event=None):
+    """
+    Run the directory-watch ingest loop: sweep the backlog, then process calls as trunk-recorder
+    completes them, until stop_event is set.
+
+    :param config_manager: ConfigManager. The watch settings are read once at startup; calls use
+                           whichever config is current when they start.
+    :param capture_paths: Directories to watch. Falls back to watch.capture_paths from config.
+    :param short_name: Optional system short name applied to every call.
+    :param stop_event: threading.Event that ends the loop. Queued calls are drained before returning.
+    """
+    watch_config = config_manager.current.watch
+    capture_paths = capture_paths or watch_config.capture_paths
+    if not capture_paths:
+        raise ValueError("No capture paths given to watch.")
+
+    stop_event = stop_event or threading.Event()
+    max_age_seconds = watch_config.scan_max_age_hours * 3600
+
+    ledger = ProcessedLedger(watch_config.ledger_path, max_age_seconds)
+    workers = []
+    if config_manager.current.distributed.enabled:
+        # Calls are claimed from the shared queue in arrival order, by this node and any worker mode nodes.
+        call_queue = WorkQueueFeeder(get_work_queue(config_manager.current.distributed))
+        watcher = call_queue.watcher = CallWatcher(capture_paths, call_queue, short_name, ledger)
+        join_workers = start_lease_workers(call_queue.work_queue, config_manager, watch_config.workers, stop_event)
+    else:
+        # Calls are shared out across systems by watch.system_weights, read from the current config on every dispatch.
+        call_queue = FairCallScheduler(lambda name: dict(config_manager.current.watch.system_weights).get(name, 1.0))
+        watcher = CallWatcher(capture_paths, call_queue, short_name, ledger)
+        join_workers = None
+
+        for worker_number in range(max(1, watch_config.workers)):
+            worker = threading.Thread(target=_call_worker, args=(call_queue, watcher, config_manager, stop_event),
+                                      name=f"CallWorker-{worker_number}", daemon=True)
+            worker.start()
+            workers.append(worker)
+
+    start_metadata_segment_flusher(config_manager, stop_event)
+
+    try:
+        watcher.start_watching()
+        if watch_config.scan_on_startup:
+            watcher.scan_backlog(max_age_seconds)
+
+        watcher.run(stop_event, max_age_seconds)
+    finally:
+        stop_event.set()
+        module_logger.info(f"<<Watch>> Stopping. Waiting for {call_queue.qsize()} queued calls to finish.")
+        if call_queue.delayed_count():
+            module_logger.warning(f"<<Watch>> {call_queue.delayed_count()} calls waiting to retry are left for the next startup scan.")
+        for worker in workers:
+            worker.join()
+        if join_workers is not None:
+            join_workers()
+        flush_metadata_segments(config_manager.current.archive, config_manager.current.bandwidth)
@@ -0,0 +1,523 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from lib.archive_module import flush_metadata_segments, start_metadata_segment_flusher
+from lib.call_processing_module import process_call, call_archive_urls, resume_stages, CALL_STAGES
+
+module_logger = logging.getLogger('tr_rdio_uploader.work_queue')
+
+# Seconds an idle worker waits before looking for work again.
+CLAIM_POLL_SECONDS = 1.0
+# Seconds a failed call waits before it can be claimed again, multiplied by its attempts so far.
+RETRY_BACKOFF_SECONDS = 30
+# Seconds between deleting finished jobs older than retain_done_hours.
+PRUNE_INTERVAL_SECONDS = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    wav_path TEXT PRIMARY KEY,
+    short_name TEXT NOT NULL,
+    state TEXT NOT NULL,
+    owner TEXT,
+    token TEXT,
+    available_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    completed_stages TEXT NOT NULL DEFAULT '[]',
+    archive_urls TEXT NOT NULL DEFAULT '{}',
+    error TEXT,
+    enqueued_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, enqueued_at);
+"""
+
+
+class LeaseLostError(Exception):
+    """The lease on a call expired and another node claimed it."""
+    pass
+
+
+class WorkLease:
+    """
+    A claimed call. Only the holder of the current token can complete or release it.
+
+    :param completed_stages: Stages recorded as done by earlier attempts, including rdio_system_stage entries.
+    :param archive_urls: Archive URLs recorded by earlier attempts, as process_call takes them.
+    """
+
+    def __init__(self, wav_path, short_name, token, attempts, completed_stages, archive_urls):
+        self.wav_path = wav_path
+        self.short_name = short_name
+        self.token = token
+        self.attempts = attempts
+        self.completed_stages = set(completed_stages)
+        self.archive_urls = dict(archive_urls)
+        # Set by the lease keeper when a renewal finds the lease was taken over.
+        self.lost = False
+
+
+class SQLiteWorkQueue:
+    """
+    Work queue in a SQLite database, shared by every node that can open the same file.
+
+    Calls are claimed under a lease of lease_seconds, which the holder keeps renewing while it
+    works. When a node dies its leases run out and other nodes claim the calls again. A call
+    that has been claimed max_attempts times without finishing is marked failed.
+
+    Lease expiry uses the wall clock, so the nodes' clocks must be kept in sync. The database
+    uses a rollback journal rather than WAL so it works on a network filesystem, which must
+    support POSIX locks (NFSv4, or NFSv3 with lockd).
+
+    :param queue_path: Database file.
+    :param lease_seconds: Length of a lease.
+    :param max_attempts: Claims allowed per call before it is marked failed.
+    """
+
+    def __init__(self, queue_path, lease_seconds, max_attempts):
+        self.queue_path = queue_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(os.path.abspath(queue_path)), exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        """This thread's connection. sqlite3 connections can't be shared between threads."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.queue_path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=DELETE")
+            self._local.connection = connection
+        return connection
+
+    def _transaction(self):
+        """Connection with a write transaction already started, so the reads that follow can't race another node."""
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        return connection
+
+    def enqueue(self, short_name, wav_path):
+        """Add a call. Returns False if it is already queued, in progress or done."""
+        now = time.time()
+        cursor = self._connection().execute(
+            "INSERT OR IGNORE INTO jobs (wav_path, short_name, state, available_at, enqueued_at, updated_at) "
+            "VALUES (?, ?, 'pending', ?, ?, ?)", (wav_path, short_name, now, now, now))
+        return cursor.rowcount == 1
+
+    def claim(self, owner):
+        """
+        Lease the oldest waiting call, or one whose lease has run out.
+
+        :param owner: Name of the claiming node, recorded for logging.
+        :return: WorkLease, or None if nothing is waiting.
+        """
+        connection = self._transaction()
+        try:
+            while True:
+                now = time.time()
+                row = connection.execute(
+                    "SELECT wav_path, short_name, state, owner, attempts, completed_stages, archive_urls FROM jobs "
+                    "WHERE state IN ('pending', 'leased') AND available_at <= ? ORDER BY enqueued_at LIMIT 1",
+                    (now,)).fetchone()
+                if row is None:
+                    connection.execute("COMMIT")
+                    return None
+
+                wav_path, short_name, state, previous_owner, attempts, completed_stages, archive_urls = row
+                if attempts >= self.max_attempts:
+                    connection.execute("UPDATE jobs SET state = 'failed', owner = NULL, token = NULL, updated_at = ?, "
+                                       "error = COALESCE(error, 'lease expired') WHERE wav_path = ?", (now, wav_path))
+                    module_logger.error(f"<<Work Queue>> Giving up on {wav_path} after {attempts} attempts.")
+                    continue
+
+                token = uuid.uuid4().hex
+                connection.execute("UPDATE jobs SET state = 'leased', owner = ?, token = ?, available_at = ?, "
+                                   "attempts = attempts + 1, updated_at = ? WHERE wav_path = ?",
+                                   (owner, token, now + self.lease_seconds, now, wav_path))
+                connection.execute("COMMIT")
+
+                if state == "leased":
+                    module_logger.warning(f"<<Work Queue>> Lease on {wav_path} held by {previous_owner} expired. Taking it over.")
+                return WorkLease(wav_path, short_name, token, attempts + 1,
+                                 json.loads(completed_stages), json.loads(archive_urls))
+        except BaseException:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            raise
+
+    def renew(self, lease):
+        """Extend a lease. Returns False if it was lost to another node."""
+        now = time.time()
+        cursor = self._connection().execute(
+            "UPDATE jobs SET available_at = ?, updated_at = ? WHERE wav_path = ? AND token = ? AND state = 'leased'",
+            (now + self.lease_seconds, now, lease.wav_path, lease.token))
+        return cursor.rowcount == 1
+
+    def record_stage(self, lease, stage, archive_urls):
+        """
+        Record a finished stage, and renew the lease if it is still held. The stage is recorded
+        either way, since the work has been done whoever holds the lease now.
+
+        :return: False if the lease was lost to another node.
+        """
+        connection = self._transaction()
+        try:
+            now = time.time()
+            row = connection.execute("SELECT completed_stages, archive_urls, token FROM jobs WHERE wav_path = ?",
+                                     (lease.wav_path,)).fetchone()
+            if row is None:
+                connection.execute("COMMIT")
+                return False
+
+            completed_stages = set(json.loads(row[0])) | {stage}
+            recorded_urls = dict(json.loads(row[1]), **archive_urls)
+            held = row[2] == lease.token
+            connection.execute("UPDATE jobs SET completed_stages = ?, archive_urls = ?, updated_at = ?, "
+                               "available_at = CASE WHEN token = ? THEN ? ELSE available_at END WHERE wav_path = ?",
+                               (json.dumps(sorted(completed_stages)), json.dumps(recorded_urls), now,
+                                lease.token, now + self.lease_seconds, lease.wav_path))
+            connection.execute("COMMIT")
+            return held
+        except BaseException:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            raise
+
+    def complete(self, lease):
+        """Mark a call done. Returns False if the lease was lost to another node."""
+        cursor = self._connection().execute(
+            "UPDATE jobs SET state = 'done', owner = NULL, token = NULL, error = NULL, updated_at = ? "
+            "WHERE wav_path = ? AND token = ?", (time.time(), lease.wav_path, lease.token))
+        return cursor.rowcount == 1
+
+    def release(self, lease, error):
+        """Hand a call that failed back to the queue to be retried later, or mark it failed once it is out of attempts."""
+        now = time.time()
+        self._connection().execute(
+            "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "owner = NULL, token = NULL, available_at = ?, error = ?, updated_at = ? WHERE wav_path = ? AND token = ?",
+            (self.max_attempts, now + RETRY_BACKOFF_SECONDS * lease.attempts, error, now, lease.wav_path, lease.token))
+
+    def prune(self, max_age_seconds):
+        """Delete done and failed calls last updated more than max_age_seconds ago. Returns the number deleted."""
+        cursor = self._connection().execute("DELETE FROM jobs WHERE state IN ('done', 'failed') AND updated_at < ?",
+                                            (time.time() - max_age_seconds,))
+        return cursor.rowcount
+
+    def counts(self):
+        """Number of calls in each state, for logging."""
+        return dict(self._connection().execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+
+class MemoryWorkQueue:
+    """
+    In-process stand-in for SQLiteWorkQueue with the same interface and lease behaviour, for
+    running distributed mode on a single host or trying out another broker's semantics.
+
+    :param lease_seconds: Length of a lease.
+    :param max_attempts: Claims allowed per call before it is marked failed.
+    """
+
+    def __init__(self, lease_seconds, max_attempts):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def enqueue(self, short_name, wav_path):
+        with self._lock:
+            if wav_path in self._jobs:
+                return False
+            now = time.time()
+            self._jobs[wav_path] = {"short_name": short_name, "state": "pending", "owner": None, "token": None,
+                                    "available_at": now, "attempts": 0, "completed_stages": set(),
+                                    "archive_urls": {}, "error": None, "enqueued_at": now, "updated_at": now}
+            return True
+
+    def claim(self, owner):
+        with self._lock:
+            now = time.time()
+            waiting = sorted(((job["enqueued_at"], wav_path) for wav_path, job in self._jobs.items()
+                              if job["state"] in ("pending", "leased") and job["available_at"] <= now))
+            for _, wav_path in waiting:
+                job = self._jobs[wav_path]
+                if job["attempts"] >= self.max_attempts:
+                    job.update(state="failed", owner=None, token=None, updated_at=now, error=job["error"] or "lease expired")
+                    module_logger.error(f"<<Work Queue>> Giving up on {wav_path} after {job['attempts']} attempts.")
+                    continue
+
+                if job["state"] == "leased":
+                    module_logger.warning(f"<<Work Queue>> Lease on {wav_path} held by {job['owner']} expired. Taking it over.")
+                job.update(state="leased", owner=owner, token=uuid.uuid4().hex, available_at=now + self.lease_seconds,
+                           attempts=job["attempts"] + 1, updated_at=now)
+                return WorkLease(wav_path, job["short_name"], job["token"], job["attempts"],
+                                 job["completed_stages"], job["archive_urls"])
+            return None
+
+    def _held_job(self, lease):
+        """The job if lease is its current lease. Caller holds the lock."""
+        job = self._jobs.get(lease.wav_path)
+        return job if job is not None and job["token"] == lease.token else None
+
+    def renew(self, lease):
+        with self._lock:
+            job = self._held_job(lease)
+            if job is None or job["state"] != "leased":
+                return False
+            job["available_at"] = time.time() + self.lease_seconds
+            return True
+
+    def record_stage(self, lease, stage, archive_urls):
+        with self._lock:
+            job = self._jobs.get(lease.wav_path)
+            if job is None:
+                return False
+            job["completed_stages"].add(stage)
+            job["archive_urls"].update(archive_urls)
+            job["updated_at"] = time.time()
+            if self._held_job(lease) is None:
+                return False
+            job["available_at"] = job["updated_at"] + self.lease_seconds
+            return True
+
+    def complete(self, lease):
+        with self._lock:
+            job = self._held_job(lease)
+            if job is None:
+                return False
+            job.update(state="done", owner=None, token=None, error=None, updated_at=time.time())
+            return True
+
+    def release(self, lease, error):
+        with self._lock:
+            job = self._held_job(lease)
+            if job is None:
+                return
+            now = time.time()
+            job.update(state="failed" if job["attempts"] >= self.max_attempts else "pending", owner=None, token=None,
+                       available_at=now + RETRY_BACKOFF_SECONDS * lease.attempts, error=error, updated_at=now)
+
+    def prune(self, max_age_seconds):
+        with self._lock:
+            cutoff = time.time() - max_age_seconds
+            finished = [wav_path for wav_path, job in self._jobs.items()
+                        if job["state"] in ("done", "failed") and job["updated_at"] < cutoff]
+            for wav_path in finished:
+                del self._jobs[wav_path]
+            return len(finished)
+
+    def counts(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job["state"]] = counts.get(job["state"], 0) + 1
+            return counts
+
+
+def get_work_queue(distributed_config):
+    """The work queue for the configured distributed.backend."""
+    if distributed_config.backend == "memory":
+        return MemoryWorkQueue(distributed_config.lease_seconds, distributed_config.max_attempts)
+    return SQLiteWorkQueue(distributed_config.queue_path, distributed_config.lease_seconds, distributed_config.max_attempts)
+
+
+def node_name(distributed_config):
+    """This process's name in the queue: distributed.node_name, or <hostname>-<pid>."""
+    return distributed_config.node_name or f"{socket.gethostname()}-{os.getpid()}"
+
+
+class LeaseKeeper:
+    """
+    Renews the leases held by this process's workers every third of a lease, so a call that takes
+    longer than lease_seconds isn't taken over while it is still being worked on. Also prunes
+    finished jobs now and then.
+
+    :param retain_seconds: Age after which done and failed jobs are deleted. 0 keeps them.
+    """
+
+    def __init__(self, work_queue, lease_seconds, retain_seconds=0):
+        self.work_queue = work_queue
+        self.interval = lease_seconds / 3
+        self.retain_seconds = retain_seconds
+        self._leases = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="LeaseKeeper", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def hold(self, lease):
+        with self._lock:
+            self._leases.add(lease)
+
+    def drop(self, lease):
+        with self._lock:
+            self._leases.discard(lease)
+
+    def _run(self):
+        last_prune = 0.0
+        while not self._stop_event.wait(self.interval):
+            with self._lock:
+                leases = list(self._leases)
+            for lease in leases:
+                try:
+                    if not self.work_queue.renew(lease):
+                        lease.lost = True
+                        module_logger.warning(f"<<Work Queue>> Lost the lease on {lease.wav_path} to another node.")
+                except sqlite3.Error as e:
+                    module_logger.error(f"<<Work Queue>> Unable to renew the lease on {lease.wav_path}: {e}")
+
+            if self.retain_seconds and time.monotonic() - last_prune >= PRUNE_INTERVAL_SECONDS:
+                last_prune = time.monotonic()
+                try:
+                    pruned = self.work_queue.prune(self.retain_seconds)
+                    if pruned:
+                        module_logger.debug(f"<<Work Queue>> Pruned {pruned} finished calls.")
+                except sqlite3.Error as e:
+                    module_logger.error(f"<<Work Queue>> Unable to prune finished calls: {e}")
+
+
+def process_leased_call(work_queue, lease, config_data):
+    """
+    Run the stages of a claimed call that earlier attempts didn't finish, recording each as it
+    completes, then complete or release the lease.
+
+    Encode is redone when archive is still to do and no .m4a was kept next to the .wav, since
+    the earlier attempt's output was in that node's staging area. Once the lease is lost the
+    call stops before its next stage, and the node that took it over carries on from the
+    stages recorded so far.
+
+    :return: True if the call finished.
+    """
+    stages = resume_stages(lease.wav_path, [stage for stage in CALL_STAGES if stage not in lease.completed_stages])
+
+    if not stages:
+        return work_queue.complete(lease)
+
+    def stage_completed(stage, call_data):
+        if not work_queue.record_stage(lease, stage, call_archive_urls(call_data)) or lease.lost:
+            lease.lost = True
+            raise LeaseLostError(f"Lease on {lease.wav_path} was taken over after {stage}.")
+
+    initial_call_data = {
+        "short_name": lease.short_name,
+        "audio_wav_path": lease.wav_path,
+        "archive_urls": lease.archive_urls,
+        "completed_stages": sorted(lease.completed_stages)
+    }
+    if lease.completed_stages:
+        module_logger.info(f"<<Work Queue>> Resuming {lease.wav_path} at {', '.join(stages)}.")
+
+    try:
+        call_data = process_call(initial_call_data, config_data, stages=stages, stage_completed=stage_completed)
+    except LeaseLostError as e:
+        module_logger.warning(f"<<Work Queue>> {e} Leaving the rest to the new holder.")
+        return False
+    except Exception as e:
+        module_logger.error(f"<<Work Queue>> Processing {lease.wav_path} failed: {e}")
+        work_queue.release(lease, str(e))
+        return False
+
+    if call_data is None:
+        work_queue.release(lease, "Call metadata could not be loaded.")
+        return False
+
+    if not call_data.get("simulcast_duplicate_of") and not set(stages) <= set(call_data.get("completed_stages", [])):
+        work_queue.release(lease, f"Did not complete {', '.join(stage for stage in stages if stage not in call_data['completed_stages'])}.")
+        return False
+
+    return work_queue.complete(lease)
+
+
+def _lease_worker(work_queue, lease_keeper, config_manager, owner, stop_event):
+    while not stop_event.is_set():
+        try:
+            lease = work_queue.claim(owner)
+        except sqlite3.Error as e:
+            module_logger.error(f"<<Work Queue>> Unable to claim a call: {e}")
+            lease = None
+        if lease is None:
+            stop_event.wait(CLAIM_POLL_SECONDS)
+            continue
+
+        lease_keeper.hold(lease)
+        start_time = time.monotonic()
+        try:
+            module_logger.info(f"Processing Call {lease.wav_path} (attempt {lease.attempts})")
+            # Each call runs with the config current when it starts, so reloads apply between calls.
+            if process_leased_call(work_queue, lease, config_manager.current):
+                module_logger.info(f"Completed Processing Call {lease.wav_path} in {time.monotonic() - start_time:.2f} seconds.")
+        except sqlite3.Error as e:
+            # The lease runs out and the call is picked up again.
+            module_logger.error(f"<<Work Queue>> Unable to record progress on {lease.wav_path}: {e}")
+        finally:
+            lease_keeper.drop(lease)
+
+
+def start_lease_workers(work_queue, config_manager, workers, stop_event):
+    """
+    Start worker threads that claim calls from work_queue until stop_event is set. Each worker
+    finishes the call it holds before stopping.
+
+    :return: Callable that waits for the workers to stop and stops renewing leases.
+    """
+    distributed_config = config_manager.current.distributed
+    owner = node_name(distributed_config)
+    lease_keeper = LeaseKeeper(work_queue, distributed_config.lease_seconds, distributed_config.retain_done_hours * 3600)
+    lease_keeper.start()
+
+    threads = []
+    for worker_number in range(max(1, workers)):
+        thread = threading.Thread(target=_lease_worker, args=(work_queue, lease_keeper, config_manager, owner, stop_event),
+                                  name=f"LeaseWorker-{worker_number}", daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    module_logger.info(f"<<Work Queue>> {owner} started {len(threads)} workers. Queue: {work_queue.counts()}")
+
+    def join():
+        for thread in threads:
+            thread.join()
+        lease_keeper.stop()
+
+    return join
+
+
+def run_worker_mode(config_manager, workers=None, stop_event=None):
+    """
+    Process calls from the shared work queue until stop_event is set. Calls are added to the
+    queue by a watch mode node with distributed.enabled.
+
+    :param config_manager: ConfigManager. The distributed settings are read once at startup.
+    :param workers: Calls processed at once. Defaults to watch.workers.
+    :param stop_event: threading.Event that ends the loop after the calls in progress finish.
+    :raises ValueError: If distributed.backend is "memory", whose queue only the watch process that made it can feed.
+    """
+    current_config = config_manager.current
+    if current_config.distributed.backend == "memory":
+        raise ValueError("Worker mode needs distributed.backend \"sqlite\". A memory queue is only fed by the watch "
+                         "process that holds it, so run watch with distributed.enabled instead.")
+    stop_event = stop_event or threading.Event()
+    work_queue = get_work_queue(current_config.distributed)
+
+    join_workers = start_lease_workers(work_queue, config_manager, workers or current_config.watch.workers, stop_event)
+    start_metadata_segment_flusher(config_manager, stop_event)
+    try:
+        stop_event.wait()
+    finally:
+        stop_event.set()
+        module_logger.info("<<Work Queue>> Stopping. Waiting for calls in progress to finish.")
+        join_workers()
+        flush_metadata_segments(config_manager.current.archive, config_manager.current.bandwidth)
@@ -1,12 +1,21 @@
 import argparse
 import os
+import signal
 import subprocess
 import sys
+import threading
 import time
+from datetime import datetime, timezone
 
-from lib.call_processing_module import process_call
-from lib.config_module import load_config_file, module_logger
+from lib.audio_server_module import run_audio_server
+from lib.backfill_module import run_backfill
+from lib.call_processing_module import process_call, resume_stages, CALL_STAGES
+from lib.config_module import ConfigManager, module_logger
+from lib.deadline_module import RetryScheduler
+from lib.encoder_module import ENCODERS, benchmark_encoders
 from lib.logging_module import CustomLogger
+from lib.watch_module import run_watch_mode
+from lib.work_queue_module import run_worker_mode
 
 app_name = "tr_rdio_uploader"
 __version__ = "0.0.1"
@@ -25,8 +34,9 @@ main_logger = logging_instance.logger
 
 # Load or Create Configuration
 try:
-    config_data = load_config_file(config_file_path)
-    logging_instance.set_log_level(config_data["log_level"])
+    config_manager = ConfigManager(config_file_path)
+    config_data = config_manager.current
+    logging_instance.set_log_level(config_data.log_level)
     main_logger.info("Loaded Config File")
 except Exception as e:
     main_logger.error(f'Error while <<loading>> configuration : {e}')
@@ -35,13 +45,160 @@ except Exception as e:
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Process Arguments.')
-    parser.add_argument("-s", "--system_short_name", type=str, help="System Short Name.", required=True)
-    parser.add_argument("-a", "--audio_wav_path", type=str, help="Path to WAV.", required=True)
+    parser.add_argument("-s", "--system_short_name", type=str, help="System Short Name.")
+    parser.add_argument("-a", "--audio_wav_path", type=str, help="Path to WAV.")
+
+    subparsers = parser.add_subparsers(dest="command")
+
+    watch_parser = subparsers.add_parser("watch", help="Watch trunk-recorder capture directories and process calls as they complete.")
+    watch_parser.add_argument("-s", "--system_short_name", type=str, default=argparse.SUPPRESS,
+                              help="System Short Name. Defaults to the first directory below each capture path.")
+    watch_parser.add_argument("-p", "--capture_path", type=str, action="append", dest="capture_paths",
+                              help="trunk-recorder captureDir to watch. May be repeated. Defaults to watch.capture_paths in config.")
+
+    backfill_parser = subparsers.add_parser("backfill", help="Reprocess existing calls across a process pool.")
+    backfill_parser.add_argument("-s", "--system_short_name", type=str, default=argparse.SUPPRESS, required=True,
+                                 help="System Short Name.")
+    backfill_parser.add_argument("-d", "--directory", type=str, action="append", dest="directories",
+                                 help="Directory to search for calls. May be repeated. Defaults to <capture path>/<short name> for each watch.capture_paths.")
+    backfill_parser.add_argument("--since", type=_parse_date, help="Only calls starting on or after this UTC date (YYYY-MM-DD).")
+    backfill_parser.add_argument("--until", type=_parse_date, help="Only calls starting before this UTC date (YYYY-MM-DD).")
+    backfill_parser.add_argument("--stages", type=_parse_stages, default=list(CALL_STAGES),
+                                 help=f"Comma separated stages to redo. Default: {','.join(CALL_STAGES)}")
+    backfill_parser.add_argument("--workers", type=int, help="Worker processes. Defaults to backfill.workers in config.")
+    backfill_parser.add_argument("--checkpoint", type=str,
+                                 help="Checkpoint file. Reuse it to resume a backfill. Defaults to backfill.checkpoint_path in config.")
+
+    worker_parser = subparsers.add_parser("worker", help="Process calls from the shared work queue set up in the distributed config.")
+    worker_parser.add_argument("--workers", type=int, help="Calls processed at once. Defaults to watch.workers in config.")
+
+    subparsers.add_parser("serve", help="Serve the local archive over HTTP using archive.local.server settings.")
+
+    benchmark_parser = subparsers.add_parser("benchmark-encoders", help="Time each encoder on short synthetic calls.")
+    benchmark_parser.add_argument("--encoders", type=str, default=",".join(ENCODERS),
+                                  help=f"Comma separated encoders to time. Default: {','.join(ENCODERS)}")
+    benchmark_parser.add_argument("--durations", type=str, default="1,2,5",
+                                  help="Comma separated call lengths in seconds. Default: 1,2,5")
+    benchmark_parser.add_argument("--iterations", type=int, default=20, help="Encodes per call length. Default: 20")
+
     args = parser.parse_args()
 
+    if args.command is None and (not args.system_short_name or not args.audio_wav_path):
+        parser.error("the following arguments are required: -s/--system_short_name, -a/--audio_wav_path")
+
     return args
 
 
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid date '{value}', expected YYYY-MM-DD.")
+
+
+def _parse_stages(value):
+    stages = [stage.strip() for stage in value.split(",") if stage.strip()]
+    unknown_stages = [stage for stage in stages if stage not in CALL_STAGES]
+    if unknown_stages or not stages:
+        raise argparse.ArgumentTypeError(f"Invalid stages '{value}', choose from {','.join(CALL_STAGES)}.")
+    return stages
+
+
+def watch(args):
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        main_logger.info(f"Received signal {signum}, stopping watch mode.")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    try:
+        config_manager.start_watching()
+        run_watch_mode(config_manager, args.capture_paths, getattr(args, "system_short_name", None), stop_event)
+    except Exception as e:
+        main_logger.error(f"Watch mode stopped with error: {e}")
+        sys.exit(1)
+
+
+def backfill(args):
+    search_paths = args.directories or [os.path.join(capture_path, args.system_short_name)
+                                        for capture_path in config_data.watch.capture_paths]
+    if not search_paths:
+        main_logger.error("No backfill directory given and no watch.capture_paths configured.")
+        sys.exit(1)
+
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        main_logger.info(f"Received signal {signum}, stopping backfill after in-flight calls.")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    config_manager.start_watching()
+    completed, failed, skipped = run_backfill(config_manager, args.system_short_name, search_paths, args.since, args.until,
+                                              args.stages, args.checkpoint, args.workers, stop_event)
+    if failed:
+        sys.exit(1)
+
+
+def worker(args):
+    if not config_data.distributed.enabled:
+        main_logger.error("Worker mode needs distributed.enabled in config.")
+        sys.exit(1)
+    if config_data.distributed.backend == "memory":
+        main_logger.error("Worker mode needs distributed.backend \"sqlite\". The memory queue is only fed by the watch process that holds it.")
+        sys.exit(1)
+
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        main_logger.info(f"Received signal {signum}, stopping worker after in-flight calls.")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    try:
+        config_manager.start_watching()
+        run_worker_mode(config_manager, args.workers, stop_event)
+    except Exception as e:
+        main_logger.error(f"Worker mode stopped with error: {e}")
+        sys.exit(1)
+
+
+def serve(args):
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        main_logger.info(f"Received signal {signum}, stopping audio server.")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    try:
+        run_audio_server(config_data.archive, stop_event)
+    except Exception as e:
+        main_logger.error(f"Audio server stopped with error: {e}")
+        sys.exit(1)
+
+
+def benchmark(args):
+    encoder_names = [name.strip() for name in args.encoders.split(",") if name.strip()]
+    durations = tuple(float(duration) for duration in args.durations.split(",") if duration.strip())
+
+    results = benchmark_encoders(config_data.m4a_audio_compression, encoder_names, durations, args.iterations)
+    for encoder_name, timings in results.items():
+        if isinstance(timings, str):
+            print(f"{encoder_name}: unavailable ({timings})")
+            continue
+        for duration, (median_seconds, p95_seconds) in timings.items():
+            print(f"{encoder_name}: {duration:g}s call  median {median_seconds * 1000:.1f} ms  p95 {p95_seconds * 1000:.1f} ms")
+
 
 def main():
     initial_call_data = {
@@ -50,13 +207,43 @@ def main():
     }
     args = parse_arguments()
 
+    if args.command == "watch":
+        watch(args)
+        return
+    if args.command == "backfill":
+        backfill(args)
+        return
+    if args.command == "worker":
+        worker(args)
+        return
+    if args.command == "serve":
+        serve(args)
+        return
+    if args.command == "benchmark-encoders":
+        benchmark(args)
+        return
+
     initial_call_data["short_name"] = args.system_short_name
     initial_call_data["audio_wav_path"] = args.audio_wav_path
 
     start_time = time.time()
     main_logger.info(f"Processing Call {args.audio_wav_path}")
     try:
-       process_call(initial_call_data, config_data)
+       call_data = process_call(initial_call_data, config_data)
+       archive_config = config_data.for_system(args.system_short_name).archive
+       retry_scheduler = RetryScheduler(max_attempts=archive_config.max_attempts, retry_delay=archive_config.retry_delay)
+       attempt = 1
+       while call_data and call_data.get("retry_stages"):
+           delay = retry_scheduler.retry_delay_after(attempt)
+           if delay is None:
+               main_logger.error(f"Giving up on {', '.join(call_data['retry_stages'])} after {attempt} attempts.")
+               break
+           # This process only handles this call, so it can wait out the backoff itself.
+           main_logger.warning(f"Retrying {', '.join(call_data['retry_stages'])} in {delay}s.")
+           time.sleep(delay)
+           attempt += 1
+           call_data = process_call(initial_call_data, config_data,
+                                    stages=resume_stages(args.audio_wav_path, call_data["retry_stages"]))
        main_logger.info(f"Completed Processing Call {args.audio_wav_path}")
        main_logger.debug(f"Call processing too {int(time.time() - start_time)} seconds.")
     except (FileNotFoundError, EnvironmentError, subprocess.CalledProcessError, RuntimeError, Exception) as e: